@@ -0,0 +1,76 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Compare pd.read_csv with csv_reader.read_csv (pyarrow parser, first load and repeat load with the cached
+schema) on a wide and a long synthetic CSV, and check that they give the same values. pyarrow parses floats
+exactly, like pd.read_csv(float_precision="round_trip"), the default C parser can be 1 ulp off, the values are
+compared with the former.
+
+    PYTHONPATH=. python benchmarks/bench_csv_read.py [long rows] [wide columns]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from data_formulator import csv_reader
+
+
+def synthetic_frame(rows, numeric_columns, string_columns, seed=0):
+    rng = np.random.default_rng(seed)
+    columns = {}
+    for i in range(numeric_columns):
+        columns[f"n{i}"] = rng.integers(0, 10**6, rows) if i % 2 == 0 else rng.random(rows) * 1000
+    for i in range(string_columns):
+        columns[f"s{i}"] = rng.choice(["north", "south", "east", "west", ""], rows)
+    columns["date"] = pd.Timestamp("2020-01-01") + pd.to_timedelta(rng.integers(0, 1000, rows), unit="D")
+    columns["date"] = columns["date"].strftime("%Y-%m-%d")
+    return pd.DataFrame(columns)
+
+
+def timed(read, path, repeats=3):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        df = read(path)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, df
+
+
+def bench(name, df, cache_dir):
+    path = os.path.join(cache_dir, f"{name}.csv")
+    df.to_csv(path, index=False)
+    print(f"{name}: {df.shape[0]} rows x {df.shape[1]} columns, {os.path.getsize(path) / 2**20:.1f} MB")
+
+    pandas_seconds, expected = timed(pd.read_csv, path)
+
+    def first_load(path):
+        csv_reader.csv_schema_cache.invalidate(path)
+        return csv_reader.read_csv(path)
+    first_seconds, first = timed(first_load, path)
+
+    csv_reader.read_csv(path)
+    repeat_seconds, repeat = timed(csv_reader.read_csv, path)
+
+    expected = pd.read_csv(path, float_precision="round_trip")
+    same = first.equals(expected) and repeat.equals(expected)
+    print(f"  pd.read_csv (C parser)        {pandas_seconds:7.3f} s")
+    print(f"  read_csv, first load          {first_seconds:7.3f} s   {pandas_seconds / first_seconds:5.2f}x")
+    print(f"  read_csv, cached schema       {repeat_seconds:7.3f} s   {pandas_seconds / repeat_seconds:5.2f}x")
+    print(f"  same values                   {same}")
+
+
+if __name__ == "__main__":
+    long_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    wide_columns = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+    print(f"pyarrow parser available: {csv_reader.pa_csv is not None}, cpus: {os.cpu_count()}")
+    with tempfile.TemporaryDirectory() as cache_dir:
+        csv_reader.configure_csv_schema_cache(os.path.join(cache_dir, "csv_schemas.json"))
+        bench("long", synthetic_frame(long_rows, 6, 3), cache_dir)
+        bench("wide", synthetic_frame(2000, wide_columns - wide_columns // 5, wide_columns // 5), cache_dir)
@@ -0,0 +1,58 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Compare creating a new openai.OpenAI client (and so a new connection pool) for every completion against
+the shared, kept-alive clients of client_utils, using a local OpenAI-compatible stub that answers immediately.
+
+    PYTHONPATH=. python benchmarks/bench_http_clients.py [calls]
+"""
+
+import statistics
+import sys
+import time
+
+import openai
+from mock_llm_server import MockLLMServer
+
+from data_formulator.agents.client_utils import Client
+
+MESSAGES = [{"role": "user", "content": "hello"}]
+
+
+def bench_new_client_per_call(client, calls):
+    latencies = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        # what Client.get_completion did before the clients were shared
+        openai_client = openai.OpenAI(api_key=client.params["api_key"], base_url=client.params["api_base"], timeout=120)
+        openai_client.chat.completions.create(**client.openai_completion_params(MESSAGES))
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def bench_shared_client(client, calls):
+    latencies = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        client.get_completion(MESSAGES)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def report(name, latencies):
+    print(f"{name:<20} mean {statistics.mean(latencies) * 1000:7.2f} ms   median {statistics.median(latencies) * 1000:7.2f} ms")
+
+
+if __name__ == "__main__":
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    with MockLLMServer(token_delay=0) as server:
+        client = Client("openai", "mock-model", api_key="mock", api_base=server.url)
+        bench_shared_client(client, 5)
+
+        new_client = bench_new_client_per_call(client, calls)
+        shared_client = bench_shared_client(client, calls)
+
+    report("new client per call", new_client)
+    report("shared client", shared_client)
+    print(f"saved per call       {(statistics.mean(new_client) - statistics.mean(shared_client)) * 1000:7.2f} ms")
@@ -0,0 +1,75 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Compare converting a DataFrame to json records through df.to_json + json.loads with the column-wise
+agent_utils.dataframe_to_records, on a synthetic table (floats, ints, strings, datetimes, with missing values).
+Each conversion runs in its own process so that its peak RSS is measured alone.
+
+    PYTHONPATH=. python benchmarks/bench_records.py [rows] [columns]
+"""
+
+import json
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from data_formulator.agents.agent_utils import dataframe_to_records
+
+
+def synthetic_frame(rows, columns, seed=0):
+    rng = np.random.default_rng(seed)
+    data = {}
+    for i in range(columns):
+        kind = i % 5
+        if kind in (0, 1):
+            values = rng.random(rows) * 1000
+            values[rng.random(rows) < 0.05] = np.nan
+        elif kind == 2:
+            values = rng.integers(0, 10**6, rows)
+        elif kind == 3:
+            values = rng.choice(np.array(["north", "south", "east", "west", None], dtype=object), rows)
+        else:
+            values = pd.Timestamp("2020-01-01") + pd.to_timedelta(rng.integers(0, 10**8, rows), unit="s")
+        data[f"c{i}"] = values
+    return pd.DataFrame(data)
+
+
+def to_json_records(df):
+    return json.loads(df.to_json(orient="records"))
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run(method, rows, columns):
+    df = synthetic_frame(rows, columns)
+    before = peak_rss_mb()
+    start = time.perf_counter()
+    records = {"to_json": to_json_records, "direct": dataframe_to_records}[method](df)
+    elapsed = time.perf_counter() - start
+    print(json.dumps({"seconds": elapsed, "frame_rss_mb": before, "peak_rss_mb": peak_rss_mb(), "rows": len(records)}))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--run":
+        run(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+        sys.exit(0)
+
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    columns = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    sample = synthetic_frame(20000, columns)
+    print(f"same records on a 20000-row sample: {to_json_records(sample) == dataframe_to_records(sample)}")
+
+    print(f"{rows} rows x {columns} columns")
+    for method in ["to_json", "direct"]:
+        output = subprocess.run([sys.executable, __file__, "--run", method, str(rows), str(columns)],
+                                capture_output=True, text=True, check=True).stdout
+        result = json.loads(output)
+        print(f"  {method:<8} {result['seconds']:7.2f} s   peak RSS {result['peak_rss_mb']:7.0f} MB "
+              f"(frame alone {result['frame_rss_mb']:.0f} MB)")
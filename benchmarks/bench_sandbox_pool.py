@@ -0,0 +1,56 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Compare cold-spawn and warm-pool sandbox latency over many small transforms.
+Pooled workers run a single task and are replaced in the background, back-to-back runs on a pool with fewer
+workers than runs (one per core by default) also wait for those replacements.
+
+    PYTHONPATH=. python benchmarks/bench_sandbox_pool.py [runs]
+"""
+
+import statistics
+import sys
+import time
+
+import data_formulator.py_sandbox as py_sandbox
+from data_formulator.sandbox_cache import result_cache
+
+CODE = '''
+import pandas as pd
+
+def transform_data(df):
+    df["total"] = df["a"] + df["b"]
+    return df.groupby("group", as_index=False)["total"].sum()
+'''
+
+TABLE = [{"group": i % 5, "a": i, "b": i * 2} for i in range(200)]
+
+
+def bench(runs, use_pool):
+    latencies = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = py_sandbox.run_transform_in_sandbox2020(CODE, [TABLE], use_pool=use_pool)
+        latencies.append(time.perf_counter() - start)
+        assert result["status"] == "ok", result
+    return latencies
+
+
+def report(name, latencies):
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f"{name:<12} mean {statistics.mean(latencies) * 1000:8.2f} ms   "
+          f"median {statistics.median(latencies) * 1000:8.2f} ms   p95 {p95 * 1000:8.2f} ms")
+
+
+if __name__ == "__main__":
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    # every run repeats the same transform, it has to execute instead of being replayed from the result cache
+    result_cache.enabled = False
+
+    # make sure the pool is warm before measuring it
+    py_sandbox.get_sandbox_pool()
+    bench(2, use_pool=True)
+
+    report("cold spawn", bench(runs, use_pool=False))
+    report("warm pool", bench(runs, use_pool=True))
@@ -0,0 +1,58 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Compare returning a transform result as json records (to_json + json.loads) against the arrow
+shared-memory channel that keeps it as a dataframe until the task boundary.
+Each mode runs in its own interpreter so that peak RSS is measured independently.
+
+    PYTHONPATH=. python benchmarks/bench_sandbox_result.py [rows]
+"""
+
+import json
+import resource
+import subprocess
+import sys
+import time
+
+CODE = '''
+import numpy as np
+
+def transform_data(df):
+    df["ratio"] = df["a"] / (df["b"] + 1)
+    df["label"] = np.where(df["a"] % 2 == 0, "even", "odd")
+    return df
+'''
+
+
+def run_mode(mode, rows):
+    import data_formulator.py_sandbox as py_sandbox
+    from data_formulator.agents.agent_utils import dataframe_to_records
+
+    table = [{"a": i, "b": i % 97, "name": f"item-{i % 1000}"} for i in range(rows)]
+    py_sandbox.get_sandbox_pool()
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    start = time.perf_counter()
+    result = py_sandbox.run_transform_in_sandbox2020(CODE, [table], output_format=mode)
+    returned = time.perf_counter() - start
+    assert result["status"] == "ok", result
+
+    if mode == "json":
+        records = json.loads(result["content"])
+    else:
+        records = dataframe_to_records(result["content"])
+    total = time.perf_counter() - start
+    assert len(records) == rows
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f"{mode:<6} result returned {returned * 1000:9.1f} ms   as records {total * 1000:9.1f} ms   "
+          f"parent peak RSS +{(peak_rss - baseline_rss) / 1024:8.1f} MB")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "--mode":
+        run_mode(sys.argv[2], int(sys.argv[3]))
+    else:
+        rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+        for mode in ["json", "arrow"]:
+            subprocess.run([sys.executable, __file__, "--mode", mode, str(rows)], check=True)
@@ -0,0 +1,65 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Compare waiting for the whole completion against streaming it and starting the sandbox as soon as the
+python block is closed, using a local OpenAI-compatible mock server.
+
+time to first result: from sending the request to the sandbox result being ready
+end to end: until agent.run returns the candidates
+
+    PYTHONPATH=. python benchmarks/bench_streaming.py [runs] [rows] [token delay in ms]
+"""
+
+import statistics
+import sys
+import time
+
+from mock_llm_server import MockLLMServer
+
+from data_formulator.agents.agent_data_transform_v2 import DataTransformationAgentV2
+from data_formulator.agents.client_utils import Client
+import data_formulator.py_sandbox as py_sandbox
+from data_formulator.sandbox_cache import result_cache
+
+
+class TimedAgent(DataTransformationAgentV2):
+
+    def execute_code(self, input_tables, code_str):
+        result = super().execute_code(input_tables, code_str)
+        self.result_ready_at = time.perf_counter()
+        return result
+
+
+def bench(client, input_tables, runs, stream):
+    agent = TimedAgent(client=client, stream=stream)
+    first_results, end_to_ends = [], []
+    for _ in range(runs):
+        # every run has to execute the code, not replay it from the result cache
+        result_cache.clear()
+        start = time.perf_counter()
+        candidates = agent.run(input_tables, "total of a and b per group", ["group", "total"])
+        end_to_ends.append(time.perf_counter() - start)
+        first_results.append(agent.result_ready_at - start)
+        assert candidates[0]["status"] == "ok", candidates[0]
+    return first_results, end_to_ends
+
+
+def report(name, first_results, end_to_ends):
+    print(f"{name:<10} time to first result {statistics.median(first_results) * 1000:8.1f} ms   "
+          f"end to end {statistics.median(end_to_ends) * 1000:8.1f} ms   (medians)")
+
+
+if __name__ == "__main__":
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    rows = int(sys.argv[2]) if len(sys.argv) > 2 else 200000
+    token_delay = (float(sys.argv[3]) if len(sys.argv) > 3 else 10) / 1000
+
+    input_tables = [{"name": "table", "rows": [{"group": i % 50, "a": i, "b": i * 2} for i in range(rows)]}]
+    py_sandbox.get_sandbox_pool()
+
+    with MockLLMServer(token_delay=token_delay) as server:
+        client = Client("openai", "mock-model", api_key="mock", api_base=server.url)
+        bench(client, input_tables, 1, stream=True)
+
+        report("blocking", *bench(client, input_tables, runs, stream=False))
+        report("streaming", *bench(client, input_tables, runs, stream=True))
@@ -0,0 +1,50 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Compare row-wise, vectorized and auto (vectorized, checked against row-wise output on probe rows) throughput
+of the derive / filter sandbox helpers across table sizes.
+
+    PYTHONPATH=. python benchmarks/bench_vectorized_derive.py [max_rows]
+"""
+
+import sys
+import time
+
+import data_formulator.py_sandbox as py_sandbox
+
+DERIVE_CODE = '''
+def derive(price, quantity):
+    return price * quantity * 1.2
+'''
+
+FILTER_CODE = '''
+def filter_row(row, df):
+    return (row["price"] > 50) & (row["quantity"] % 2 == 0)
+'''
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    assert result["status"] == "ok", result
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    max_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    py_sandbox.get_sandbox_pool()
+
+    print(f"{'rows':>10} {'helper':<8} {'rowwise':>12} {'vectorized':>12} {'auto':>12} {'speedup':>8}")
+    rows = 1_000
+    while rows <= max_rows:
+        table = [{"price": i % 100, "quantity": i % 7} for i in range(rows)]
+        for name, fn, args in [
+            ("derive", py_sandbox.run_derive_data_in_sandbox2020, (DERIVE_CODE, ["price", "quantity"], "total", table)),
+            ("filter", py_sandbox.run_filter_data_in_sandbox2020, (FILTER_CODE, table)),
+        ]:
+            rowwise = timed(fn, *args, mode="rowwise")
+            vectorized = timed(fn, *args, mode="vectorized")
+            auto = timed(fn, *args, mode="auto")
+            print(f"{rows:>10} {name:<8} {rowwise * 1000:>9.1f} ms {vectorized * 1000:>9.1f} ms {auto * 1000:>9.1f} ms "
+                  f"{rowwise / auto:>7.1f}x")
+        rows *= 10
@@ -0,0 +1,119 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""A local OpenAI-compatible chat completions server for benchmarks.
+
+It answers every request with the same transformation response (refined goal, python block, trailing
+explanation), emitted token by token with a fixed delay, either as one completion or as a server-sent
+event stream. Use it with Client("openai", "mock-model", api_key="mock", api_base=server.url).
+"""
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+RESPONSE = '''```json
+{
+    "detailed_instruction": "Compute the total of a and b for every group.",
+    "output_fields": ["group", "total"],
+    "visualization_fields": ["group", "total"],
+    "reason": "The user wants to compare the totals across groups."
+}
+```
+
+```python
+import pandas as pd
+import collections
+import numpy as np
+
+def transform_data(df):
+    df["total"] = df["a"] + df["b"]
+    transformed_df = df.groupby("group", as_index=False)["total"].sum()
+    return transformed_df
+```
+
+The function adds a "total" column that sums the "a" and "b" columns of every row, then aggregates the totals
+per group so that each group appears exactly once in the output. Grouping with as_index=False keeps "group" as a
+regular column, which makes the result ready to be used as the x axis of a bar chart, while "total" goes on the
+y axis. No rows are filtered out, and groups keep the order produced by the groupby.
+'''
+
+
+def tokenize(text, token_size=4):
+    return [text[i:i + token_size] for i in range(0, len(text), token_size)]
+
+
+class MockCompletionHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.request_count += 1
+        tokens = tokenize(self.server.response_text)
+        if request.get("stream"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for token in tokens:
+                time.sleep(self.server.token_delay)
+                self.write_chunk(self.chunk_event(request, {"content": token}, None))
+            self.write_chunk(self.chunk_event(request, {}, "stop"))
+            self.write_chunk(b"data: [DONE]\n\n")
+            self.write_chunk(b"")
+        else:
+            time.sleep(self.server.token_delay * len(tokens))
+            body = json.dumps({
+                "id": "chatcmpl-mock", "object": "chat.completion", "created": int(time.time()),
+                "model": request["model"],
+                "choices": [{"index": i, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": self.server.response_text}}
+                            for i in range(request.get("n", 1))],
+                "usage": {"prompt_tokens": 0, "completion_tokens": len(tokens), "total_tokens": len(tokens)},
+            }).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def chunk_event(self, request, delta, finish_reason):
+        chunk = {
+            "id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": int(time.time()),
+            "model": request["model"],
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        return f"data: {json.dumps(chunk)}\n\n".encode()
+
+    def write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+
+class MockLLMServer(object):
+    """run the mock server in a background thread: `with MockLLMServer() as server: ...`"""
+
+    def __init__(self, response_text=RESPONSE, token_delay=0.01):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), MockCompletionHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.response_text = response_text
+        self.httpd.token_delay = token_delay
+        self.httpd.request_count = 0
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/v1"
+
+    @property
+    def request_count(self):
+        return self.httpd.request_count
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
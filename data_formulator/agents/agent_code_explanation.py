@@ -1,6 +1,7 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
+import asyncio
 import pandas as pd
 from data_formulator.agents.agent_utils import generate_data_summary, extract_code_from_gpt_response
 
@@ -71,14 +72,7 @@ class CodeExplanationAgent(object):
 
     def run(self, input_tables, code):
 
-        data_summary = generate_data_summary(input_tables, include_data_samples=True)
-
-        user_query = f"[CONTEXT]\n\n{data_summary}\n\n[CODE]\n\here is the transformation code: {code}\n\n[EXPLANATION]\n"
-
-        logger.info(user_query)
-
-        messages = [{"role":"system", "content": SYSTEM_PROMPT},
-                    {"role":"user","content": user_query}]
+        messages = self.messages(input_tables, code)
         
         ###### the part that calls open_ai
         response = self.client.get_completion(messages = messages)
@@ -86,3 +80,24 @@ class CodeExplanationAgent(object):
         logger.info(f"=== explanation output ===>\n{response.choices[0].message.content}\n")
         
         return response.choices[0].message.content
+
+    async def arun(self, input_tables, code):
+        """async version of run"""
+        messages = await asyncio.to_thread(self.messages, input_tables, code)
+
+        response = await self.client.aget_completion(messages = messages)
+
+        logger.info(f"=== explanation output ===>\n{response.choices[0].message.content}\n")
+
+        return response.choices[0].message.content
+
+    def messages(self, input_tables, code):
+
+        data_summary = generate_data_summary(input_tables, include_data_samples=True)
+
+        user_query = f"[CONTEXT]\n\n{data_summary}\n\n[CODE]\n\here is the transformation code: {code}\n\n[EXPLANATION]\n"
+
+        logger.info(user_query)
+
+        return [{"role":"system", "content": SYSTEM_PROMPT},
+                {"role":"user","content": user_query}]
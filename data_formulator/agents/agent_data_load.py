@@ -1,10 +1,14 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
+import asyncio
 import json
 from typing import Any
 
+import pandas as pd
+
 from data_formulator.agents.agent_utils import extract_json_objects, generate_data_summary
+from data_formulator.agents.field_inference import describe_fields, fallback_field, infer_fields
 
 SYSTEM_PROMPT = '''You are a data scientist to help user infer data types based off the table provided by the user.
 Given a dataset provided by the user, identify their type and semantic type, and provide a very short summary of the dataset.
@@ -120,28 +124,93 @@ table_0 (weather_seattle_atlanta) sample:
 }```'''
 
 class DataLoadAgent(object):
+    """infers field types and summarizes a table. With local_inference, fields whose type can be decided from
+    their values are typed locally and only the ambiguous ones (and the data summary) are asked to the model"""
 
-    def __init__(self, client, logger):
+    def __init__(self, client, logger, local_inference=True):
         self.client = client
         self.logger = logger
+        self.local_inference = local_inference
 
     def run(self, input_data, n=1):
+        known_fields = self.infer_fields(input_data)
+        messages = self.messages(input_data, known_fields)
+        
+        ###### the part that calls open_ai
+        response = self.client.get_completion(messages = messages, n = n)
+
+        #log = {'messages': messages, 'response': response.model_dump(mode='json')}
+
+        return self.process_response(messages, response, known_fields, input_data)
+
+    async def arun(self, input_data, n=1):
+        """async version of run"""
+        known_fields = await asyncio.to_thread(self.infer_fields, input_data)
+        messages = await asyncio.to_thread(self.messages, input_data, known_fields)
+        response = await self.client.aget_completion(messages = messages, n = n)
+        return self.process_response(messages, response, known_fields, input_data)
+
+    def run_local(self, input_data):
+        """type every field and summarize the table without calling the model, ambiguous fields get a generic type"""
+        df = pd.DataFrame(input_data["rows"])
+        fields = {name: field if field is not None else fallback_field(df[name])
+                  for name, field in infer_fields(df).items()}
+        content = {"fields": fields, "data summary": describe_fields(input_data["name"], df, fields)}
+        return [{'status': 'ok', 'content': content, 'dialog': [], 'agent': 'DataLoadAgent'}]
+
+    def infer_fields(self, input_data):
+        """{field name: type entry or None (ambiguous)}, None when local inference is off"""
+        if not self.local_inference:
+            return None
+        known_fields = infer_fields(pd.DataFrame(input_data["rows"]))
+        self.logger.info(f"inferred {sum(f is not None for f in known_fields.values())} of {len(known_fields)} field types locally")
+        return known_fields
+
+    def messages(self, input_data, known_fields=None):
         print("input data ", input_data["rows"][0])
-        # 用表的前几条数据生成一个简短的sample，同时拉出前几列字段和最后几列字段拼一起，中间用... 连接省略大量的数据。不是全部读取
-        data_summary = generate_data_summary([input_data], include_data_samples=True, field_sample_size=30)
+        if known_fields is None:
+            # 用表的前几条数据生成一个简短的sample，同时拉出前几列字段和最后几列字段拼一起，中间用... 连接省略大量的数据。不是全部读取
+            data_summary = generate_data_summary([input_data], include_data_samples=True, field_sample_size=30)
+        else:
+            data_summary = self.partial_data_summary(input_data, known_fields)
 
         user_query = f"[DATA]\n\n{data_summary}\n\n[OUTPUT]"
 
         self.logger.info(user_query)
 
-        messages = [{"role":"system", "content": SYSTEM_PROMPT},
-                    {"role":"user","content": user_query}]
-        
-        ###### the part that calls open_ai
-        response = self.client.get_completion(messages = messages)
-
-        #log = {'messages': messages, 'response': response.model_dump(mode='json')}
-
+        return [{"role":"system", "content": SYSTEM_PROMPT},
+                {"role":"user","content": user_query}]
+
+    def partial_data_summary(self, input_data, known_fields):
+        """the data summary restricted to the ambiguous fields, followed by the fields typed locally"""
+        ambiguous = [name for name, field in known_fields.items() if field is None]
+        parts = []
+        if len(ambiguous) > 0:
+            rows = [{name: row.get(name) for name in ambiguous} for row in input_data["rows"]]
+            parts.append(generate_data_summary([{"name": input_data["name"], "rows": rows}],
+                                               include_data_samples=True, field_sample_size=30))
+            parts.append("Only include the fields above in \"fields\".")
+        else:
+            parts.append("All field types are known, leave \"fields\" empty.")
+
+        known = '\n\t'.join(f"{name} -- type: {field['type']}, semantic type: {field['semantic_type']}"
+                             for name, field in known_fields.items() if field is not None)
+        if known:
+            parts.append(f"The other fields of {input_data['name']}, already typed (use them for the data summary):\n\t{known}")
+        return "\n\n".join(parts)
+
+    def merge_fields(self, content, known_fields, input_data):
+        """fill the fields typed locally into the model's answer, ambiguous fields the model skipped get a generic type
+        like in run_local"""
+        llm_fields = content.get("fields") if isinstance(content.get("fields"), dict) else {}
+        skipped = [name for name, field in known_fields.items() if field is None and name not in llm_fields]
+        if len(skipped) > 0:
+            df = pd.DataFrame(input_data["rows"])
+            llm_fields = {**llm_fields, **{name: fallback_field(df[name]) for name in skipped}}
+        content["fields"] = {name: field if field is not None else llm_fields[name] for name, field in known_fields.items()}
+        return content
+
+    def process_response(self, messages, response, known_fields=None, input_data=None):
         candidates = []
         for choice in response.choices:
             
@@ -159,6 +228,9 @@ class DataLoadAgent(object):
                     result = {'status': 'ok', 'content': json_block}
                 except:
                     result = {'status': 'other error', 'content': 'unable to extract VegaLite script from response'}
+
+            if result['status'] == 'ok' and known_fields is not None and isinstance(result['content'], dict):
+                result['content'] = self.merge_fields(result['content'], known_fields, input_data)
             
             # individual dialog for the agent
             result['dialog'] = [*messages, {"role": choice.message.role, "content": choice.message.content}]
@@ -1,12 +1,19 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
+import asyncio
 import json
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from types import SimpleNamespace
 from typing import Any
 
-from data_formulator.agents.agent_utils import extract_json_objects, generate_data_summary, extract_code_from_gpt_response
+from data_formulator.agents.agent_utils import extract_json_objects, generate_data_summary, extract_code_from_gpt_response, dedup_data_transform_candidates, CodeBlockStreamParser
 import data_formulator.py_sandbox as py_sandbox
+import data_formulator.sandbox_preflight as sandbox_preflight
+from data_formulator.sandbox_io import sample_table
 
 import traceback
 
@@ -15,6 +22,10 @@ import logging
 # Replace/update the logger configuration
 logger = logging.getLogger(__name__)
 
+# with sample_first, tables at least this long are first run on a sample of SAMPLE_ROWS rows
+SAMPLE_FIRST_MIN_ROWS = 50000
+SAMPLE_ROWS = 1000
+
 SYSTEM_PROMPT = '''You are a data scientist to help user to transform data that will be used for visualization.
 The user will provide you information about what data would be needed, and your job is to create a python function based on the input data summary, transformation instruction and expected fields.
 The users' instruction includes "expected fields" that the user want for visualization, and natural language instructions "goal" that describe what data is needed.
@@ -188,21 +199,139 @@ def transform_data(df):
 def completion_response_wrapper(client, messages, n):
     ### wrapper for completion response, especially handling errors
     try:
-        response = client.get_completion(messages = messages)
+        response = client.get_completion(messages = messages, n = n)
+    except Exception as e:
+        response = e
+
+    return response
+
+async def acompletion_response_wrapper(client, messages, n):
+    try:
+        response = await client.aget_completion(messages = messages, n = n)
     except Exception as e:
         response = e
 
     return response
 
 
+def log_candidates(candidates):
+    logger.info("=== Transform Candidates ===>")
+    for candidate in candidates:
+        for key, value in candidate.items():
+            if key in ['dialog', 'content']:
+                logger.info(f"##{key}:\n{str(value)[:1000]}...")
+            else:
+                logger.info(f"## {key}:\n{value}")
+
+
 class DataTransformationAgentV2(object):
 
-    def __init__(self, client, system_prompt=None):
+    def __init__(self, client, system_prompt=None, output_format="json", stop_at_first_ok=False, stream=False, sample_first=False,
+                 limits=None):
+        """output_format: "json" returns candidate content as json records,
+        "arrow" keeps it as the dataframe produced in the sandbox (see py_sandbox.run_transform_in_sandbox2020)
+        stop_at_first_ok: with several candidate completions, return as soon as one of them executes successfully
+        (deduplicated finished candidates only) instead of waiting for all of them
+        stream: for single-candidate requests, stream the completion and start executing the code as soon as its
+        block is complete, while the model is still writing the rest of the response
+        sample_first: run the code on a small stratified sample of a large table first, and only on the full table
+        once it succeeds there, so that broken code goes back to repair without processing all rows
+        (single-table inputs only, see execute_on_sample)
+        limits: budgets of the sandbox executions (see py_sandbox.DEFAULT_LIMITS), unlimited by default"""
         self.client = client
         self.system_prompt = system_prompt if system_prompt is not None else SYSTEM_PROMPT
+        self.output_format = output_format
+        self.stop_at_first_ok = stop_at_first_ok
+        self.stream = stream
+        self.sample_first = sample_first
+        self.limits = limits
+
+    def execute_on_sample(self, input_tables, code_str, cancel=None):
+        """run the code on samples of the tables with at least SAMPLE_FIRST_MIN_ROWS rows (smaller tables are used
+        whole), None when there is no such table. Code joining or looking up several tables is not sampled either:
+        independent samples rarely share their keys, the code could come back empty or fail on them"""
+        if len(input_tables) > 1 or not any(len(t['rows']) >= SAMPLE_FIRST_MIN_ROWS for t in input_tables):
+            return None
+
+        start = time.perf_counter()
+        sample_list = [sample_table(t['rows'], SAMPLE_ROWS) if len(t['rows']) >= SAMPLE_FIRST_MIN_ROWS else t['rows']
+                       for t in input_tables]
+        result = py_sandbox.run_transform_in_sandbox2020(code_str, sample_list, output_format="json", limits=self.limits, cancel=cancel)
+        result['timings'] = {**result.get('timings', {}), 'sample_run': time.perf_counter() - start}
+        if result['status'] != 'ok':
+            result['content'] = (f"{result['content']}\n(this happened when running the code on a sample of "
+                                 f"{max(len(rows) for rows in sample_list)} rows of the input)")
+        return result
+
+    def execute_code(self, input_tables, code_str, cancel=None):
+        """execute the transformation code in the sandbox, unless the pre-flight checks already find it broken
+        cancel: a threading.Event, setting it stops the sandbox execution (see py_sandbox.run_script_in_sandbox)"""
+        preflight_errors = sandbox_preflight.check_transform_code(code_str, [t['rows'] for t in input_tables])
+        sandbox_preflight.record_check(preflight_errors)
+        if preflight_errors:
+            logger.info(f"pre-flight check rejected the code: {preflight_errors}")
+            error_message = "The code was not executed, it has the following errors:\n" + "\n".join(preflight_errors)
+            return {'status': 'error', 'code': code_str, 'content': error_message, 'preflight_errors': preflight_errors}
+
+        try:
+            sample_result = self.execute_on_sample(input_tables, code_str, cancel) if self.sample_first else None
+            if sample_result is not None and sample_result['status'] != 'ok':
+                logger.info(f"the code failed on a sample, the full tables are not processed: {sample_result['content']}")
+                return {**sample_result, 'code': code_str, 'sample_failed': True}
+
+            # 在沙盒里执行代码，获取结果
+            result = py_sandbox.run_transform_in_sandbox2020(code_str, [t['rows'] for t in input_tables], output_format=self.output_format,
+                                                         limits=self.limits, cancel=cancel)
+            result['code'] = code_str
+            if sample_result is not None:
+                result['timings'] = {**result.get('timings', {}), 'sample_run': sample_result['timings']['sample_run']}
+
+            if result['status'] == 'ok':
+                # parse the content
+                if self.output_format == "json":
+                    result['content'] = json.loads(result['content'])
+            else:
+                logger.info(result['content'])
+        except Exception as e:
+            logger.warning('Error occurred during code execution:')
+            error_message = f"An error occurred during code execution. Error type: {type(e).__name__}"
+            logger.warning(error_message)
+            result = {'status': 'error', 'code': code_str, 'content': error_message}
+        return result
+
+    def process_choice(self, input_tables, messages, choice, speculative_runs={}, cancel=None):
+        """extract the refined goal and code from one completion choice, and execute the code in the sandbox
+        speculative_runs: futures of executions already started (keyed by code) while the choice was streamed
+        cancel: see execute_code"""
+        logger.info("=== Data transformation result ===>")
+        logger.info(choice.message.content + "\n")
+        
+        json_blocks = extract_json_objects(choice.message.content + "\n")
+        if len(json_blocks) > 0:
+            refined_goal = json_blocks[0]
+        else:
+            refined_goal = {'visualization_fields': [], 'instruction': '', 'reason': ''}
+
+        code_blocks = extract_code_from_gpt_response(choice.message.content + "\n", "python")
+
+        if len(code_blocks) > 0:
+            code_str = code_blocks[-1]
+
+            if code_str in speculative_runs:
+                result = speculative_runs[code_str].result()
+            else:
+                result = self.execute_code(input_tables, code_str, cancel)
+        else:
+            result: dict[str, Any] = {'status': 'error', 'code': "", 'content': "No code block found in the response. The model is unable to generate code to complete the task."}
+        
+        result['dialog'] = [*messages, {"role": choice.message.role, "content": choice.message.content}]
+        result['agent'] = 'DataTransformationAgent'
+        result['refined_goal'] = refined_goal
+        return result
 
     def process_gpt_response(self, input_tables, messages, response):
-        """process gpt response to handle execution"""
+        """process gpt response to handle execution, candidate choices are executed concurrently
+        (each on its own sandbox worker) and returned in choice order"""
 
         #log = {'messages': messages, 'response': response.model_dump(mode='json')}
         #logger.info("=== prompt_filter_results ===>")
@@ -211,60 +340,112 @@ class DataTransformationAgentV2(object):
         if isinstance(response, Exception):
             result = {'status': 'other error', 'content': str(response)}
             return [result]
-        
-        candidates = []
-        for choice in response.choices:
-            logger.info("=== Data transformation result ===>")
-            logger.info(choice.message.content + "\n")
-            
-            json_blocks = extract_json_objects(choice.message.content + "\n")
-            if len(json_blocks) > 0:
-                refined_goal = json_blocks[0]
-            else:
-                refined_goal = {'visualization_fields': [], 'instruction': '', 'reason': ''}
-
-            code_blocks = extract_code_from_gpt_response(choice.message.content + "\n", "python")
 
-            if len(code_blocks) > 0:
-                code_str = code_blocks[-1]
-
-                try:
-                    # 在沙盒里执行代码，获取结果
-                    result = py_sandbox.run_transform_in_sandbox2020(code_str, [t['rows'] for t in input_tables])
-                    result['code'] = code_str
-
-                    if result['status'] == 'ok':
-                        # parse the content
-                        result['content'] = json.loads(result['content'])
-                    else:
-                        logger.info(result['content'])
-                except Exception as e:
-                    logger.warning('Error occurred during code execution:')
-                    error_message = f"An error occurred during code execution. Error type: {type(e).__name__}"
-                    logger.warning(error_message)
-                    result = {'status': 'error', 'code': code_str, 'content': error_message}
+        if len(response.choices) == 0:
+            candidates = []
+        elif len(response.choices) == 1:
+            candidates = [self.process_choice(input_tables, messages, response.choices[0])]
+        else:
+            executor = ThreadPoolExecutor(max_workers=len(response.choices))
+            cancel = threading.Event()
+            futures = [executor.submit(self.process_choice, input_tables, messages, choice, cancel=cancel)
+                       for choice in response.choices]
+            if self.stop_at_first_ok:
+                for future in as_completed(futures):
+                    if future.result()['status'] == 'ok':
+                        break
+                # candidates still running are stopped (their sandbox workers are killed), their results are dropped
+                cancel.set()
+                executor.shutdown(wait=False, cancel_futures=True)
+                finished = [f.result() for f in futures if f.done() and not f.cancelled() and f.result()['status'] != 'cancelled']
+                ok_candidates = dedup_data_transform_candidates(finished)
+                candidates = ok_candidates if len(ok_candidates) > 0 else finished
             else:
-                result: dict[str, Any] = {'status': 'error', 'code': "", 'content': "No code block found in the response. The model is unable to generate code to complete the task."}
-            
-            result['dialog'] = [*messages, {"role": choice.message.role, "content": choice.message.content}]
-            result['agent'] = 'DataTransformationAgent'
-            result['refined_goal'] = refined_goal
-            candidates.append(result)
-
-        logger.info("=== Transform Candidates ===>")
-        for candidate in candidates:
-            for key, value in candidate.items():
-                if key in ['dialog', 'content']:
-                    logger.info(f"##{key}:\n{str(value)[:1000]}...")
-                else:
-                    logger.info(f"## {key}:\n{value}")
+                candidates = [f.result() for f in futures]
+                executor.shutdown()
 
+        log_candidates(candidates)
         return candidates
 
+    def process_streamed_response(self, input_tables, messages):
+        """stream a single completion, executing each python block in the background as soon as it is closed
+        (the refined goal and any trailing text are still being generated), then process the complete choice"""
+        parser = CodeBlockStreamParser("python")
+        executor = ThreadPoolExecutor(max_workers=4)
+        cancel = threading.Event()
+        speculative_runs = {}
+
+        def start_runs(code_blocks):
+            for code_str in code_blocks:
+                if code_str not in speculative_runs:
+                    speculative_runs[code_str] = executor.submit(self.execute_code, input_tables, code_str, cancel)
+
+        try:
+            for delta in self.client.stream_completion(messages):
+                start_runs(parser.feed(delta))
+            start_runs(parser.close())
+        except Exception as e:
+            cancel.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+            return [{'status': 'other error', 'content': str(e)}]
+
+        choice = SimpleNamespace(message=SimpleNamespace(role="assistant", content=parser.text))
+        try:
+            candidates = [self.process_choice(input_tables, messages, choice, speculative_runs)]
+        finally:
+            # superseded blocks (the response is judged on its last one) are stopped, not waited for
+            cancel.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        log_candidates(candidates)
+        return candidates
+
+    def complete_and_process(self, input_tables, messages, n):
+        if self.stream and n == 1:
+            return self.process_streamed_response(input_tables, messages)
+
+        response = completion_response_wrapper(self.client, messages, n)
+        return self.process_gpt_response(input_tables, messages, response)
+
 
     # description 是用户输入的要求，expected_fields 是用户指定的字段， prev_messages 为空
     def run(self, input_tables, description, expected_fields: list[str], prev_messages: list[dict] = [], n=1):
+        messages = self.run_messages(input_tables, description, expected_fields, prev_messages)
+        
+        # 要求ai 根据样例数据和用户的要求，生成一个python函数来实现数据转换
+        return self.complete_and_process(input_tables, messages, n)
+
+    def followup(self, input_tables, dialog, output_fields: list[str], new_instruction: str, n=1):
+        """extend the input data (in json records format) to include new fields"""
+        messages = self.followup_messages(dialog, output_fields, new_instruction)
+
+        return self.complete_and_process(input_tables, messages, n)
+
+    async def arun(self, input_tables, description, expected_fields: list[str], prev_messages: list[dict] = [], n=1, on_code=None):
+        """async version of run, see aprocess_gpt_response for on_code"""
+        # profiling the tables for the prompt can take a while on large inputs, keep it off the event loop
+        messages = await asyncio.to_thread(self.run_messages, input_tables, description, expected_fields, prev_messages)
+        response = await acompletion_response_wrapper(self.client, messages, n)
+        return await self.aprocess_gpt_response(input_tables, messages, response, on_code)
+
+    async def afollowup(self, input_tables, dialog, output_fields: list[str], new_instruction: str, n=1, on_code=None):
+        """async version of followup, see aprocess_gpt_response for on_code"""
+        messages = self.followup_messages(dialog, output_fields, new_instruction)
+        response = await acompletion_response_wrapper(self.client, messages, n)
+        return await self.aprocess_gpt_response(input_tables, messages, response, on_code)
+
+    async def aprocess_gpt_response(self, input_tables, messages, response, on_code=None):
+        """execute the candidates in a worker thread, so that the event loop keeps serving other calls.
+        on_code(code) is called with the code of the first candidate before it starts executing,
+        e.g. to start explaining the code while the sandbox is still producing the content"""
+        if on_code is not None and not isinstance(response, Exception) and len(response.choices) > 0:
+            code_blocks = extract_code_from_gpt_response(response.choices[0].message.content + "\n", "python")
+            if len(code_blocks) > 0:
+                on_code(code_blocks[-1])
 
+        return await asyncio.to_thread(self.process_gpt_response, input_tables, messages, response)
+
+    def run_messages(self, input_tables, description, expected_fields, prev_messages):
         if len(prev_messages) > 0:
             logger.info("=== Previous messages ===>")
             formatted_prev_messages = ""
@@ -288,16 +469,9 @@ class DataTransformationAgentV2(object):
         messages = [{"role":"system", "content": self.system_prompt},
                     *prev_messages,
                     {"role":"user","content": user_query}]
-        
-        # 要求ai 根据样例数据和用户的要求，生成一个python函数来实现数据转换
-        response = completion_response_wrapper(self.client, messages, n)
-
-        return self.process_gpt_response(input_tables, messages, response)
-        
-
-    def followup(self, input_tables, dialog, output_fields: list[str], new_instruction: str, n=1):
-        """extend the input data (in json records format) to include new fields"""
+        return messages
 
+    def followup_messages(self, dialog, output_fields, new_instruction):
         goal = {
             "followup_instruction": new_instruction,
             "visualization_fields": output_fields
@@ -311,7 +485,4 @@ class DataTransformationAgentV2(object):
 
         messages = [*updated_dialog, {"role":"user", 
                               "content": f"Update the code above based on the following instruction:\n\n{json.dumps(goal, indent=4)}"}]
-
-        response = completion_response_wrapper(self.client, messages, n)
-
-        return self.process_gpt_response(input_tables, messages, response)
+        return messages
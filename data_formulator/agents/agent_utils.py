@@ -7,11 +7,16 @@ import pandas as pd
 import numpy as np
 
 import base64
+import collections
+import hashlib
+import threading
 
 from pprint import pprint
 
 import re
 
+from data_formulator.sandbox_io import table_fingerprint, table_store
+
 def string_to_py_varname(var_str): 
     var_name = re.sub('\W|^(?=\d)','_', var_str)
     if keyword.iskeyword(var_name):
@@ -58,13 +63,126 @@ def value_handling_func(val):
 
     return val
 
+def round_hash_numbers(col):
+    """floats rounded to 5 digits like value_handling_func, -0.0 becomes 0.0 (python hashes them alike)"""
+    return col.round(5) + 0.0
+
+def split_hash_numbers(col):
+    """numbers as a pair of columns like value_handling_func sees them: integers, and floats that are integral once
+    rounded to 5 digits, go into the first as exact int64 (3 and 3.0 agree, as their python hashes do, and integers
+    beyond 2**53 stay distinct), the other rounded floats into the second"""
+    if pd.api.types.is_integer_dtype(col.dtype) and col.notna().all() and (col.dtype != 'uint64' or col.max() < 2**63):
+        return [col.astype('int64'), pd.Series(0.0, index=col.index)]
+    values = round_hash_numbers(col.astype('float64'))
+    integral = (values % 1 == 0) & (values.abs() < 2**63)
+    return [values.where(integral, 0).astype('int64'), values.where(~integral, 0.0)]
+
+def normalize_hash_column(col):
+    """vectorized counterpart of value_handling_func for a whole column, as a list of columns: numbers (and numeric
+    strings) are split by split_hash_numbers, datetimes become epoch milliseconds (as in json records), other
+    values strings"""
+    if pd.api.types.is_datetime64_any_dtype(col):
+        col = col.dt.tz_localize(None) if getattr(col.dt, 'tz', None) is not None else col
+        return split_hash_numbers((col.astype('int64') // 10**6).astype('float64').where(col.notna()))
+    if pd.api.types.is_bool_dtype(col) or pd.api.types.is_numeric_dtype(col):
+        return split_hash_numbers(col)
+
+    numeric = pd.to_numeric(col, errors='coerce')
+    non_null = col.notna()
+    if numeric.notna().sum() == non_null.sum():
+        return split_hash_numbers(numeric)
+    if numeric.notna().sum() == 0:
+        return [col.astype(str).where(non_null, None)]
+    # mixed numbers and text: numbers and numeric strings are written like split_hash_numbers reads them, integral
+    # ones as integers and the others as their rounded float, so that 3, 3.0 and "3" agree (as their hashes do after
+    # value_handling_func), other values as strings
+    numbers = round_hash_numbers(numeric)
+    integral = (numbers % 1 == 0) & (numbers.abs() < 2**63)
+    text = numbers.astype(str).where(~integral, numbers.where(integral, 0).astype('int64').astype(str))
+    # python integers are written exactly, their float would not be beyond 2**53
+    exact = col.map(lambda v: isinstance(v, (int, np.integer)))
+    text = text.where(~exact, col[exact].map(lambda v: str(int(v))))
+    return [text.where(numeric.notna() | exact, col.astype(str)).where(non_null, None)]
+
 def table_hash(table):
-    """hash a table, mostly for the purpose of comparison"""
-    if len(table) == 0:
-        return hash(table)
-    schema = sorted(list(table[0].keys()))
-    frozen_table = tuple(sorted([tuple([hash(value_handling_func(r[key])) for key in schema]) for r in table]))
-    return hash(frozen_table)
+    """hash a table, mostly for the purpose of comparison: insensitive to row and column order, 
+    table can be json records, a dataframe or a pyarrow table"""
+    if not isinstance(table, pd.DataFrame):
+        table = table.to_pandas() if hasattr(table, 'to_pandas') else pd.DataFrame.from_records(table)
+
+    columns = sorted(table.columns, key=str)
+    digest = hashlib.blake2b(repr([str(c) for c in columns]).encode(), digest_size=8)
+    if len(table) > 0:
+        parts = [part for c in columns for part in normalize_hash_column(table[c])]
+        normalized = pd.DataFrame(dict(enumerate(parts)))
+        row_hashes = pd.util.hash_pandas_object(normalized, index=False).to_numpy()
+        # sorting the row hashes makes the combination independent of row order
+        digest.update(np.sort(row_hashes).tobytes())
+    return int.from_bytes(digest.digest(), 'little', signed=True)
+
+
+def mask_missing(values, missing):
+    """values (a list) with None at the positions where missing is true"""
+    for i in np.flatnonzero(missing):
+        values[i] = None
+    return values
+
+def epoch_milliseconds(nanoseconds):
+    """int64 nanoseconds to milliseconds, truncated toward zero like to_json"""
+    milliseconds = nanoseconds // 10**6
+    return milliseconds + ((nanoseconds % 10**6 != 0) & (nanoseconds < 0))
+
+def json_doubles(values):
+    """float64 values as they read back from df.to_json: its encoder writes 10 digits after the point, rounding
+    half to odd (and up from 0), and %.10g beyond 1e16 and below 1e-15. Non-finite values stay NaN"""
+    out = np.full(values.shape, np.nan)
+    magnitude = np.abs(values)
+    regular = (magnitude <= 1e16 - 1) & ((magnitude >= 1e-15) | (magnitude == 0))
+
+    whole = np.floor(magnitude[regular])
+    scaled = (magnitude[regular] - whole) * 1e10
+    frac = np.floor(scaled)
+    diff = scaled - frac
+    frac += (diff > 0.5) | ((diff == 0.5) & ((frac == 0) | (frac % 2 == 1)))
+    rollover = frac >= 1e10
+    whole[rollover] += 1
+    frac[rollover] = 0
+    # whole * 1e10 + frac is an exact integer below 2**53, one division then rounds like parsing "whole.frac"
+    exact = whole < 2**53 / 1e10
+    out[regular] = np.copysign(np.where(exact, (whole * 1e10 + frac) / 1e10, whole + frac / 1e10), values[regular])
+
+    irregular = np.flatnonzero(~regular & np.isfinite(values))
+    out[irregular] = [float(f"{v:.10g}") for v in values[irregular]]
+    return out
+
+def column_to_json_values(col):
+    """the values of a column as python objects, as they read back from df.to_json(orient="records"):
+    NaN / NaT / inf become None, datetimes and timedeltas epoch milliseconds, numpy scalars python values"""
+    dtype = col.dtype
+    if pd.api.types.is_datetime64_any_dtype(dtype) or pd.api.types.is_timedelta64_dtype(dtype):
+        if isinstance(dtype, pd.DatetimeTZDtype):
+            col = col.dt.tz_convert(None)
+        values = col.to_numpy()
+        nanoseconds = values.astype(f"{values.dtype.kind}8[ns]").view('int64')
+        return mask_missing(epoch_milliseconds(nanoseconds).tolist(), col.isna().to_numpy())
+    if isinstance(dtype, np.dtype) and dtype.kind in 'iub':
+        return col.to_numpy().tolist()
+    if isinstance(dtype, np.dtype) and dtype.kind == 'f':
+        values = col.to_numpy().astype('float64')
+        return mask_missing(json_doubles(values).tolist(), ~np.isfinite(values))
+    if dtype == object and pd.api.types.infer_dtype(col, skipna=True) in ('string', 'empty'):
+        return mask_missing(col.tolist(), col.isna().to_numpy())
+    # extension dtypes, categoricals, mixed objects: pandas' encoder handles this column alone
+    return [row[0] for row in json.loads(col.to_frame().to_json(orient="values"))]
+
+def dataframe_to_records(df):
+    """convert a dataframe to json records, with the same value semantics as df.to_json(orient="records"),
+    column by column, without serializing the whole table to a json string first"""
+    if not df.columns.is_unique:
+        raise ValueError("DataFrame columns must be unique for orient='records'.")
+    columns = [str(c) for c in df.columns]
+    values = [column_to_json_values(df.iloc[:, i]) for i in range(df.shape[1])]
+    return [dict(zip(columns, row)) for row in zip(*values)]
 
 
 def extract_code_from_gpt_response(code_raw, language):
@@ -90,6 +208,33 @@ def extract_code_from_gpt_response(code_raw, language):
     return results
 
 
+class CodeBlockStreamParser(object):
+    """incrementally extracts ```{language} code blocks from a streamed response, a block is reported as soon as
+    the line holding its closing fence is complete (the same blocks extract_code_from_gpt_response finds at the end)"""
+
+    def __init__(self, language):
+        self.language = language
+        self.text = ""
+        self.blocks = []
+
+    def feed(self, delta):
+        """add a delta of the response, returns the code blocks completed by it"""
+        self.text += delta
+        # fences are only judged on complete lines, so that a "```" being streamed is not taken for a closing one
+        complete_lines = self.text[:self.text.rfind("\n") + 1]
+        return self._update(complete_lines)
+
+    def close(self):
+        """the response is complete, returns the code blocks not reported yet"""
+        return self._update(self.text + "\n")
+
+    def _update(self, text):
+        blocks = extract_code_from_gpt_response(text, self.language)
+        new_blocks = blocks[len(self.blocks):]
+        self.blocks.extend(new_blocks)
+        return new_blocks
+
+
 def find_matching_bracket(text, start_index, bracket_type='curly'):  
     """Find the index of the matching closing bracket for JSON objects or arrays."""  
     if bracket_type == 'curly':  
@@ -153,71 +298,162 @@ def extract_json_objects(text):
     return json_objects  
 
 
-def insert_candidates(code, table, dialog, candidate_groups):
+def insert_candidates(candidate, candidate_groups):
     """ Try to insert a candidate into existing candidate groups
     Args:
-        code: code candidate
-        table: json records table
+        candidate: candidate result, its content is a json records table or a dataframe
         candidate_groups: current candidate group
     Returns:
         a boolean flag incidate whether new_group_created
     """
-    table_headers = sorted(table[0].keys())
-    t_hash = table_hash([{c: r[c] for c in table_headers} for r in table])
+    t_hash = table_hash(candidate['content'])
     if t_hash in candidate_groups:
-        candidate_groups[t_hash].append({"code": code, "content": table, "dialog": dialog})
+        candidate_groups[t_hash].append(candidate)
         new_group_created = False
     else:
-        candidate_groups[t_hash] = [{"code": code, "content": table, "dialog": dialog}]
+        candidate_groups[t_hash] = [candidate]
         new_group_created = True
     return new_group_created
 
 def dedup_data_transform_candidates(candidates):
-    """each candidate is a tuple of {status: ..., code: ..., data: ..., dialog: ...},
-    this function extracts candidates that are 'ok', and removes uncessary duplicates"""
+    """each candidate is a dict of {status: ..., code: ..., content: ..., dialog: ...},
+    this function extracts candidates that are 'ok', and removes uncessary duplicates (candidates producing the same table)"""
     candidate_groups = {}
     for candidate in candidates:
-        insert_candidates(candidate["code"], candidate['data'], candidate['dialog'], candidate_groups)
+        if candidate.get('status') == 'ok':
+            insert_candidates(candidate, candidate_groups)
     return [items[0] for _, items in candidate_groups.items()]
 
 
-def get_field_summary(field_name, df, field_sample_size):
-    try:
-        values = sorted([x for x in list(set(df[field_name].values)) if x != None])
-    except:
-        values = [x for x in list(set(df[field_name].values)) if x != None]
-
-    val_sample = ""
+# columns at least this long get an approximate distinct count before any exact uniqueness work
+APPROX_DISTINCT_MIN_ROWS = 100000
+
+def approx_distinct_count(values, precision=12):
+    """HyperLogLog estimate of the number of distinct values (standard error ~1.04 / sqrt(2 ** precision))"""
+    num_registers = 1 << precision
+    hashes = pd.util.hash_array(np.asarray(values), categorize=False)
+    buckets = (hashes >> np.uint64(64 - precision)).astype(np.int64)
+    rest = hashes << np.uint64(precision)
+    # rank = position of the leftmost 1 bit among the remaining 64 - precision bits
+    with np.errstate(divide="ignore"):
+        top_bit = np.floor(np.log2(rest.astype(np.float64)))
+    ranks = np.where(rest == 0, 64 - precision + 1, 64 - top_bit).astype(np.uint8)
+    registers = np.zeros(num_registers, dtype=np.uint8)
+    bucket_max = pd.Series(ranks).groupby(buckets).max()
+    registers[bucket_max.index.to_numpy()] = bucket_max.to_numpy()
+
+    alpha = 0.7213 / (1 + 1.079 / num_registers)
+    estimate = alpha * num_registers ** 2 / np.sum(np.power(2.0, -registers.astype(np.float64)))
+    empty_registers = int(np.count_nonzero(registers == 0))
+    if estimate <= 2.5 * num_registers and empty_registers > 0:
+        estimate = num_registers * np.log(num_registers / empty_registers)
+    return int(round(estimate))
+
+def orderable_field_values(col):
+    """non-null values of col as a numpy array that sorts the same way python's sorted() does on them,
+    or None when the column needs the generic path (mixed types, NaN, nested values, ...)"""
+    if not isinstance(col.dtype, np.dtype):
+        return None
+    if col.dtype.kind in "biu":
+        return col.to_numpy()
+    if col.dtype.kind == "f":
+        # NaN never compares equal, so the generic path keeps every one of them; stay with it there
+        return None if col.isna().any() else col.to_numpy()
+    if col.dtype == object:
+        values = col.to_numpy()
+        is_none = np.equal(values, None)
+        if int(col.isna().sum()) != int(is_none.sum()):
+            return None
+        values = values[~is_none]
+        return values if pd.api.types.infer_dtype(values, skipna=False) == "string" else None
+    return None
+
+def distinct_extremes(values, head_size, tail_size):
+    """the head_size smallest and tail_size largest distinct values (each ascending), selected with one partial
+    sort instead of sorting all values"""
+    num_candidates = max(head_size, tail_size) * 4
+    while 2 * num_candidates < len(values):
+        partitioned = np.partition(values, [num_candidates - 1, len(values) - num_candidates])
+        head = np.unique(partitioned[:num_candidates])
+        tail = np.unique(partitioned[-num_candidates:])
+        if len(head) >= head_size and len(tail) >= tail_size:
+            return head[:head_size], tail[len(tail) - tail_size:]
+        num_candidates *= 4
+    values = np.unique(values)
+    return values[:head_size], values[len(values) - tail_size:]
+
+def sample_orderable_values(values, sample_size):
+    """sorted distinct values, or their sample_size / 2 smallest and largest around "..." when there are more"""
+    if len(values) < APPROX_DISTINCT_MIN_ROWS or approx_distinct_count(values) <= 4 * sample_size:
+        distinct = pd.unique(values)
+        if len(distinct) <= sample_size:
+            return list(np.sort(distinct))
+        values = distinct
+
+    # fixed-width unicode keeps the partial sort in C; it orders by code point, like python's str comparison
+    head, tail = distinct_extremes(values.astype(str) if values.dtype == object else values,
+                                   int(sample_size / 2), sample_size - int(sample_size / 2))
+    return list(head) + ["..."] + list(tail)
 
+def get_field_summary(field_name, df, field_sample_size):
     sample_size = field_sample_size
 
-    if len(values) <= sample_size:
-        val_sample = values
+    values = orderable_field_values(df[field_name]) if sample_size > 0 else None
+    if values is not None:
+        val_sample = sample_orderable_values(values, sample_size)
     else:
-        val_sample = values[:int(sample_size / 2)] + ["..."] + values[-(sample_size - int(sample_size / 2)):]
+        try:
+            values = sorted([x for x in list(set(df[field_name].values)) if x != None])
+        except:
+            values = [x for x in list(set(df[field_name].values)) if x != None]
+
+        if len(values) <= sample_size:
+            val_sample = values
+        else:
+            val_sample = values[:int(sample_size / 2)] + ["..."] + values[-(sample_size - int(sample_size / 2)):]
 
     val_str = ', '.join([str(s) if ',' not in str(s) else f'"{str(s)}"' for s in val_sample])
 
     return f"{field_name} -- type: {df[field_name].dtype}, values: {val_str}"
 
+# profiles of recently summarized tables, keyed by (table fingerprint, include_data_samples, field_sample_size),
+# shared by all agents of the process so that repairs and explanations do not profile the same table again
+SUMMARY_CACHE_SIZE = 64
+_summary_cache = collections.OrderedDict()
+_summary_cache_lock = threading.Lock()
+
+def summarize_table(rows, include_data_samples, field_sample_size):
+    """field summaries and (optionally) the csv sample of one table, memoized by table content"""
+    # a table new to the store is fingerprinted with the frame the summary is computed from
+    df = pd.DataFrame(rows) if rows not in table_store else None
+    key = (table_fingerprint(rows, df), include_data_samples, field_sample_size)
+    with _summary_cache_lock:
+        if key in _summary_cache:
+            _summary_cache.move_to_end(key)
+            return _summary_cache[key]
+
+    df = pd.DataFrame(rows) if df is None else df
+    field_summary = '\n\t'.join([get_field_summary(fname, df, field_sample_size)  for fname in list(df.columns.values)])
+    sample_csv = pd.DataFrame(rows[:5]).to_csv(sep="|") if include_data_samples else None
+
+    with _summary_cache_lock:
+        _summary_cache[key] = (field_summary, sample_csv)
+        while len(_summary_cache) > SUMMARY_CACHE_SIZE:
+            _summary_cache.popitem(last=False)
+    return field_summary, sample_csv
+
 def generate_data_summary(input_tables, include_data_samples=True, field_sample_size=7):
     
     input_table_names = [f'{string_to_py_varname(var_str=t["name"])}' for t in input_tables]
 
-    data_samples = [t['rows'][:5] for t in input_tables]
-
-    field_summaries = []
-    for input_data in input_tables:
-        df = pd.DataFrame(input_data['rows'])
-        s = '\n\t'.join([get_field_summary(fname, df, field_sample_size)  for fname in list(df.columns.values)])
-        field_summaries.append(s)
+    table_profiles = [summarize_table(t['rows'], include_data_samples, field_sample_size) for t in input_tables]
 
-    table_field_summaries = [f'table_{i} ({input_table_names[i]}) fields:\n\t{s}' for i, s in enumerate(field_summaries)]
+    table_field_summaries = [f'table_{i} ({input_table_names[i]}) fields:\n\t{s}' for i, (s, _) in enumerate(table_profiles)]
     
     if include_data_samples:
-        table_sample_strings = [f'table_{i} ({input_table_names[i]}) sample:\n\n```\n{pd.DataFrame(data_sample).to_csv(sep="|")}......\n```' for i, data_sample in enumerate(data_samples)]
+        table_sample_strings = [f'table_{i} ({input_table_names[i]}) sample:\n\n```\n{sample_csv}......\n```' for i, (_, sample_csv) in enumerate(table_profiles)]
     else:
-        table_sample_strings = ['' for i, data_sample in enumerate(data_samples)]
+        table_sample_strings = ['' for i, _ in enumerate(table_profiles)]
 
     table_summary = "\n\n".join([f'{field_summary}\n\n{sample_str}' for field_summary, sample_str in zip(table_field_summaries, table_sample_strings)])
 
@@ -1,8 +1,102 @@
+import asyncio
+import atexit
+import logging
 import os
+import re
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any
+import httpx
 import litellm
 import openai
 
+from data_formulator.agents import llm_cache
+
+logger = logging.getLogger(__name__)
+
+# connection pool settings of the shared http clients, see configure_http_clients
+HTTP_CLIENT_LIMITS = {
+    "max_connections": 100,
+    "max_keepalive_connections": 20,
+    "keepalive_expiry": 60.0,
+}
+HTTP_TIMEOUT = 120
+
+# long-lived clients keyed by (endpoint, api_base, api_key), shared by all Client objects and threads of the process
+_http_clients: dict[tuple, Any] = {}
+_http_clients_lock = threading.Lock()
+
+def configure_http_clients(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60.0):
+    """set the connection pool limits of the shared http clients, clients created before are closed
+    and recreated with the new limits on their next use"""
+    HTTP_CLIENT_LIMITS.update(max_connections=max_connections,
+                              max_keepalive_connections=max_keepalive_connections,
+                              keepalive_expiry=keepalive_expiry)
+    close_http_clients()
+
+def new_http_client():
+    return httpx.Client(limits=httpx.Limits(**HTTP_CLIENT_LIMITS), timeout=HTTP_TIMEOUT)
+
+def get_http_client(endpoint, api_base=None, api_key=None):
+    """the shared client of an endpoint: an openai.OpenAI client for "openai", for the endpoints served by
+    LiteLLM a pooled httpx client that LiteLLM uses as its client session"""
+    key = (endpoint, api_base, api_key)
+    with _http_clients_lock:
+        if key not in _http_clients:
+            if endpoint == "openai":
+                _http_clients[key] = openai.OpenAI(api_key=api_key, base_url=api_base, timeout=HTTP_TIMEOUT,
+                                                   http_client=new_http_client())
+            else:
+                _http_clients[key] = new_http_client()
+        return _http_clients[key]
+
+# async clients are bound to the event loop they were created in, so they are shared per loop
+_async_http_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict[tuple, Any]]" = weakref.WeakKeyDictionary()
+
+def get_async_http_client(endpoint, api_base=None, api_key=None):
+    """the shared openai.AsyncOpenAI client of an endpoint for the running event loop"""
+    key = (endpoint, api_base, api_key)
+    with _http_clients_lock:
+        loop_clients = _async_http_clients.setdefault(asyncio.get_running_loop(), {})
+        if key not in loop_clients:
+            http_client = httpx.AsyncClient(limits=httpx.Limits(**HTTP_CLIENT_LIMITS), timeout=HTTP_TIMEOUT)
+            loop_clients[key] = openai.AsyncOpenAI(api_key=api_key, base_url=api_base, timeout=HTTP_TIMEOUT,
+                                                   http_client=http_client)
+        return loop_clients[key]
+
+# whether (endpoint, api_base, model) returned n choices for a request with n > 1, unknown until tried
+_n_support: dict[tuple, bool] = {}
+
+def rejects_n(error):
+    """whether error is a provider rejecting the n parameter: a 400 / 422 response saying n is not supported
+    (rate limits, timeouts, server errors and other bad requests say nothing about n)"""
+    if getattr(error, 'status_code', None) not in (400, 422):
+        return False
+    message = str(error).lower()
+    return (re.search(r"\bn\b", message) is not None
+            and any(word in message for word in ("unsupported", "not supported", "does not support", "not allowed",
+                                                  "unrecognized", "unknown", "invalid", "only supports", "must be")))
+
+def merge_choices(responses):
+    """one response holding the choices of all responses, re-indexed"""
+    response = responses[0]
+    choices = [choice for r in responses for choice in r.choices]
+    for i, choice in enumerate(choices):
+        choice.index = i
+    response.choices = choices
+    return response
+
+@atexit.register
+def close_http_clients():
+    with _http_clients_lock:
+        clients = list(_http_clients.values())
+        _http_clients.clear()
+        if litellm.client_session in clients:
+            litellm.client_session = None
+    for client in clients:
+        client.close()
+
 class Client(object):
     """
     Returns a LiteLLM client configured for the specified endpoint and model.
@@ -39,7 +133,88 @@ class Client(object):
             else:
                 self.model = f"anthropic/{model}"
 
-    def get_completion(self, messages):
+    def get_completion(self, messages, n=1):
+        """
+        Returns the completion of messages with n choices, from the response cache when one is configured (see llm_cache).
+        """
+        cache = llm_cache.response_cache
+        if cache is None:
+            return self.request_completion(messages, n)
+
+        key = self.cache_key(messages, n)
+        response = cache.get(key)
+        if response is None:
+            response = self.request_completion(messages, n)
+            cache.put(key, response)
+        return response
+
+    async def aget_completion(self, messages, n=1):
+        """
+        Async version of get_completion, for agents running on an event loop.
+        """
+        cache = llm_cache.response_cache
+        if cache is None:
+            return await self.arequest_completion(messages, n)
+
+        key = self.cache_key(messages, n)
+        response = cache.get(key)
+        if response is None:
+            response = await self.arequest_completion(messages, n)
+            cache.put(key, response)
+        return response
+
+    def request_completion(self, messages, n=1):
+        """
+        Asks for n choices in one request. Providers that do not support n (the request is rejected because of n,
+        see rejects_n, or they return fewer choices) get the missing choices from parallel single-choice requests,
+        and only those from then on. Any other error is raised.
+        """
+        response = None
+        if n == 1 or _n_support.get(self.provider_key()) is not False:
+            try:
+                response = self.request_choices(messages, n)
+            except Exception as e:
+                if n == 1 or _n_support.get(self.provider_key()) or not rejects_n(e):
+                    raise
+                logger.warning(f"request with n={n} rejected ({type(e).__name__}), falling back to parallel requests")
+
+        if response is not None and len(response.choices) >= n:
+            if n > 1:
+                _n_support[self.provider_key()] = True
+            return response
+
+        _n_support[self.provider_key()] = False
+        responses = [] if response is None else [response]
+        missing = n - sum(len(r.choices) for r in responses)
+        with ThreadPoolExecutor(max_workers=missing) as executor:
+            responses += list(executor.map(lambda _: self.request_choices(messages, 1), range(missing)))
+        return merge_choices(responses)
+
+    async def arequest_completion(self, messages, n=1):
+        """
+        Async version of request_completion.
+        """
+        response = None
+        if n == 1 or _n_support.get(self.provider_key()) is not False:
+            try:
+                response = await self.arequest_choices(messages, n)
+            except Exception as e:
+                if n == 1 or _n_support.get(self.provider_key()) or not rejects_n(e):
+                    raise
+                logger.warning(f"request with n={n} rejected ({type(e).__name__}), falling back to parallel requests")
+
+        if response is not None and len(response.choices) >= n:
+            if n > 1:
+                _n_support[self.provider_key()] = True
+            return response
+
+        _n_support[self.provider_key()] = False
+        responses = [] if response is None else [response]
+        missing = n - sum(len(r.choices) for r in responses)
+        responses += await asyncio.gather(*[self.arequest_choices(messages, 1) for _ in range(missing)])
+        return merge_choices(responses)
+
+    def request_choices(self, messages, n):
         """
         Returns a LiteLLM client configured for the specified endpoint and model.
         Supports OpenAI, Azure, Ollama, and other providers via LiteLLM.
@@ -47,26 +222,94 @@ class Client(object):
         # Configure LiteLLM 
 
         if self.endpoint == "openai":
-            client = openai.OpenAI(
-                api_key=self.params["api_key"], 
-                base_url=self.params["api_base"] if "api_base" in self.params else None,
-                timeout=120
+            client = self.openai_client()
+            return client.chat.completions.create(**self.openai_completion_params(messages, n))
+        else:
+            self.use_litellm_session()
+            return litellm.completion(
+                model=self.model,
+                messages=messages,
+                drop_params=True,
+                **self.litellm_params(n)
             )
 
-            completion_params = {
-                "model": self.model,
-                "messages": messages,
-            }
-            
-            if not (self.model == "o3-mini" or self.model == "o1"):
-                completion_params["temperature"] = self.params["temperature"]
-                completion_params["max_tokens"] = self.params["max_completion_tokens"]
-                
-            return client.chat.completions.create(**completion_params)
+    async def arequest_choices(self, messages, n):
+        if self.endpoint == "openai":
+            client = get_async_http_client(self.endpoint, self.params.get("api_base"), self.params["api_key"])
+            return await client.chat.completions.create(**self.openai_completion_params(messages, n))
         else:
-            return litellm.completion(
+            return await litellm.acompletion(
                 model=self.model,
                 messages=messages,
                 drop_params=True,
+                **self.litellm_params(n)
+            )
+
+    def stream_completion(self, messages):
+        """
+        Streams a single-choice completion, yielding the text deltas as they arrive.
+        A cached response is yielded as a single delta, a streamed one is cached once complete.
+        """
+        cache = llm_cache.response_cache
+        if cache is not None:
+            key = self.cache_key(messages)
+            response = cache.get(key)
+            if response is not None:
+                yield response.choices[0].message.content
+                return
+
+        deltas = []
+        for delta in self.request_stream(messages):
+            deltas.append(delta)
+            yield delta
+
+        if cache is not None:
+            cache.put(key, llm_cache.response_from_text("".join(deltas), self.model))
+
+    def request_stream(self, messages):
+        if self.endpoint == "openai":
+            client = self.openai_client()
+            stream = client.chat.completions.create(**self.openai_completion_params(messages), stream=True)
+        else:
+            self.use_litellm_session()
+            stream = litellm.completion(
+                model=self.model,
+                messages=messages,
+                drop_params=True,
+                stream=True,
                 **self.params
-            )
\ No newline at end of file
+            )
+
+        for chunk in stream:
+            if len(chunk.choices) > 0 and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    def cache_key(self, messages, n=1):
+        return llm_cache.response_cache_key(self.endpoint, self.model, messages, self.litellm_params(n))
+
+    def provider_key(self):
+        return (self.endpoint, self.params.get("api_base"), self.model)
+
+    def litellm_params(self, n=1):
+        return {**self.params, "n": n} if n > 1 else self.params
+
+    def openai_client(self):
+        return get_http_client(self.endpoint, self.params.get("api_base"), self.params["api_key"])
+
+    def use_litellm_session(self):
+        # LiteLLM caches its provider clients itself, the shared session gives them the configured pool limits
+        litellm.client_session = get_http_client("litellm")
+
+    def openai_completion_params(self, messages, n=1):
+        completion_params = {
+            "model": self.model,
+            "messages": messages,
+        }
+        if n > 1:
+            completion_params["n"] = n
+        
+        if not (self.model == "o3-mini" or self.model == "o1"):
+            completion_params["temperature"] = self.params["temperature"]
+            completion_params["max_tokens"] = self.params["max_completion_tokens"]
+
+        return completion_params
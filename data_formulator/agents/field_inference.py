@@ -0,0 +1,200 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Deterministic inference of field types, the local fast path of DataLoadAgent.
+
+Each column gets the {"type", "semantic_type", "sort_order"} entry that DataLoadAgent's prompt asks the model for,
+when it can be decided from the dtype, the values and the column name alone: numbers, datetimes and date strings,
+times, years, months and days given by name, percentages, ranges, month and weekday names (with their calendar
+order). Columns that need judgement (names, locations, categories with a natural order, number-like strings,
+year-like integers under an unrelated name, ...) are reported as ambiguous and left to the model.
+"""
+
+import re
+
+import numpy as np
+import pandas as pd
+
+# at most this many distinct values of a column are inspected
+INFERENCE_MAX_VALUES = 5000
+
+MONTH_NAMES = ['january', 'february', 'march', 'april', 'may', 'june', 'july', 'august', 'september', 'october',
+               'november', 'december']
+WEEKDAY_NAMES = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+# formats of date strings, tried in order, with the semantic type of the values they parse
+# (Time values must also match TIME_PATTERN, strptime reads "1:2" as 01:02)
+DATE_FORMATS = [
+    ('%H:%M', 'Time'), ('%H:%M:%S', 'Time'),
+    ('%m/%d/%Y', 'Date'), ('%d/%m/%Y', 'Date'), ('%m/%d/%y', 'Date'), ('%Y/%m/%d', 'Date'), ('%d.%m.%Y', 'Date'),
+    ('%b %d, %Y', 'Date'), ('%B %d, %Y', 'Date'), ('%d %b %Y', 'Date'), ('%d %B %Y', 'Date'),
+    ('%m/%d/%Y %H:%M', 'DateTime'), ('%m/%d/%Y %H:%M:%S', 'DateTime'),
+    ('ISO8601', None),
+]
+
+TIME_PATTERN = re.compile(r'^\d{2}:\d{2}(:\d{2})?$')
+PERCENTAGE_PATTERN = re.compile(r'^\s*[-+]?\d[\d,]*(\.\d+)?\s*%\s*$')
+RANGE_PATTERN = re.compile(
+    r'^\s*(?P<below><=?|>=?|under|over|below|above|less than|more than)?\s*\$?(?P<low>\d[\d,]*(?:\.\d+)?)\s*(?P<low_unit>[kKmM])?'
+    r'(?:\s*(?P<to>-|–|to)\s*\$?(?P<high>\d[\d,]*(?:\.\d+)?)\s*(?P<high_unit>[kKmM])?)?'
+    r'\s*(?P<above>\+|or more|or older|and over|and above|and older)?\s*$', re.IGNORECASE)
+
+YEAR_WORDS = {'year', 'years', 'yr', 'yyyy'}
+MONTH_WORDS = {'month', 'mon', 'mm'}
+DAY_WORDS = {'day', 'dd'}
+PERCENTAGE_WORDS = {'pct', 'percent', 'percentage', 'percentages'}
+RANGE_WORDS = {'range', 'ranges', 'bracket', 'band', 'bin', 'bucket', 'group', 'interval', 'tier', 'age'}
+
+
+def name_words(field_name):
+    """the lowercase words of a column name, splitting camelCase, snake_case and punctuation"""
+    spaced = re.sub(r'([a-z])([A-Z])', r'\1 \2', str(field_name))
+    words = set(re.findall(r'[a-z]+', spaced.lower()))
+    if '%' in str(field_name):
+        words.add('percent')
+    return words
+
+
+def field_type(type, semantic_type, sort_order=None):
+    return {"type": type, "semantic_type": semantic_type, "sort_order": sort_order}
+
+
+def fallback_field(col):
+    """the entry of a field nobody could classify"""
+    if pd.api.types.is_numeric_dtype(col.dtype) and not pd.api.types.is_bool_dtype(col.dtype):
+        return field_type("number", "Number")
+    return field_type("string", "String")
+
+
+def calendar_order(values, names):
+    """the values in calendar order when they all are (abbreviated) names of names, None otherwise"""
+    positions = {}
+    for value in values:
+        key = str(value).strip().lower().rstrip('.')
+        if len(key) < 3:
+            return None
+        position = next((i for i, name in enumerate(names) if name.startswith(key)), None)
+        if position is None:
+            return None
+        positions[value] = position
+    return sorted(values, key=lambda v: positions[v])
+
+
+def range_bound(match, bound):
+    unit = (match.group(f'{bound}_unit') or '').lower()
+    return float(match.group(bound).replace(',', '')) * {'': 1, 'k': 1e3, 'm': 1e6}[unit]
+
+
+def range_order(values, field_name=''):
+    """the values sorted by their bounds when they are all ranges like "<10", "10 to 19", "20-29" or "30+",
+    None otherwise. Values that are only "digits-digits" (phone numbers, scores, zip+4 codes) are ranges only
+    under a range-like column name"""
+    keys = {}
+    marked = bool(name_words(field_name) & RANGE_WORDS)
+    for value in values:
+        match = RANGE_PATTERN.match(value)
+        if match is None or all(match.group(marker) is None for marker in ('below', 'high', 'above')):
+            # plain amounts like "$35" or "5k" are not ranges
+            return None
+        low = range_bound(match, 'low')
+        if match.group('high') is not None and low > range_bound(match, 'high'):
+            return None
+        marked = marked or match.group('below') is not None or match.group('above') is not None or match.group('to') != '-'
+        below = match.group('below') is not None and match.group('below').lower() in ('<', '<=', 'under', 'below', 'less than')
+        keys[value] = (low, 0 if below else 1)
+    return sorted(values, key=lambda v: keys[v]) if marked else None
+
+
+def date_semantic_type(values):
+    """Date, DateTime or Time when all values parse with one of DATE_FORMATS, None otherwise"""
+    values = pd.Series(values, dtype=object)
+    if not values.str.contains(r'[-/:.,\s]', regex=True).all():
+        return None
+    for format, semantic_type in DATE_FORMATS:
+        if semantic_type == 'Time' and not values.str.match(TIME_PATTERN).all():
+            continue
+        parsed = pd.to_datetime(values, format=format, errors='coerce')
+        if parsed.notna().all():
+            if semantic_type is None:
+                has_time = ((parsed - parsed.dt.normalize()) != pd.Timedelta(0)).any() or values.str.contains(':').any()
+                semantic_type = 'DateTime' if has_time else 'Date'
+            return semantic_type
+    return None
+
+
+def infer_numeric_field(field_name, values):
+    words = name_words(field_name)
+    integral = values.dtype.kind in 'iu' or bool(np.all(np.mod(values, 1) == 0))
+    low, high = values.min(), values.max()
+
+    if integral and words & YEAR_WORDS and 1000 <= low and high <= 2999:
+        return field_type("number", "Year")
+    if integral and words & MONTH_WORDS and 1 <= low and high <= 12:
+        return field_type("number", "Month")
+    if integral and words & DAY_WORDS and 1 <= low and high <= 31:
+        return field_type("number", "Day")
+    if words & PERCENTAGE_WORDS and 0 <= low and high <= 100:
+        return field_type("number", "Percentage")
+    if integral and 1800 <= low and high <= 2100:
+        # years, or counts and ids that happen to look like years
+        return None
+    if not integral and 0 <= low and high <= 1 and not words & {'id', 'count', 'number'}:
+        # fractions, maybe percentages
+        return None
+    return field_type("number", "Number")
+
+
+def infer_string_field(field_name, values):
+    if not all(isinstance(v, str) for v in values):
+        return None
+
+    if all(PERCENTAGE_PATTERN.match(v) for v in values):
+        return field_type("string", "Percentage")
+    if pd.to_numeric(pd.Series(values, dtype=object), errors='coerce').notna().all():
+        # zip codes, ids, years or numbers stored as text
+        return None
+
+    months = calendar_order(values, MONTH_NAMES)
+    if months is not None:
+        return field_type("string", "Month", months)
+    weekdays = calendar_order(values, WEEKDAY_NAMES)
+    if weekdays is not None:
+        return field_type("string", "Day", weekdays)
+
+    semantic_type = date_semantic_type(values)
+    if semantic_type is not None:
+        return field_type("string", semantic_type)
+
+    ranges = range_order(values, field_name)
+    if ranges is not None:
+        return field_type("string", "Range", ranges)
+    return None
+
+
+def infer_field(field_name, col):
+    """the type entry of a column, None when it is ambiguous"""
+    col = col.dropna()
+    if len(col) == 0:
+        return field_type("string", "String")
+
+    if pd.api.types.is_bool_dtype(col.dtype):
+        return field_type("string", "String")
+    if pd.api.types.is_datetime64_any_dtype(col.dtype):
+        has_time = (col != col.dt.normalize()).any()
+        return field_type("date", "DateTime" if has_time else "Date")
+    if pd.api.types.is_numeric_dtype(col.dtype):
+        return infer_numeric_field(field_name, col.to_numpy())
+
+    values = list(pd.unique(col.to_numpy())[:INFERENCE_MAX_VALUES])
+    return infer_string_field(field_name, values)
+
+
+def infer_fields(df):
+    """{field name: type entry, or None when the field is ambiguous} for every column of df, in column order"""
+    return {str(name): infer_field(name, df[name]) for name in df.columns}
+
+
+def describe_fields(table_name, df, fields):
+    """a short summary of the table written without the model"""
+    field_list = ', '.join(f"{name} ({field['semantic_type']})" for name, field in fields.items())
+    return f"The dataset {table_name} contains {len(df)} rows and {len(fields)} fields: {field_list}."
@@ -0,0 +1,143 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Persistent cache of LLM completions.
+
+Responses are keyed by a hash of the endpoint, the model, the messages and the sampling params (api keys are
+not part of the key), and stored in a SQLite file shared by every process using the same path.
+Entries expire after ttl seconds and the least recently used ones are evicted beyond max_bytes.
+In replay mode a miss raises LLMCacheMiss instead of calling the model, so that benchmarks and tests run
+without network.
+
+The cache is off unless configured, either with configure_response_cache or with the environment variables
+DATA_FORMULATOR_LLM_CACHE (path of the SQLite file) and DATA_FORMULATOR_LLM_CACHE_REPLAY=1.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from openai.types.chat import ChatCompletion
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Client params that select the account or the deployment, not the completion
+NON_KEY_PARAMS = {'api_key', 'api_version'}
+
+
+class LLMCacheMiss(Exception):
+    """raised in replay mode when a request has no cached response"""
+
+
+def response_cache_key(endpoint, model, messages, params):
+    key_params = {k: v for k, v in params.items() if k not in NON_KEY_PARAMS}
+    payload = json.dumps([endpoint, model, messages, key_params], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def response_from_text(text, model=None):
+    """a single-choice completion holding text, for responses assembled from a stream"""
+    return ChatCompletion.construct(
+        object="chat.completion", model=model, created=int(time.time()),
+        choices=[{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": text}}])
+
+
+class LLMResponseCache(object):
+    """SQLite-backed response cache, ttl in seconds (None: entries never expire), max_bytes bounds the
+    stored responses"""
+
+    def __init__(self, path, ttl=7 * 24 * 3600, max_bytes=256 * 1024 * 1024, replay=False):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.replay = replay
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL,
+                created REAL NOT NULL, last_used REAL NOT NULL)""")
+
+    def get(self, key):
+        """the cached response, or None (LLMCacheMiss in replay mode)"""
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl is not None and row[1] < now - self.ttl:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+
+        if row is None:
+            if self.replay:
+                raise LLMCacheMiss(f"no cached response for request {key} (replay mode)")
+            return None
+        return ChatCompletion.construct(**json.loads(row[0]))
+
+    def put(self, key, response):
+        data = json.dumps(response.model_dump(mode="json"))
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                               (key, data, len(data), now, now))
+            self._evict(now)
+
+    def _evict(self, now):
+        if self.ttl is not None:
+            self._conn.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = []
+        for key, size in self._conn.execute("SELECT key, size FROM responses ORDER BY last_used"):
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM responses")
+
+    def stats(self):
+        with self._lock:
+            entries, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': entries,
+                'bytes': size,
+            }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+response_cache = None
+if os.environ.get("DATA_FORMULATOR_LLM_CACHE"):
+    response_cache = LLMResponseCache(os.environ["DATA_FORMULATOR_LLM_CACHE"],
+                                      replay=os.environ.get("DATA_FORMULATOR_LLM_CACHE_REPLAY") == "1")
+
+def configure_response_cache(path, ttl=7 * 24 * 3600, max_bytes=256 * 1024 * 1024, replay=False):
+    """use a response cache stored at path for all Clients of the process (None turns caching off)"""
+    global response_cache
+    if response_cache is not None:
+        response_cache.close()
+    response_cache = LLMResponseCache(path, ttl, max_bytes, replay) if path is not None else None
+    return response_cache
@@ -0,0 +1,141 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Persistent cache of transformation plans (generated code).
+
+Plans are keyed on the normalized instruction, the expected fields and the schemas of the input tables
+(column names and dtypes), not on their rows: the same instruction on a refreshed table with the same schema
+reuses the code instead of generating it again. Only the key, the code, the fields it suggests for visualization
+and its explanation are stored (plus how long generating it took), never the dialog or the data samples that went
+into the prompt. Hits, misses and the generation time
+saved by hits are accumulated in the cache file, across processes. Beyond max_entries plans, the least recently
+used ones are evicted.
+
+The cache is off unless configured, either with configure_plan_cache or with the environment variable
+DATA_FORMULATOR_PLAN_CACHE (path of the SQLite file).
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from data_formulator.sandbox_io import table_dtypes
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_instruction(instruction):
+    return " ".join(instruction.lower().split())
+
+
+def table_schema(rows):
+    return [(str(name), str(dtype)) for name, dtype in table_dtypes(rows).items()]
+
+
+def plan_key(instruction, expected_fields, table_list):
+    payload = json.dumps([normalize_instruction(instruction), list(expected_fields),
+                          [table_schema(rows) for rows in table_list]])
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class PlanCache(object):
+    """SQLite-backed plan cache, a plan is the generated code, its 'visualization_fields' and 'explanation' (None
+    when it could not be generated) and 'generation_seconds' (how long producing it took, what a hit saves),
+    max_entries bounds the stored plans"""
+
+    def __init__(self, path, max_entries=1000):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS plans (
+                key TEXT PRIMARY KEY, code TEXT NOT NULL, visualization_fields TEXT NOT NULL, explanation TEXT,
+                generation_seconds REAL NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL)""")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value REAL NOT NULL)")
+
+    def get(self, key):
+        """{'code', 'visualization_fields', 'explanation', 'generation_seconds'} of the cached plan, or None"""
+        with self._lock, self._conn:
+            row = self._conn.execute("""SELECT code, visualization_fields, explanation, generation_seconds
+                FROM plans WHERE key = ?""", (key,)).fetchone()
+            if row is not None:
+                self._conn.execute("UPDATE plans SET last_used = ? WHERE key = ?", (time.time(), key))
+        if row is None:
+            return None
+        return {'code': row[0], 'visualization_fields': json.loads(row[1]), 'explanation': row[2],
+                'generation_seconds': row[3]}
+
+    def put(self, key, code, generation_seconds, visualization_fields=(), explanation=None):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO plans VALUES (?, ?, ?, ?, ?, ?, ?)",
+                               (key, code, json.dumps(list(visualization_fields)), explanation,
+                                generation_seconds, now, now))
+            self._conn.execute("""DELETE FROM plans WHERE key NOT IN
+                (SELECT key FROM plans ORDER BY last_used DESC LIMIT ?)""", (self.max_entries,))
+
+    def invalidate(self, key):
+        """drop a plan that failed on the current data"""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM plans WHERE key = ?", (key,))
+
+    def record(self, hit, seconds_saved=0.0):
+        with self._lock, self._conn:
+            for name, value in [('hits' if hit else 'misses', 1), ('seconds_saved', max(seconds_saved, 0.0))]:
+                self._conn.execute("INSERT INTO stats VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + ?",
+                                   (name, value, value))
+
+    def stats(self):
+        with self._lock:
+            values = dict(self._conn.execute("SELECT name, value FROM stats").fetchall())
+            entries = self._conn.execute("SELECT COUNT(*) FROM plans").fetchone()[0]
+        hits, misses = int(values.get('hits', 0)), int(values.get('misses', 0))
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / (hits + misses) if hits + misses > 0 else 0.0,
+            'seconds_saved': values.get('seconds_saved', 0.0),
+            'entries': entries,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_plan_cache = None
+_plan_cache_configured = False
+_plan_cache_lock = threading.Lock()
+
+def configure_plan_cache(path, max_entries=1000):
+    """store plans at path (None turns the plan cache off)"""
+    global _plan_cache, _plan_cache_configured
+    with _plan_cache_lock:
+        if _plan_cache is not None:
+            _plan_cache.close()
+        _plan_cache = PlanCache(path, max_entries) if path else None
+        _plan_cache_configured = True
+    return _plan_cache
+
+def get_plan_cache():
+    """the process-wide plan cache, opened on first use, or None when it is turned off"""
+    global _plan_cache, _plan_cache_configured
+    with _plan_cache_lock:
+        if not _plan_cache_configured:
+            path = os.environ.get("DATA_FORMULATOR_PLAN_CACHE")
+            try:
+                _plan_cache = PlanCache(path) if path else None
+            except (OSError, sqlite3.Error) as e:
+                logger.warning(f"plan cache at {path} unavailable: {e}")
+                _plan_cache = None
+            _plan_cache_configured = True
+        return _plan_cache
@@ -0,0 +1,241 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Fast CSV reading: pyarrow's multithreaded parser when it is available, pandas' C parser otherwise, with the
+same values as pd.read_csv (dates and times stay strings, the same null markers, "true"/"false" booleans).
+Files pyarrow would read differently, with hexadecimal-looking values ("0x10" is a string to pandas) or integers
+beyond int64 (uint64 or strings to pandas), are left to pandas.
+
+The column types inferred for a file can be remembered per path in a small JSON file, so that the next load of the
+same export (say, a daily one) parses with known types instead of inferring them again. A cached schema that
+does not fit the file anymore is simply dropped and inferred again. Beyond max_entries files, the least recently
+used schemas are evicted. The cache is off unless configured, either with configure_csv_schema_cache or with the
+environment variable DATA_FORMULATOR_CSV_SCHEMA_CACHE (path of the JSON file).
+"""
+
+import json
+import mmap
+import os
+import re
+import threading
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = None
+    pc = None
+    pa_csv = None
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# pd.read_csv's default null markers
+NULL_VALUES = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+               '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null']
+TRUE_VALUES = ['True', 'TRUE', 'true']
+FALSE_VALUES = ['False', 'FALSE', 'false']
+
+# a whole field that pyarrow parses as a hexadecimal integer
+HEX_FIELD_PATTERN = re.compile(rb'(?:^|[,"])[ \t]*[-+]?0[xX][0-9a-fA-F]+[ \t]*(?:[,"\r\n]|$)', re.MULTILINE)
+
+# arrow types that are cached: a column changing to another type fails the read or is caught by schema_fits,
+# (string columns are not cached, values of a string column may all turn numeric)
+CACHEABLE_ARROW_TYPES = {'null', 'bool', 'int64', 'double'}
+# pandas dtypes given to the C parser from a cached schema
+CACHEABLE_DTYPES = {'int64', 'float64'}
+
+
+class CsvSchemaCache(object):
+    """{file path: {"engine": parser that read it, "types": {column: arrow type}, "dtypes": {column: pandas dtype}}},
+    kept in a JSON file in least recently used order, max_entries bounds the stored schemas"""
+
+    def __init__(self, path, max_entries=1000):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._schemas = None
+
+    def _load(self):
+        if self._schemas is None:
+            try:
+                with open(self.path) as f:
+                    self._schemas = json.load(f)
+            except (OSError, ValueError):
+                self._schemas = {}
+        return self._schemas
+
+    def get(self, file_path):
+        with self._lock:
+            schemas = self._load()
+            key = os.path.abspath(file_path)
+            if key not in schemas:
+                return None
+            # written in this order with the next put
+            schemas[key] = schemas.pop(key)
+            return schemas[key]
+
+    def put(self, file_path, schema):
+        with self._lock:
+            schemas = self._load()
+            key = os.path.abspath(file_path)
+            if schemas.get(key) == schema:
+                return
+            schemas.pop(key, None)
+            schemas[key] = schema
+            for old_key in list(schemas)[:max(0, len(schemas) - self.max_entries)]:
+                del schemas[old_key]
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                tmp_path = f"{self.path}.{os.getpid()}.tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump(schemas, f)
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                logger.warning(f"csv schema cache at {self.path} not writable: {e}")
+
+    def invalidate(self, file_path):
+        with self._lock:
+            self._load().pop(os.path.abspath(file_path), None)
+
+
+_schema_cache_path = os.environ.get("DATA_FORMULATOR_CSV_SCHEMA_CACHE")
+csv_schema_cache = CsvSchemaCache(_schema_cache_path) if _schema_cache_path else None
+
+def configure_csv_schema_cache(path, max_entries=1000):
+    """remember csv schemas at path (None turns the schema cache off)"""
+    global csv_schema_cache
+    csv_schema_cache = CsvSchemaCache(path, max_entries) if path else None
+    return csv_schema_cache
+
+
+def cached_schema(file_path):
+    return csv_schema_cache.get(file_path) if csv_schema_cache is not None else None
+
+
+def cached_dtypes(file_path):
+    """the pandas dtypes of the cached schema that can be handed to the C parser, None when there are none"""
+    schema = cached_schema(file_path)
+    dtypes = {c: d for c, d in (schema or {}).get('dtypes', {}).items() if d in CACHEABLE_DTYPES}
+    return dtypes or None
+
+
+def arrow_convert_options(usecols, column_types):
+    return pa_csv.ConvertOptions(include_columns=usecols, column_types=column_types, null_values=NULL_VALUES,
+                                 strings_can_be_null=True, true_values=TRUE_VALUES, false_values=FALSE_VALUES)
+
+
+def temporal_columns(file_path, usecols):
+    """the columns that pyarrow infers as dates, times or timestamps from the first block (pandas keeps them as strings)"""
+    with pa_csv.open_csv(file_path, convert_options=arrow_convert_options(usecols, None)) as reader:
+        schema = reader.schema
+    return [f.name for f in schema if pa.types.is_temporal(f.type)]
+
+
+def has_hex_fields(file_path):
+    """whether a field of the file looks like a hexadecimal integer"""
+    if os.path.getsize(file_path) == 0:
+        return False
+    with open(file_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        return HEX_FIELD_PATTERN.search(data) is not None
+
+
+def overflowing_columns(table):
+    """the float columns whose values are all integers and some beyond int64, pandas reads them as uint64 or strings"""
+    names = []
+    for field in table.schema:
+        if pa.types.is_floating(field.type):
+            col = pc.drop_null(table.column(field.name))
+            col = pc.filter(col, pc.is_finite(col))
+            if (len(col) > 0 and pc.all(pc.equal(pc.floor(col), col)).as_py()
+                    and pc.max(pc.abs(col)).as_py() >= 2 ** 63):
+                names.append(field.name)
+    return names
+
+
+def read_csv_arrow(file_path, usecols=None, schema=None):
+    """read a csv with pyarrow, column types come from schema when given, temporal columns are read as strings"""
+    if has_hex_fields(file_path):
+        raise ValueError("hexadecimal-looking values")
+    if schema is not None:
+        column_types = {c: t for c, t in schema['types'].items() if usecols is None or c in usecols}
+    else:
+        column_types = {c: 'string' for c in temporal_columns(file_path, usecols)}
+
+    table = pa_csv.read_csv(file_path, convert_options=arrow_convert_options(
+        usecols, {c: pa.type_for_alias(t) for c, t in column_types.items()}))
+    late_temporal = [f.name for f in table.schema if pa.types.is_temporal(f.type)]
+    if late_temporal:
+        # dates that only start after the first block
+        column_types.update({c: 'string' for c in late_temporal})
+        table = pa_csv.read_csv(file_path, convert_options=arrow_convert_options(
+            usecols, {c: pa.type_for_alias(t) for c, t in column_types.items()}))
+
+    names = table.column_names
+    if len(set(names)) != len(names) or '' in names:
+        # pandas renames duplicated and empty headers ("a.1", "Unnamed: 0"), leave those files to it
+        raise ValueError("duplicated or empty column names")
+    overflowing = overflowing_columns(table)
+    if overflowing:
+        raise ValueError(f"integers beyond int64 in {overflowing}")
+
+    arrow_schema = table.schema
+    # the arrow buffers are released while the frame is built, so that the file is not held twice in memory
+    df = table.to_pandas(split_blocks=True, self_destruct=True)
+    del table
+    if usecols is not None:
+        # like pandas' usecols, keep the order of the file
+        df = df[[c for c in pd.read_csv(file_path, nrows=0).columns if c in df.columns]]
+
+    # the temporal columns read as strings are cached too, the next load skips the probe
+    types = {**{f.name: str(f.type) for f in arrow_schema if str(f.type) in CACHEABLE_ARROW_TYPES},
+             **{c: t for c, t in column_types.items() if t == 'string'}}
+    return df, types
+
+
+def read_csv_pandas(file_path, usecols=None, schema=None):
+    dtypes = {c: d for c, d in (schema or {}).get('dtypes', {}).items() if d in CACHEABLE_DTYPES}
+    df = pd.read_csv(file_path, usecols=usecols, dtype=dtypes or None)
+    types = {c: {'int64': 'int64', 'float64': 'double', 'bool': 'bool'}[str(d)] for c, d in df.dtypes.items()
+             if str(d) in ('int64', 'float64', 'bool')}
+    return df, types
+
+
+def schema_fits(df):
+    """whether a frame read with cached types has the dtypes inference would give: a float column without nulls
+    whose values are all integers would have been inferred as int64"""
+    for name, col in df.items():
+        if col.dtype == 'float64' and len(col) > 0 and col.notna().all() and (col % 1 == 0).all():
+            return False
+    return True
+
+
+def read_csv(file_path, usecols=None):
+    """read a whole csv file into a DataFrame, with the values pd.read_csv(file_path, usecols=usecols) would give"""
+    schema = cached_schema(file_path)
+    attempts = []
+    if pa_csv is not None and (schema or {}).get('engine') != 'c':
+        attempts += [(read_csv_arrow, schema)] if schema is not None else []
+        attempts += [(read_csv_arrow, None)]
+    attempts += [(read_csv_pandas, schema)] if schema is not None else []
+    attempts += [(read_csv_pandas, None)]
+
+    for i, (read, attempt_schema) in enumerate(attempts):
+        try:
+            df, types = read(file_path, usecols, attempt_schema)
+            if attempt_schema is None or schema_fits(df):
+                break
+            logger.info(f"cached schema of {file_path} does not fit anymore")
+        except Exception as e:
+            if i == len(attempts) - 1:
+                raise
+            logger.info(f"{read.__name__} failed on {file_path} ({'cached' if attempt_schema else 'inferred'} schema): {e}")
+
+    if csv_schema_cache is not None and usecols is None:
+        csv_schema_cache.put(file_path, {'engine': 'pyarrow' if read is read_csv_arrow else 'c', 'types': types,
+                                         'dtypes': {str(c): str(d) for c, d in df.dtypes.items()}})
+    return df
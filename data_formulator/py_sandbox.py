@@ -1,22 +1,46 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Process, Pipe
+import multiprocessing
 from sys import addaudithook
+import ast
+import atexit
+import math
+import os
+import queue
+import signal
+import sys
+import threading
+import time
 import traceback
 import warnings
 
-## ---------------- The sandbox implementation follows, not to be changed --------------------
+from data_formulator.sandbox_cache import cached_sandbox_call
+from data_formulator.sandbox_io import DUMP_TABLE_STR, LOAD_TABLE_STR, discard_result_block, prepare_result_channel, \
+    read_result_table, result_block_name, staged_tables
+
+try:
+    import resource
+except ImportError:  # not available on windows, only the wall-clock limit applies there
+    resource = None
+
+# per-execution budgets, any of them can be None (unlimited), none is set by default
+#   timeout: wall-clock seconds, enforced by the main process which kills the sandbox
+#   cpu_time: cpu seconds, enforced in the sandbox with RLIMIT_CPU
+#   memory: bytes of address space the execution may add to what the sandbox process has mapped when it starts,
+#           enforced in the sandbox with RLIMIT_AS
+DEFAULT_LIMITS = {
+    'timeout': None,
+    'cpu_time': None,
+    'memory': None,
+}
 
-def ran_in_subprocess(code, allowed_objects, conn, output_var_name):
-    """run the code in a subprocess with some sort of safety measure
-    code: script to execute
-    allowed_objects: objects exposed to the target code
-    conn: children connection
-    output_var_name: which variable to return from the subprocess
-    """
-    warnings.filterwarnings('ignore')
+## ---------------- The sandbox implementation follows, not to be changed --------------------
 
+def install_audit_hook():
+    """install the audit hook guarding the current process, it stays active for the rest of the process lifetime"""
 
     def block_mischief(event,arg):
         if type(event) != str: raise
@@ -34,110 +58,694 @@ def ran_in_subprocess(code, allowed_objects, conn, output_var_name):
     addaudithook(block_mischief)
     del(block_mischief)  ## No way to remove or circumwent audit hooks from python. No access to this function. 
 
-    allowed_objects['conn'] = conn  # automatically add the communication pipe to objects accessible from the sandbox
+
+def address_space_size():
+    """bytes of address space currently mapped by this process, 0 where it cannot be read"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[0]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def apply_limits(limits):
+    """set the cpu time and address space budgets of the current process for the next execution"""
+    if resource is None:
+        return
+
+    if limits.get('cpu_time') is not None:
+        # RLIMIT_CPU counts the cpu time of the whole process lifetime, the budget is on top of what's used already
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+        soft = math.ceil(usage.ru_utime + usage.ru_stime + limits['cpu_time'])
+        resource.setrlimit(resource.RLIMIT_CPU, (soft if hard == resource.RLIM_INFINITY else min(soft, hard), hard))
+
+    if limits.get('memory') is not None:
+        # like RLIMIT_CPU, RLIMIT_AS covers the whole process: what it inherited when forked, pandas, ... included
+        _, hard = resource.getrlimit(resource.RLIMIT_AS)
+        soft = address_space_size() + limits['memory']
+        soft = soft if hard == resource.RLIM_INFINITY else min(soft, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (soft, hard))
+
+
+def peak_rss():
+    """the peak RSS (bytes) of the current process, None where it cannot be read"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def sandbox_timings(allowed_objects, start_peak_rss=None):
+    """stage timings recorded by the script in its `timings` dict, plus by how much the execution raised the peak RSS
+    (bytes) of the sandbox process: a forked sandbox starts with the peak RSS of the process it was forked from"""
+    timings = dict(allowed_objects['timings']) if isinstance(allowed_objects.get('timings'), dict) else {}
+    if start_peak_rss is not None:
+        timings['peak_rss_increase'] = peak_rss() - start_peak_rss
+    return timings
+
+
+def exec_in_sandbox(code, allowed_objects, output_var_name):
+    """execute the code in the current (audit-hooked) process and package the result message"""
+    start_peak_rss = peak_rss()
     try:
         exec(code, allowed_objects)
+    except MemoryError as err:
+        result = {'status': 'oom', 'content': f"Error: MemoryError - {str(err) or 'code execution ran out of memory'}"}
     except Exception as err:
         error_message = f"Error: {type(err).__name__} - {str(err)}"
-        conn.send({'status': 'error', 'content': error_message})
-        conn.close()
-        return allowed_objects
+        result = {'status': 'error', 'content': error_message}
+    else:
+        result = {'status': 'ok', 'content': allowed_objects[output_var_name]}
+        if 'exec_mode' in allowed_objects:
+            result['mode'] = allowed_objects['exec_mode']
+
+    result['timings'] = sandbox_timings(allowed_objects, start_peak_rss)
+    return result
+
+
+def ran_in_subprocess(code, allowed_objects, conn, output_var_name, limits={}):
+    """run the code in a subprocess with some sort of safety measure
+    code: script to execute
+    allowed_objects: objects exposed to the target code
+    conn: children connection
+    output_var_name: which variable to return from the subprocess
+    limits: cpu time / memory budgets of the execution (see DEFAULT_LIMITS)
+    """
+    warnings.filterwarnings('ignore')
+
+    apply_limits(limits)
+    install_audit_hook()
 
-    conn.send({'status': 'ok', 'content': allowed_objects[output_var_name]})
+    allowed_objects['conn'] = conn  # automatically add the communication pipe to objects accessible from the sandbox
+    conn.send(exec_in_sandbox(code, allowed_objects, output_var_name))
     conn.close()
     return allowed_objects
 
-def run_transform_in_sandbox2020(code, table_list):
-    
-    allowed_objects = [table_list]
 
-    import_str = "import pandas as pd\nimport json"
+def ran_in_worker(conn):
+    """body of a pooled sandbox worker: pandas/numpy are imported and the audit hook is installed ahead of time,
+    then the single task (code, allowed_objects, output_var_name, limits) received from conn is executed"""
+    warnings.filterwarnings('ignore')
 
-    exec_str = '''
-output_df = transform_data(*[pd.DataFrame.from_records(data) for data in table_list])
-#print(output_df)
-output = output_df.to_json(None, "records")
-#print(output)
-    '''
+    import pandas
+    import numpy
 
-    script_str = f'{import_str}\n\n{code}{exec_str}'
+    install_audit_hook()
+
+    try:
+        task = conn.recv()
+    except EOFError:
+        task = None
+    if task is not None:
+        code, allowed_objects, output_var_name, limits = task
+        apply_limits(limits)
+        conn.send(exec_in_sandbox(code, allowed_objects, output_var_name))
+
+    conn.close()
+
+
+# how often an execution waiting for a worker or a result checks whether it was cancelled (seconds)
+CANCEL_POLL_INTERVAL = 0.05
+
+CANCELLED_RESULT = {'status': 'cancelled', 'content': "Error: CancelledError - code execution was cancelled"}
+
+def wait_for_result(conn, process, limits, cancel=None):
+    """receive the result message of a sandbox process while enforcing the wall-clock budget,
+    a process running over budget is killed and a 'timeout' / 'oom' status is returned instead.
+    cancel: a threading.Event, once it is set the process is killed and a 'cancelled' status is returned"""
+    timeout = limits.get('timeout')
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        wait = None if deadline is None else max(0, deadline - time.monotonic())
+        if cancel is not None:
+            wait = CANCEL_POLL_INTERVAL if wait is None else min(wait, CANCEL_POLL_INTERVAL)
+        if conn.poll(wait):
+            break
+        if cancel is not None and cancel.is_set():
+            process.kill()
+            process.join()
+            return dict(CANCELLED_RESULT)
+        if deadline is not None and time.monotonic() >= deadline:
+            process.kill()
+            process.join()
+            return {'status': 'timeout', 'content': f"Error: TimeoutError - code execution exceeded the time limit of {timeout} seconds"}
+
+    try:
+        start = time.perf_counter()
+        result = conn.recv()
+        result.setdefault('timings', {})['receive_output'] = time.perf_counter() - start
+        return result
+    except EOFError:
+        process.join()
+
+    if process.exitcode == -signal.SIGXCPU:
+        return {'status': 'timeout', 'content': f"Error: TimeoutError - code execution exceeded the cpu time limit of {limits.get('cpu_time')} seconds"}
+    if process.exitcode == -signal.SIGKILL:
+        return {'status': 'oom', 'content': "Error: MemoryError - the sandbox process was killed, most likely it ran out of memory"}
+    return {'status': 'error', 'content': f"Error: SandboxError - the sandbox process exited unexpectedly (exit code {process.exitcode})"}
+
+## ---------------- Warm worker pool --------------------
+
+# workers are forked by a forkserver (a single-threaded process with pandas preloaded) rather than by the main
+# process: a fork of the main process would inherit the locks its other threads (candidate executors, http clients,
+# ...) hold at that moment, e.g. the one of stdout the audit hook prints with, and could hang on them
+if 'forkserver' in multiprocessing.get_all_start_methods():
+    _worker_context = multiprocessing.get_context('forkserver')
+    _worker_context.set_forkserver_preload(['data_formulator.py_sandbox'])
+else:
+    _worker_context = multiprocessing.get_context('spawn')
+
+
+class SandboxWorker(object):
+    """a pre-forked sandbox process and the parent end of its pipe"""
+
+    def __init__(self):
+        prepare_result_channel()
+        self.conn, child_conn = _worker_context.Pipe()
+        self.process = _worker_context.Process(target=ran_in_worker, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def run(self, code, allowed_objects, output_var_name, limits, cancel=None):
+        start = time.perf_counter()
+        self.conn.send((code, allowed_objects, output_var_name, limits))
+        send_time = time.perf_counter() - start
+
+        result = wait_for_result(self.conn, self.process, limits, cancel)
+        result.setdefault('timings', {})['send_input'] = send_time
+        return result
+
+    def close(self):
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.conn.close()
+        self.process.join(timeout=1)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+
+
+class SandboxWorkerPool(object):
+    """keeps `size` warm sandbox workers around, so that executions skip the process spawn and pandas import.
+    Every worker has the same audit hook as ran_in_subprocess and runs a single task: it is forked from the
+    forkserver (which never runs generated code) and retired right after, so module state patched by generated code
+    (pandas methods, pd.set_option, ...) and the limits of the execution never reach the next one.
+    """
 
-    sandbox_locals = dict((key, value) for key,value in locals().items() if value in allowed_objects) # copy.deepcopy() ## are all obj safely serialized?
+    def __init__(self, size=2):
+        self.size = size
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._closed = False
+        for _ in range(size):
+            self._idle.put(SandboxWorker())
+
+    def run(self, code, allowed_objects, output_var_name='output', limits=DEFAULT_LIMITS, cancel=None):
+        """execute code on an idle worker (blocking until one is available) and return the result message.
+        cancel: a threading.Event, setting it gives up waiting for a worker, or kills the one running the code"""
+        if self._closed:
+            raise RuntimeError("sandbox worker pool is closed")
+
+        start = time.perf_counter()
+        worker = None
+        while worker is None:
+            try:
+                worker = self._idle.get(timeout=CANCEL_POLL_INTERVAL if cancel is not None else None)
+            except queue.Empty:
+                pass
+            if cancel is not None and cancel.is_set():
+                if worker is not None:
+                    # unused, still clean
+                    self._idle.put(worker)
+                return dict(CANCELLED_RESULT)
+        wait_time = time.perf_counter() - start
+        try:
+            result = worker.run(code, allowed_objects, output_var_name, limits, cancel)
+            # with a warm pool, "spawn" is the time spent waiting for an idle worker
+            result['timings']['spawn'] = wait_time
+            return result
+        except (EOFError, OSError):
+            return {'status': 'error', 'content': "Error: SandboxError - the sandbox worker exited unexpectedly"}
+        finally:
+            self._recycle(worker)
+
+    def _recycle(self, worker):
+        """retire a worker and fork its replacement in the background, off the caller's critical path"""
+        def replace():
+            worker.close()
+            with self._lock:
+                if not self._closed:
+                    self._idle.put(SandboxWorker())
+        threading.Thread(target=replace, daemon=True).start()
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+def configure_sandbox_pool(size=2):
+    """(re)create the process-wide sandbox worker pool with the given settings"""
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is not None:
+            _default_pool.close()
+        _default_pool = SandboxWorkerPool(size)
+    return _default_pool
+
+def get_sandbox_pool():
+    """the process-wide sandbox worker pool, created on first use.
+    The pool size (one worker per core by default) can be set with the DATA_FORMULATOR_SANDBOX_WORKERS environment variable"""
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            size = int(os.environ.get("DATA_FORMULATOR_SANDBOX_WORKERS", os.cpu_count() or 2))
+            _default_pool = SandboxWorkerPool(size)
+        return _default_pool
+
+@atexit.register
+def _close_sandbox_pool():
+    if _default_pool is not None:
+        _default_pool.close()
+
+
+def run_script_in_sandbox(script_str, sandbox_locals, use_pool=True, limits=None, cancel=None):
+    """run a full script in the sandbox and return the value of its `output` variable,
+    either on a warm pooled worker or in a freshly spawned process.
+    limits override DEFAULT_LIMITS, an execution running over budget gets status 'timeout' or 'oom'.
+    cancel: a threading.Event, setting it stops the execution, which gets status 'cancelled'.
+    The result's `timings` (seconds) cover spawn, send_input, build_dataframe, transform, serialize_output,
+    receive_output and total, plus peak_rss_increase, the bytes by which the execution raised the sandbox process'
+    peak RSS"""
+    limits = {**DEFAULT_LIMITS, **(limits or {})}
+    start = time.perf_counter()
+
+    if use_pool:
+        result = get_sandbox_pool().run(script_str, sandbox_locals, 'output', limits, cancel)
+        result.setdefault('timings', {})['total'] = time.perf_counter() - start
+        return result
+
+    prepare_result_channel()
     parent_conn, child_conn = Pipe()
-    p = Process(target=ran_in_subprocess, args=(script_str, sandbox_locals, child_conn, 'output'))
+    p = Process(target=ran_in_subprocess, args=(script_str, sandbox_locals, child_conn, 'output', limits))
     p.start()
+    spawn_time = time.perf_counter() - start
 
     ## NOTE: The sandbox is probably safe against file writing, as well as against access into the main process.
     ## Yet the objects returned from it as results could have been manipulated. Asserting the output objects to be 
     ## of expected data types is an extra safety measure. But be careful whenever your main program flow is 
     ## controlled by the returned objects' attributes, e.g. file paths could change. 
-    result = parent_conn.recv()
+    result = wait_for_result(parent_conn, p, limits, cancel)
     p.join()
+    result.setdefault('timings', {}).update({'spawn': spawn_time, 'total': time.perf_counter() - start})
     return result
 
+@cached_sandbox_call('table_list')
+def run_transform_in_sandbox2020(code, table_list, use_pool=True, output_format="json", limits=None, cancel=None):
+    """run transform_data on the tables, output_format decides how the result comes back:
+        json: content is the json records string of the output dataframe
+        arrow: content is the output dataframe, shipped back as an arrow stream through shared memory
+    cancel: see run_script_in_sandbox
+    """
 
-def run_data_process_in_sandbox(code, table_rows, exec_str):
-    """given a concept derivatino function, execute the function on inputs to generate a new dataframe"""
-    
-    allowed_objects = [table_rows]
+    import_str = f"import pandas as pd\nimport json\nfrom time import perf_counter as sandbox_clock\n{LOAD_TABLE_STR}"
+
+    if output_format == "arrow":
+        # the main process only reads (and frees) the shared memory block it named
+        shm_name = result_block_name()
+        output_str = f'{DUMP_TABLE_STR}\noutput = dump_table(output_df, {shm_name!r})'
+    else:
+        output_str = 'output = output_df.to_json(None, "records")'
 
-    import_str = "import pandas as pd\nimport json"
+    exec_str = f'''
+timings = {{}}
+stage_start = sandbox_clock()
+input_dfs = [load_table(data) for data in table_list]
+timings["build_dataframe"] = sandbox_clock() - stage_start
+
+stage_start = sandbox_clock()
+output_df = transform_data(*input_dfs)
+timings["transform"] = sandbox_clock() - stage_start
+#print(output_df)
+
+stage_start = sandbox_clock()
+{output_str}
+timings["serialize_output"] = sandbox_clock() - stage_start
+#print(output)
+    '''
 
     script_str = f'{import_str}\n\n{code}{exec_str}'
 
-    sandbox_locals = dict((key, value) for key,value in locals().items() if value in allowed_objects) # copy.deepcopy() ## are all obj safely serialized?
-    parent_conn, child_conn = Pipe()
-    p = Process(target=ran_in_subprocess, args=(script_str, sandbox_locals, child_conn, 'output'))
-    p.start()
+    # large tables are handed over as read-only memory-mapped arrow files instead of pickled rows
+    with staged_tables(table_list) as table_list:
+        allowed_objects = [table_list]
+        sandbox_locals = dict((key, value) for key,value in locals().items() if value in allowed_objects) # copy.deepcopy() ## are all obj safely serialized?
+        result = run_script_in_sandbox(script_str, sandbox_locals, use_pool, limits, cancel)
+
+    if output_format == "arrow" and result['status'] == 'ok':
+        start = time.perf_counter()
+        try:
+            result['content'] = read_result_table(result['content'], shm_name)
+        except Exception as err:
+            result = {'status': 'error', 'content': f"Error: {type(err).__name__} - {str(err)}", 'timings': result['timings']}
+        result['timings']['receive_output'] = result['timings'].get('receive_output', 0) + time.perf_counter() - start
+    if output_format == "arrow":
+        discard_result_block(shm_name)
+    return result
 
-    result = parent_conn.recv()
-    p.join()
+
+def run_data_process_in_sandbox(code, table_rows, exec_str, use_pool=True, limits=None, row_range=None):
+    """given a concept derivatino function, execute the function on inputs to generate a new dataframe
+    exec_str sees the table as `table_rows` and the rows it should process as `row_range` ((start, stop) or None for all)"""
+
+    import_str = f"import pandas as pd\nimport json\nfrom time import perf_counter as sandbox_clock\n{LOAD_TABLE_STR}"
+
+    script_str = f'{import_str}\n\n{code}{exec_str}'
+
+    with staged_tables([table_rows]) as (table_rows,):
+        sandbox_locals = {'table_rows': table_rows, 'row_range': row_range}
+        return run_script_in_sandbox(script_str, sandbox_locals, use_pool, limits)
+
+
+# tables smaller than this are not worth splitting across sandbox workers
+MIN_PARTITION_ROWS = 20000
+
+def partition_size(num_rows, num_workers):
+    """rows per chunk: about two chunks per worker (to even out stragglers), never below MIN_PARTITION_ROWS"""
+    return max(MIN_PARTITION_ROWS, math.ceil(num_rows / (2 * num_workers)))
+
+
+# names of the sandbox script that give access to the whole table
+TABLE_NAMES = {"df", "table_rows", "row_range", "load_table"}
+# methods that change a container in place
+MUTATING_METHODS = {"append", "add", "update", "pop", "popitem", "setdefault", "extend", "insert", "remove", "clear",
+                    "discard", "sort", "reverse"}
+
+def is_row_local(code, func_name, table_param_index=None):
+    """whether func_name in code only looks at the row it is given, i.e. neither it nor any module-level function
+    it calls reads its whole-table parameter (at table_param_index), the script-level `df` or the table itself,
+    and it keeps no state across rows: module-level names it uses must be functions, imports or literal constants
+    that are never changed in place, and no module-level statement may read the table.
+    Unparsable or unusual code counts as not row-local"""
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return False
+
+    functions = {}
+    constants = set()
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            if node.name in functions:
+                return False
+            functions[node.name] = node
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            continue
+        elif isinstance(node, ast.Assign) and all(isinstance(t, ast.Name) for t in node.targets) \
+                and all(isinstance(n, (ast.Constant, ast.Tuple, ast.List, ast.Set, ast.Dict, ast.Load, ast.UnaryOp, ast.USub))
+                        for n in ast.walk(node.value)):
+            constants.update(t.id for t in node.targets)
+        elif isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant):
+            continue  # docstrings
+        else:
+            # any other module-level statement (classes, computed values, code reading the table) may carry state
+            return False
+
+    func = functions.get(func_name)
+    if func is None or func.args.vararg or func.args.kwarg:
+        return False
+
+    params = [a.arg for a in func.args.posonlyargs + func.args.args]
+    table_param = None
+    if table_param_index is not None:
+        if len(params) <= table_param_index:
+            return False
+        table_param = params[table_param_index]
+
+    # walk func and every module-level function reachable from it, parameters shadow the script's names
+    reached, pending = {func_name}, [func]
+    while pending:
+        node_func = pending.pop()
+        arguments = node_func.args
+        table_names = TABLE_NAMES - {a.arg for a in arguments.posonlyargs + arguments.args + arguments.kwonlyargs}
+        if node_func is func and table_param is not None:
+            table_names = table_names | {table_param}
+        for node in ast.walk(node_func):
+            if isinstance(node, (ast.Global, ast.Nonlocal)):
+                return False
+            if isinstance(node, ast.Name):
+                if node.id in table_names:
+                    return False
+                if node.id in ("globals", "locals", "vars", "eval", "exec"):
+                    return False
+                if node.id in functions and node.id not in reached:
+                    reached.add(node.id)
+                    pending.append(functions[node.id])
+            if isinstance(node, (ast.Subscript, ast.Attribute)) and isinstance(node.ctx, (ast.Store, ast.Del)) \
+                    and isinstance(node.value, ast.Name) and node.value.id in constants:
+                return False
+            if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and isinstance(node.func.value, ast.Name) \
+                    and node.func.value.id in constants and node.func.attr in MUTATING_METHODS:
+                return False
+    return True
+
+
+def run_partitioned_in_sandbox(code, table_rows, exec_str, limits=None):
+    """run a row-local exec_str over consecutive row chunks of the table on the worker pool,
+    the json records outputs are concatenated in the original row order"""
+    start = time.perf_counter()
+    pool = get_sandbox_pool()
+    chunk_size = partition_size(len(table_rows), pool.size)
+    if chunk_size >= len(table_rows):
+        return run_data_process_in_sandbox(code, table_rows, exec_str, limits=limits)
+
+    ranges = [(start, min(start + chunk_size, len(table_rows))) for start in range(0, len(table_rows), chunk_size)]
+
+    # a staged table is shared by all chunks (each worker slices its rows), plain rows are split up front
+    with staged_tables([table_rows]) as (staged,):
+        def run_chunk(row_range):
+            if isinstance(staged, str):
+                return run_data_process_in_sandbox(code, staged, exec_str, limits=limits, row_range=row_range)
+            return run_data_process_in_sandbox(code, table_rows[row_range[0]:row_range[1]], exec_str, limits=limits)
+
+        with ThreadPoolExecutor(max_workers=pool.size) as executor:
+            results = list(executor.map(run_chunk, ranges))
+
+    for result in results:
+        if result['status'] != 'ok':
+            return result
+
+    chunks = [result['content'][1:-1] for result in results if result['content'] != '[]']
+    # stage timings are the slowest partition's, peak_rss_increase the largest worker's
+    timings = {}
+    for result in results:
+        for stage, value in result['timings'].items():
+            timings[stage] = max(timings.get(stage, 0), value)
+    timings['total'] = time.perf_counter() - start
+    return {'status': 'ok', 'content': '[' + ','.join(chunks) + ']', 'mode': results[0].get('mode'), 'partitions': len(results), 'timings': timings}
+
+
+# rows used to find out which contract (vectorized / row-wise) the code follows before partitioning
+CONTRACT_PROBE_ROWS = 1000
+
+def run_row_local_in_sandbox(code, table_rows, build_exec_str, mode, row_local):
+    """partitioned execution of derive / filter helpers: row-wise code that is row-local is split across the
+    worker pool, everything else (vectorized code may aggregate over whole columns) runs as a single partition"""
+    if not row_local:
+        return run_data_process_in_sandbox(code, table_rows, build_exec_str(mode))
+
+    if mode == "auto":
+        probe = run_data_process_in_sandbox(code, table_rows[:CONTRACT_PROBE_ROWS], build_exec_str("auto"))
+        if probe['status'] != 'ok':
+            return probe
+        if probe.get('mode') == "vectorized":
+            # checked against the row-wise output again, on probe rows of the whole table
+            return run_data_process_in_sandbox(code, table_rows, build_exec_str("auto"))
+        mode = "rowwise"
+
+    if mode == "vectorized":
+        return run_data_process_in_sandbox(code, table_rows, build_exec_str(mode))
+    return run_partitioned_in_sandbox(code, table_rows, build_exec_str("rowwise"))
+
+# code made available to derive / filter scripts: runs the function under the vectorized contract (whole columns in,
+# a series / boolean mask aligned with df out), returns None when the code does not follow it (unless mode forces it).
+# In "auto" mode the vectorized result is only kept when it agrees with rowwise(probe_df), the row-wise output, on
+# probe rows: the leading rows, the first null of every column and random rows. Code that follows the contract by
+# accident (e.g. `x if x is not None else "unknown"` or `x.lower() if isinstance(x, str) else x`, which hand whole
+# columns back unchanged) is run row-wise.
+VECTORIZED_CALL_STR = '''
+def probe_positions(df, size=100):
+    import numpy as np
+    picked = set(range(min(size, len(df))))
+    for name in df.columns:
+        nulls = df[name].isna().to_numpy()
+        if nulls.any():
+            picked.add(int(nulls.argmax()))
+    if len(df) > 0:
+        picked.update(np.random.default_rng(0).integers(0, len(df), size=size).tolist())
+    return sorted(picked)
+
+def same_values(left, right):
+    import math
+    for a, b in zip(left, right):
+        if pd.api.types.is_scalar(a) and pd.api.types.is_scalar(b) and pd.isna(a) and pd.isna(b):
+            continue
+        if isinstance(a, float) and isinstance(b, float) and math.isclose(a, b, rel_tol=1e-9):
+            continue
+        try:
+            if not bool(a == b):
+                return False
+        except (TypeError, ValueError):
+            return False
+    return True
+
+def call_vectorized(fn, args, df, mode, rowwise=None, is_mask=False):
+    import numpy as np
+    if mode == "rowwise":
+        return None
+    try:
+        result = fn(*args)
+    except Exception:
+        if mode == "vectorized":
+            raise
+        return None
+
+    if isinstance(result, pd.Series):
+        valid = result.index.equals(df.index) and (not is_mask or result.dtype == bool)
+    elif isinstance(result, np.ndarray):
+        valid = result.ndim == 1 and len(result) == len(df) and (not is_mask or result.dtype == bool)
+    else:
+        valid = False
+
+    if not valid:
+        if mode == "vectorized":
+            raise TypeError(f"expected a {'boolean mask' if is_mask else 'series'} with one value per row, got {type(result).__name__}")
+        return None
+
+    if mode == "auto" and rowwise is not None and len(df) > 0:
+        positions = probe_positions(df)
+        try:
+            expected = rowwise(df.iloc[positions])
+        except Exception:
+            return None
+        if not same_values(pd.Series(result).iloc[positions].tolist(), pd.Series(expected).tolist()):
+            return None
     return result
+'''
 
-def run_derive_data_in_sandbox2020(code, field_names, output_field_name, table_rows):
-    """given a concept derivatino function, execute the function on inputs to generate a new dataframe"""
+
+@cached_sandbox_call('table_rows')
+def run_derive_data_in_sandbox2020(code, field_names, output_field_name, table_rows, mode="rowwise", partitioned=False):
+    """given a concept derivatino function, execute the function on inputs to generate a new dataframe
+    mode: "vectorized" calls derive once with whole columns (pd.Series) and expects a series back,
+          "rowwise" calls derive once per row with scalar values,
+          "auto" tries the vectorized contract first and falls back to row-wise when the code does not follow it,
+          or when its output differs from the row-wise one on probe rows (see VECTORIZED_CALL_STR)
+    partitioned: split row-wise, row-local derivations across the sandbox worker pool
+    """
     
     arg_list = ", ".join([f'r["{name}"]' for name in field_names])
+    column_list = ", ".join([f'df["{name}"].copy()' for name in field_names])
 
-    exec_str = f'''
-df = pd.DataFrame.from_records(table_rows)
+    build_exec_str = lambda mode: f'''
+{VECTORIZED_CALL_STR}
+timings = {{}}
+stage_start = sandbox_clock()
+df = load_table(table_rows, row_range)
+timings["build_dataframe"] = sandbox_clock() - stage_start
+
+stage_start = sandbox_clock()
 app_func = lambda r: derive({arg_list})
-df["{output_field_name}"] = df.apply(app_func, axis = 1)
+derived = call_vectorized(derive, [{column_list}], df, "{mode}", lambda probe_df: probe_df.apply(app_func, axis = 1))
+exec_mode = "rowwise" if derived is None else "vectorized"
+if derived is None:
+    derived = df.apply(app_func, axis = 1)
+df["{output_field_name}"] = derived
+timings["transform"] = sandbox_clock() - stage_start
+
+stage_start = sandbox_clock()
 output = df.to_json(None, "records")
+timings["serialize_output"] = sandbox_clock() - stage_start
 #print(output)
     '''
 
-    return run_data_process_in_sandbox(code, table_rows, exec_str)
+    if partitioned:
+        return run_row_local_in_sandbox(code, table_rows, build_exec_str, mode, is_row_local(code, "derive"))
+    return run_data_process_in_sandbox(code, table_rows, build_exec_str(mode))
 
 
 
-def run_generic_derive_data_in_sandbox2020(code, field_names, output_field_name, table_rows):
-    """given a concept derivatino function, execute the function on inputs to generate a new dataframe"""
+@cached_sandbox_call('table_rows')
+def run_generic_derive_data_in_sandbox2020(code, field_names, output_field_name, table_rows, partitioned=False):
+    """given a concept derivatino function, execute the function on inputs to generate a new dataframe
+    partitioned: split the rows across the sandbox worker pool, unless derive reads the whole df"""
     
     exec_str = f'''
-df = pd.DataFrame.from_records(table_rows)
+timings = {{}}
+stage_start = sandbox_clock()
+df = load_table(table_rows, row_range)
+timings["build_dataframe"] = sandbox_clock() - stage_start
+
+stage_start = sandbox_clock()
 app_func = lambda r: derive(r, df)
 df["{output_field_name}"] = df.apply(app_func, axis = 1)
+timings["transform"] = sandbox_clock() - stage_start
+
+stage_start = sandbox_clock()
 output = df.to_json(None, "records")
+timings["serialize_output"] = sandbox_clock() - stage_start
 #print(output)
     '''
 
+    if partitioned:
+        return run_row_local_in_sandbox(code, table_rows, lambda mode: exec_str, "rowwise", is_row_local(code, "derive", 1))
     return run_data_process_in_sandbox(code, table_rows, exec_str)
 
 
 
-def run_filter_data_in_sandbox2020(code, table_rows):
-    """given a concept derivatino function, execute the function on inputs to generate a new dataframe"""
+@cached_sandbox_call('table_rows')
+def run_filter_data_in_sandbox2020(code, table_rows, mode="rowwise", partitioned=False):
+    """given a concept derivatino function, execute the function on inputs to generate a new dataframe
+    mode: "vectorized" calls filter_row(df, df) once and expects a boolean mask aligned with df,
+          "rowwise" calls filter_row(r, df) once per row,
+          "auto" tries the vectorized contract first and falls back to row-wise when the code does not follow it,
+          or when its output differs from the row-wise one on probe rows (see VECTORIZED_CALL_STR)
+    partitioned: split row-wise filters that do not read the whole df across the sandbox worker pool
+    """
+
+    build_exec_str = lambda mode: f'''
+{VECTORIZED_CALL_STR}
+timings = {{}}
+stage_start = sandbox_clock()
+df = load_table(table_rows, row_range)
+timings["build_dataframe"] = sandbox_clock() - stage_start
 
-    exec_str = f'''
-df = pd.DataFrame.from_records(table_rows)
+stage_start = sandbox_clock()
 filter_fn = lambda r: filter_row(r, df)
-filter_boolean = df.apply(filter_fn, axis=1)
+filter_boolean = call_vectorized(filter_row, [df.copy(), df], df, "{mode}", lambda probe_df: probe_df.apply(filter_fn, axis=1), is_mask=True)
+exec_mode = "rowwise" if filter_boolean is None else "vectorized"
+if filter_boolean is None:
+    filter_boolean = df.apply(filter_fn, axis=1)
 
 df_out = df[filter_boolean]
+timings["transform"] = sandbox_clock() - stage_start
 
+stage_start = sandbox_clock()
 output = df_out.to_json(None, "records")
+timings["serialize_output"] = sandbox_clock() - stage_start
 #print(output)
     '''
 
-    return run_data_process_in_sandbox(code, table_rows, exec_str)
\ No newline at end of file
+    if partitioned:
+        return run_row_local_in_sandbox(code, table_rows, build_exec_str, mode, is_row_local(code, "filter_row", 1))
+    return run_data_process_in_sandbox(code, table_rows, build_exec_str(mode))
@@ -0,0 +1,208 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Content-addressed cache of sandbox results.
+
+Results are keyed by the sandbox entry point, the normalized code (comments and formatting do not matter),
+the entry point's other arguments and a fingerprint of every input table. A hit returns the stored result
+without staging data or touching a sandbox process.
+There is an in-memory LRU tier and an optional on-disk Parquet tier (for dataframe results, needs pyarrow),
+both evicted by size. Only successful results are cached.
+"""
+
+import ast
+import collections
+import functools
+import glob
+import hashlib
+import inspect
+import os
+import threading
+import time
+
+import pandas as pd
+
+from data_formulator.sandbox_io import pa, table_fingerprint
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# arguments that change how a result is computed, not what it is
+NON_KEY_ARGUMENTS = {'use_pool', 'limits', 'partitioned', 'cancel'}
+
+
+def normalize_code(code):
+    """canonical form of python code: comments, blank lines and formatting are dropped"""
+    try:
+        return ast.unparse(ast.parse(code))
+    except SyntaxError:
+        return code.strip()
+
+
+def result_size(result):
+    content = result.get('content')
+    if isinstance(content, pd.DataFrame):
+        return int(content.memory_usage(index=False, deep=True).sum())
+    return len(str(content))
+
+
+def copy_result(result):
+    """results are handed out as copies, so that callers modifying them do not alter the cache"""
+    result = dict(result)
+    if isinstance(result.get('content'), pd.DataFrame):
+        result['content'] = result['content'].copy()
+    return result
+
+
+class SandboxResultCache(object):
+    """LRU result cache bounded by max_bytes in memory, spilling dataframe results to Parquet files in
+    disk_dir (bounded by max_disk_bytes) when a directory is given"""
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, disk_dir=None, max_disk_bytes=2 * 1024 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir if pa is not None else None
+        self.max_disk_bytes = max_disk_bytes
+        self.enabled = True
+
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if self.disk_dir is not None:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return copy_result(self._entries[key][0])
+
+        result = self._read_disk(key)
+        with self._lock:
+            if result is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+        self._put_memory(key, result)
+        return copy_result(result)
+
+    def put(self, key, result):
+        if result.get('status') != 'ok':
+            return
+        result = copy_result(result)
+        result.pop('timings', None)
+        self._put_memory(key, result)
+        self._write_disk(key, result)
+
+    def _put_memory(self, key, result):
+        size = result_size(result)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (result, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.parquet")
+
+    def _read_disk(self, key):
+        if self.disk_dir is None or not os.path.exists(self._disk_path(key)):
+            return None
+        try:
+            content = pd.read_parquet(self._disk_path(key))
+        except Exception as e:
+            logger.warning(f"unreadable sandbox cache entry {key}: {e}")
+            return None
+        os.utime(self._disk_path(key))  # mark as recently used
+        return {'status': 'ok', 'content': content}
+
+    def _write_disk(self, key, result):
+        if self.disk_dir is None or not isinstance(result['content'], pd.DataFrame):
+            return
+        try:
+            result['content'].to_parquet(self._disk_path(key), index=False)
+        except Exception as e:
+            logger.info(f"sandbox result not cached on disk: {e}")
+            return
+
+        files = sorted(glob.glob(os.path.join(self.disk_dir, "*.parquet")), key=os.path.getmtime)
+        total = sum(os.path.getsize(f) for f in files)
+        while files and total > self.max_disk_bytes:
+            oldest = files.pop(0)
+            total -= os.path.getsize(oldest)
+            os.remove(oldest)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+        if self.disk_dir is not None:
+            for f in glob.glob(os.path.join(self.disk_dir, "*.parquet")):
+                os.remove(f)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+            }
+
+
+result_cache = SandboxResultCache(disk_dir=os.environ.get("DATA_FORMULATOR_SANDBOX_CACHE_DIR"))
+
+def configure_result_cache(max_bytes=256 * 1024 * 1024, disk_dir=None, max_disk_bytes=2 * 1024 * 1024 * 1024):
+    """replace the process-wide sandbox result cache with one using the given settings"""
+    global result_cache
+    result_cache = SandboxResultCache(max_bytes, disk_dir, max_disk_bytes)
+    return result_cache
+
+
+def cached_sandbox_call(*table_params):
+    """cache the results of a sandbox entry point, table_params name its arguments holding json-records tables
+    (a parameter named like `table_list` holds a list of tables)"""
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            cache = result_cache
+            if not cache.enabled:
+                return func(*args, **kwargs)
+
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key_parts = [func.__name__]
+            for name, value in bound.arguments.items():
+                if name in NON_KEY_ARGUMENTS:
+                    continue
+                if name == 'code':
+                    value = normalize_code(value)
+                elif name in table_params:
+                    value = [table_fingerprint(t) for t in value] if name.endswith('_list') else table_fingerprint(value)
+                key_parts.append((name, value))
+            key = hashlib.sha256(repr(key_parts).encode()).hexdigest()
+
+            start = time.perf_counter()
+            result = cache.get(key)
+            if result is not None:
+                result['cache_hit'] = True
+                result['timings'] = {'total': time.perf_counter() - start}
+                return result
+            result = func(*args, **kwargs)
+            cache.put(key, result)
+            return result
+        return wrapper
+    return decorator
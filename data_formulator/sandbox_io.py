@@ -0,0 +1,440 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Columnar hand-off of tables between the main process and the sandbox.
+
+Input tables are written once by the main process into read-only, memory-mapped Arrow IPC files,
+the sandbox maps them straight into DataFrames instead of receiving pickled row dicts.
+Results can travel back the same way: the sandbox writes the output DataFrame as an Arrow IPC stream
+into a shared memory block, named by the main process for each execution, which the main process reads and frees.
+pyarrow is optional: without it (or for tables arrow cannot represent) rows are pickled / json encoded as before.
+"""
+
+import atexit
+import collections
+import contextlib
+import hashlib
+import itertools
+import json
+import os
+import secrets
+import shutil
+import sys
+import tempfile
+import threading
+import traceback
+
+from multiprocessing import resource_tracker, shared_memory
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+except ImportError:
+    pa = None
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# below this size pickling the rows is cheaper than staging a file
+ARROW_HANDOFF_MIN_ROWS = 10000
+
+# code made available to sandbox scripts: turns a staged table (file path) or plain rows into a DataFrame,
+# optionally only the rows in row_range = (start, stop)
+LOAD_TABLE_STR = '''
+def load_table(table, row_range=None):
+    if isinstance(table, str):
+        import pyarrow as pa
+        import pyarrow.ipc
+        arrow_table = pa.ipc.open_file(pa.memory_map(table, 'r')).read_all()
+        if row_range is not None:
+            arrow_table = arrow_table.slice(row_range[0], row_range[1] - row_range[0])
+        return arrow_table.to_pandas()
+    if row_range is not None:
+        table = table[row_range[0]:row_range[1]]
+    return pd.DataFrame.from_records(table)
+'''
+
+# code made available to sandbox scripts: packs the output DataFrame into an arrow ipc stream, placed in a new
+# shared memory block named shm_name (or inlined when /dev/shm is too small), json is the fallback for frames arrow
+# cannot type. Scripts define it after the generated code has run, so that the code cannot replace it
+DUMP_TABLE_STR = '''
+def dump_table(df, shm_name):
+    import os
+    try:
+        import pyarrow as pa
+        import pyarrow.ipc
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if any(pa.types.is_nested(field.type) for field in table.schema):
+            # list and dict cells would come back as numpy arrays and dicts with the keys of all the other rows
+            raise TypeError("nested columns")
+    except Exception:
+        return {'format': 'json', 'data': df.to_json(None, "records")}
+
+    mock = pa.MockOutputStream()
+    with pa.ipc.new_stream(mock, table.schema) as writer:
+        writer.write_table(table)
+    size = max(mock.size(), 1)
+
+    shm_stat = os.statvfs('/dev/shm') if os.path.isdir('/dev/shm') else None
+    if shm_stat is None or shm_stat.f_bavail * shm_stat.f_frsize < 2 * size:
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return {'format': 'arrow', 'data': sink.getvalue().to_pybytes()}
+
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name=shm_name, create=True, size=size)
+    def write(buf):
+        with pa.ipc.new_stream(pa.FixedSizeBufferWriter(pa.py_buffer(buf)), table.schema) as writer:
+            writer.write_table(table)
+    write(shm.buf)
+    shm.close()
+    return {'format': 'arrow', 'shm': shm.name, 'size': size}
+'''
+
+
+# rows of a table (evenly spaced, first and last included) that go into its store key
+KEY_SAMPLE_ROWS = 64
+
+
+def rows_digest(rows):
+    """a cheap digest of a few rows of a table, telling apart lists that reuse an identity or were changed in place"""
+    step = max(1, (len(rows) - 1) // (KEY_SAMPLE_ROWS - 1))
+    picked = [rows[i] for i in range(0, len(rows), step)][:KEY_SAMPLE_ROWS - 1] + rows[-1:]
+    return hashlib.blake2b(json.dumps(picked, sort_keys=True, default=str).encode(), digest_size=16).hexdigest()
+
+
+class TableStore(object):
+    """prepares json-records tables for the sandbox: a fingerprint of the content (for result caching), the column
+    dtypes and, once the table is staged, an Arrow IPC file in a private temp directory.
+    Entries are keyed by the identity and length of the rows list (which the store keeps a reference to, so that the
+    identity cannot be reused) plus a digest of a few of its rows, repeated executions on the same table (e.g. code
+    repair attempts) reuse them. A list changed in place gets a new entry, unless none of the rows in the digest
+    changed: tables should still not be mutated after they are prepared.
+    The store holds at most max_bytes (in-memory size of the row dicts it keeps, of the tables and of their arrow
+    files), least recently used tables are dropped first. A staged file is pinned by stage() until release(): executions reading it keep it in
+    place, even when the tables they stage together are larger than max_bytes."""
+
+    def __init__(self, max_bytes=512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        # concurrent executions on one table (candidates of one request) write its arrow file once
+        self._stage_lock = threading.Lock()
+        self._dir = None
+        self._counter = itertools.count()
+        # executions holding each staged file
+        self._pins = collections.Counter()
+
+    def __contains__(self, rows):
+        with self._lock:
+            return (id(rows), len(rows), rows_digest(rows)) in self._entries
+
+    def _prepare(self, rows, stage=False, df=None):
+        """the entry of rows, staged (and its file pinned) when stage is set. df: the DataFrame of rows, when the
+        caller has it already"""
+        key = (id(rows), len(rows), rows_digest(rows))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                if stage and entry.get('path') is not None:
+                    self._pins[entry['path']] += 1
+                if not stage or 'path' in entry:
+                    return entry
+
+        df = pd.DataFrame.from_records(rows) if df is None else df
+        if entry is None:
+            entry = {'rows': rows, 'fingerprint': frame_fingerprint(df, rows), 'dtypes': df.dtypes,
+                     'samples': {}, 'nbytes': rows_nbytes(rows) + frame_nbytes(df)}
+        if stage:
+            entry['path'] = self._write_arrow(df)
+            if entry['path'] is not None:
+                entry['nbytes'] += os.path.getsize(entry['path'])
+
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            if stage and entry['path'] is not None:
+                self._pins[entry['path']] += 1
+            self._evict()
+        return entry
+
+    def _evict(self):
+        """drop the least recently used entries (but the newest one) until the store fits in max_bytes, entries
+        whose file is pinned stay. Called with self._lock held"""
+        total = sum(e['nbytes'] for e in self._entries.values())
+        for key in list(self._entries)[:-1]:
+            if total <= self.max_bytes:
+                break
+            entry = self._entries[key]
+            if self._pins[entry.get('path')] > 0:
+                continue
+            del self._entries[key]
+            total -= entry['nbytes']
+            if entry.get('path') is not None:
+                os.remove(entry['path'])
+
+    def _write_arrow(self, df):
+        try:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError) as e:
+            logger.info(f"table not staged as arrow, falling back to rows: {e}")
+            return None
+        if any(pa.types.is_nested(field.type) for field in table.schema):
+            # list cells would come back as numpy arrays and dict cells with the keys of all the other rows
+            logger.info("table with nested columns not staged as arrow, falling back to rows")
+            return None
+
+        with self._lock:
+            if self._dir is None:
+                self._dir = tempfile.mkdtemp(prefix="df-sandbox-")
+            path = os.path.join(self._dir, f"table-{next(self._counter)}.arrow")
+
+        with pa.OSFile(path, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.chmod(path, 0o400)
+        return path
+
+    def stage(self, rows):
+        """return the path of a read-only arrow file holding rows, or None if the table is not staged.
+        The file stays in place until it is handed back with release(path)"""
+        if pa is None or len(rows) < ARROW_HANDOFF_MIN_ROWS:
+            return None
+        with self._stage_lock:
+            return self._prepare(rows, stage=True)['path']
+
+    def release(self, path):
+        """unpin a file returned by stage(), it can be dropped again once no execution holds it"""
+        with self._lock:
+            self._pins[path] -= 1
+            if self._pins[path] <= 0:
+                del self._pins[path]
+            self._evict()
+
+    def staged_path(self, rows):
+        """the arrow file of rows if it was staged already, without staging it"""
+        return self._prepare(rows).get('path')
+
+    def fingerprint(self, rows, df=None):
+        return self._prepare(rows, df=df)['fingerprint']
+
+    def dtypes(self, rows):
+        return self._prepare(rows)['dtypes']
+
+    def sample(self, rows, sample_size, seed=0):
+        entry = self._prepare(rows)
+        key = (sample_size, seed)
+        if key not in entry['samples']:
+            df = table_frame(rows)
+            sample = df.iloc[stratified_sample(df, sample_size, seed)].to_dict("records")
+            with self._lock:
+                entry['samples'][key] = sample
+        return entry['samples'][key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._pins.clear()
+            if self._dir is not None:
+                shutil.rmtree(self._dir, ignore_errors=True)
+                self._dir = None
+
+
+def rows_nbytes(rows):
+    """in-memory size of a json-records table (the list, its dicts and their values), estimated from about a
+    thousand evenly spaced rows"""
+    sample = rows[::max(1, len(rows) // 1000)]
+    sample_bytes = sum(sys.getsizeof(row) + sum(sys.getsizeof(v) for v in row.values())
+                       for row in sample if isinstance(row, dict))
+    return sys.getsizeof(rows) + int(sample_bytes * len(rows) / max(1, len(sample)))
+
+
+def frame_nbytes(df):
+    """in-memory size of df, estimated from about a thousand evenly spaced rows"""
+    sample = df.iloc[::max(1, len(df) // 1000)]
+    return int(sample.memory_usage(deep=True, index=False).sum() * len(df) / max(1, len(sample)))
+
+
+def frame_fingerprint(df, rows=None):
+    """a fast, order-sensitive content hash of a table (column names, dtypes and values). Object columns hash their
+    values by string form, the python types of their cells are hashed too (so that 1, "1" and True, "True" differ)"""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr([(str(name), str(dtype)) for name, dtype in df.dtypes.items()]).encode())
+    try:
+        h.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    except TypeError:
+        # unhashable cells (lists, dicts), hash the serialized rows instead
+        h.update(json.dumps(rows if rows is not None else df.to_dict("records"), sort_keys=True, default=str).encode())
+        return h.hexdigest()
+
+    for name, col in df.items():
+        if col.dtype != object:
+            continue
+        kind = pd.api.types.infer_dtype(col, skipna=True)
+        h.update(kind.encode())
+        if kind not in ('string', 'empty'):
+            cell_types = col.map(lambda v: type(v).__name__).to_numpy(dtype=object)
+            h.update(pd.util.hash_array(cell_types).tobytes())
+    return h.hexdigest()
+
+
+table_store = TableStore()
+atexit.register(table_store.clear)
+
+
+def table_fingerprint(rows, df=None):
+    """content fingerprint of a json-records table. df: its DataFrame if the caller built it already, used when the
+    table is not in the store yet"""
+    return table_store.fingerprint(rows, df)
+
+
+@contextlib.contextmanager
+def staged_tables(table_list):
+    """map every table to what is sent to the sandbox: a staged arrow file path, or the rows themselves.
+    The staged files are kept until the block exits, i.e. until the sandbox is done with them"""
+    staged, pinned = [], []
+    try:
+        for rows in table_list:
+            # already staged (and pinned by the caller)
+            if isinstance(rows, str):
+                staged.append(rows)
+                continue
+            path = table_store.stage(rows)
+            if path is not None:
+                pinned.append(path)
+            staged.append(path if path is not None else rows)
+        yield staged
+    finally:
+        for path in pinned:
+            table_store.release(path)
+
+
+def table_dtypes(rows):
+    """the dtypes of the DataFrame of a json-records table"""
+    return table_store.dtypes(rows)
+
+
+def table_frame(rows):
+    """the DataFrame of a json-records table, read back from its arrow file when it was staged already"""
+    path = table_store.staged_path(rows)
+    if path is not None:
+        try:
+            return pa.ipc.open_file(pa.memory_map(path, 'r')).read_all().to_pandas()
+        except FileNotFoundError:
+            # dropped from the store in the meantime
+            pass
+    return pd.DataFrame.from_records(rows)
+
+
+# columns with at most this many distinct values contribute a row for each of their values to a sample
+SAMPLE_STRATA_MAX_VALUES = 50
+# the cardinality of a column is first estimated on this many leading rows
+SAMPLE_STRATA_PROBE_ROWS = 10000
+
+def stratified_sample(df, sample_size, seed=0):
+    """positions of a small sample of df that exercises the code paths of the full table, in original row order:
+    the first and last rows, for every column its first null, empty string, minimum and maximum, a row for every
+    value of low-cardinality columns, filled up with random rows to sample_size"""
+    df = df.reset_index(drop=True)
+    picked = {0, len(df) - 1}
+    for name in df.columns:
+        col = df[name]
+        nulls = col.isna().to_numpy()
+        if nulls.any():
+            picked.add(int(nulls.argmax()))
+        if pd.api.types.is_numeric_dtype(col.dtype) or pd.api.types.is_datetime64_any_dtype(col.dtype):
+            if not nulls.all():
+                picked.update([int(col.idxmin()), int(col.idxmax())])
+        elif col.dtype == object:
+            empty = (col == "").to_numpy()
+            if empty.any():
+                picked.add(int(empty.argmax()))
+        try:
+            if (col.iloc[:SAMPLE_STRATA_PROBE_ROWS].nunique() <= SAMPLE_STRATA_MAX_VALUES
+                    and col.nunique() <= SAMPLE_STRATA_MAX_VALUES):
+                picked.update(np.flatnonzero(~col.duplicated().to_numpy()).tolist())
+        except TypeError:
+            # unhashable cells (lists, dicts)
+            pass
+
+    rng = np.random.default_rng(seed)
+    for i in rng.integers(0, len(df), size=2 * sample_size):
+        if len(picked) >= sample_size:
+            break
+        picked.add(int(i))
+    return sorted(picked)
+
+
+def sample_table(rows, sample_size, seed=0):
+    """json records of a stratified sample (see stratified_sample) of a json-records table, memoized with the table"""
+    if len(rows) <= sample_size:
+        return rows
+    return table_store.sample(rows, sample_size, seed)
+
+
+def prepare_result_channel():
+    """start the shared memory resource tracker before sandbox processes are forked, so that blocks created
+    by the sandbox and released by the main process are accounted by one tracker"""
+    if pa is not None:
+        resource_tracker.ensure_running()
+
+
+def result_block_name():
+    """a fresh name for the shared memory block of one execution's result"""
+    return f"df_result_{secrets.token_hex(8)}"
+
+
+def discard_result_block(shm_name):
+    """free the block shm_name if the sandbox created it but it was never read (failed or stopped executions)"""
+    try:
+        shm = shared_memory.SharedMemory(name=shm_name)
+    except FileNotFoundError:
+        return
+    shm.unlink()
+    shm.close()
+
+
+def read_shared_block(shm, size):
+    """the DataFrame of the arrow stream in the first size bytes of shm, no view into the block outlives the call"""
+    view = shm.buf[:size]
+    try:
+        df = pa.ipc.open_stream(pa.py_buffer(view)).read_all().to_pandas()
+    except Exception as err:
+        # the frames of the failed read still hold the arrow buffer over the view
+        traceback.clear_frames(err.__traceback__)
+        view.release()
+        raise
+    try:
+        view.release()
+    except BufferError:
+        # some columns (e.g. categorical codes) still point into the block, copy them out before it is unmapped
+        df = df.copy(deep=True)
+        view.release()
+    return df
+
+
+def read_result_table(content, shm_name=None):
+    """turn a handle produced by dump_table in the sandbox into a DataFrame, freeing its shared memory.
+    shm_name is the block the execution was given, handles naming any other block are rejected"""
+    if not isinstance(content, dict) or content.get('format') not in ('json', 'arrow'):
+        raise ValueError(f"unexpected sandbox result: {type(content).__name__}")
+
+    if content['format'] == 'json':
+        return pd.DataFrame.from_records(json.loads(content['data']))
+
+    if 'data' in content:
+        return pa.ipc.open_stream(pa.py_buffer(content['data'])).read_all().to_pandas()
+
+    if shm_name is None or content.get('shm') != shm_name:
+        raise ValueError("sandbox result names a shared memory block it was not given")
+    shm = shared_memory.SharedMemory(name=shm_name)
+    shm.unlink()
+    try:
+        return read_shared_block(shm, content['size'])
+    finally:
+        shm.close()
@@ -0,0 +1,236 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Static pre-flight checks of generated transformation code, run in the main process before any sandbox.
+
+The checks only report mistakes that are certain to fail in the sandbox: syntax errors, a missing
+transform_data or one taking the wrong number of tables, imports of modules the sandbox blocks or that are not
+installed, and unguarded reads of constant column names that the input table does not have (and the code does
+not create). Anything the checker cannot follow statically (reassigned frames, dynamic column names, in-place
+methods, ...) and reads the code guards itself (under an `in` test, inside a try) are let through.
+"""
+
+import ast
+import difflib
+import importlib.util
+import threading
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# modules the sandbox's audit hook blocks every use of (see py_sandbox.install_audit_hook), shutil is not among
+# them: only its copying, moving and removing functions are audited
+FORBIDDEN_MODULES = {'subprocess', 'winreg'}
+
+# DataFrame methods returning a frame with the same columns, `df = df.<method>(...)` keeps df's columns known
+COLUMN_PRESERVING_METHODS = {
+    'copy', 'sort_values', 'sort_index', 'dropna', 'fillna', 'drop_duplicates', 'head', 'tail', 'sample',
+    'query', 'astype', 'ffill', 'bfill', 'replace', 'round', 'abs', 'clip',
+}
+
+# DataFrame methods changing the columns of the frame they are called on
+MUTATING_METHODS = {'insert', 'pop', 'update', 'join', 'merge'}
+
+
+class TableColumns(object):
+    """the columns of a json records table: the first row's keys, all rows are only scanned when a column is
+    not among them (records may have heterogeneous keys)"""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.columns = list(rows[0].keys()) if len(rows) > 0 else []
+        self.complete = len(rows) <= 1
+
+    def __contains__(self, column):
+        if column in self.columns:
+            return True
+        if not self.complete:
+            self.columns = list(dict.fromkeys(key for row in self.rows for key in row))
+            self.complete = True
+        return column in self.columns
+
+
+def check_imports(tree):
+    errors = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            modules = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            modules = [node.module]
+        else:
+            continue
+        for module in modules:
+            top_level = module.split('.')[0]
+            if top_level in FORBIDDEN_MODULES:
+                errors.append(f"line {node.lineno}: '{module}' is blocked in the sandbox, "
+                              "only use pandas, numpy and the standard library modules needed for data processing")
+            elif importlib.util.find_spec(top_level) is None:
+                errors.append(f"line {node.lineno}: module '{module}' is not installed, use pandas and numpy instead")
+    return errors
+
+
+def assignment_targets(node):
+    if isinstance(node, ast.Assign):
+        return node.targets
+    if isinstance(node, (ast.AugAssign, ast.AnnAssign, ast.For, ast.AsyncFor, ast.NamedExpr, ast.comprehension)):
+        return [node.target]
+    if isinstance(node, (ast.With, ast.AsyncWith)):
+        return [item.optional_vars for item in node.items if item.optional_vars is not None]
+    return []
+
+
+def bound_names(target):
+    if isinstance(target, ast.Name):
+        return [target.id]
+    if isinstance(target, (ast.Tuple, ast.List)):
+        return [name for element in target.elts for name in bound_names(element)]
+    if isinstance(target, ast.Starred):
+        return bound_names(target.value)
+    return []
+
+
+def tracked_frames(func, params, helper_names):
+    """the parameters whose columns can be followed statically: names that are reassigned (other than through
+    a column preserving method or a row filter), shadowed, written through .loc / .columns / non-constant keys,
+    mutated in place or handed to helper functions are dropped"""
+    tracked = set(params)
+    for node in ast.walk(func):
+        for target in assignment_targets(node):
+            for name in bound_names(target):
+                if not preserves_columns(node, name):
+                    tracked.discard(name)
+            if isinstance(target, ast.Subscript) and isinstance(target.value, ast.Name) and constant_columns(target.slice) is None:
+                tracked.discard(target.value.id)
+            if isinstance(target, ast.Subscript) and isinstance(target.value, ast.Attribute) and isinstance(target.value.value, ast.Name):
+                tracked.discard(target.value.value.id)
+            if isinstance(target, ast.Attribute) and isinstance(target.value, ast.Name):
+                tracked.discard(target.value.id)
+
+        if node is not func and isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda)):
+            for arg in node.args.posonlyargs + node.args.args + node.args.kwonlyargs:
+                tracked.discard(arg.arg)
+
+        if isinstance(node, ast.Call):
+            if isinstance(node.func, ast.Attribute) and isinstance(node.func.value, ast.Name):
+                if node.func.attr in MUTATING_METHODS or any(k.arg == 'inplace' for k in node.keywords):
+                    tracked.discard(node.func.value.id)
+            if isinstance(node.func, ast.Name) and node.func.id in helper_names:
+                for arg in node.args:
+                    if isinstance(arg, ast.Name):
+                        tracked.discard(arg.id)
+    return tracked
+
+
+def preserves_columns(node, name):
+    """whether the assignment `name = <value>` keeps the columns of name"""
+    if not isinstance(node, ast.Assign) or len(node.targets) != 1 or not isinstance(node.targets[0], ast.Name):
+        return False
+    value = node.value
+    if (isinstance(value, ast.Call) and isinstance(value.func, ast.Attribute)
+            and isinstance(value.func.value, ast.Name) and value.func.value.id == name):
+        return value.func.attr in COLUMN_PRESERVING_METHODS
+    if isinstance(value, ast.Subscript) and isinstance(value.value, ast.Name) and value.value.id == name:
+        # df = df[mask] keeps all columns, df = df[["a", "b"]] does not
+        return constant_columns(value.slice) is None and not isinstance(value.slice, (ast.List, ast.Slice))
+    return False
+
+
+def constant_columns(node):
+    """the column names of a subscript like ["a"] or [["a", "b"]], None when they are not all string constants"""
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return [node.value]
+    if isinstance(node, ast.List) and len(node.elts) > 0 and all(isinstance(e, ast.Constant) and isinstance(e.value, str) for e in node.elts):
+        return [e.value for e in node.elts]
+    return None
+
+
+def has_membership_test(node):
+    return any(isinstance(n, ast.Compare) and any(isinstance(op, (ast.In, ast.NotIn)) for op in n.ops)
+               for n in ast.walk(node))
+
+
+def guarded_nodes(func):
+    """ids of the nodes that only run once a membership test (`if "a" in df.columns`) passed, or inside the body of
+    a try: a missing column there is expected and handled by the code"""
+    guarded = set()
+    for node in ast.walk(func):
+        if isinstance(node, (ast.If, ast.IfExp, ast.While)) and has_membership_test(node.test):
+            guarded.update(id(n) for n in ast.walk(node))
+        elif isinstance(node, ast.BoolOp) and any(has_membership_test(value) for value in node.values):
+            guarded.update(id(n) for n in ast.walk(node))
+        elif isinstance(node, ast.Try):
+            guarded.update(id(n) for statement in node.body for n in ast.walk(statement))
+    return guarded
+
+
+def check_columns(func, params, tables, helper_names):
+    errors = []
+    tracked = tracked_frames(func, params, helper_names)
+    guarded = guarded_nodes(func)
+    table_of = {name: tables[i] for i, name in enumerate(params) if name in tracked}
+
+    created = {name: set() for name in table_of}
+    for node in ast.walk(func):
+        if (isinstance(node, ast.Subscript) and isinstance(node.ctx, ast.Store)
+                and isinstance(node.value, ast.Name) and node.value.id in table_of):
+            created[node.value.id].update(constant_columns(node.slice) or [])
+
+    for node in ast.walk(func):
+        if not (isinstance(node, ast.Subscript) and isinstance(node.ctx, ast.Load)
+                and isinstance(node.value, ast.Name) and node.value.id in table_of) or id(node) in guarded:
+            continue
+        name = node.value.id
+        for column in constant_columns(node.slice) or []:
+            if column in created[name] or column in table_of[name]:
+                continue
+            available = table_of[name].columns
+            message = f"line {node.lineno}: column '{column}' does not exist in {name}"
+            suggestions = difflib.get_close_matches(column, [str(c) for c in available], n=1)
+            message += f", did you mean '{suggestions[0]}'?" if suggestions else "."
+            message += f" Available columns: {', '.join(str(c) for c in available)}"
+            errors.append(message)
+    return errors
+
+
+def check_transform_code(code, table_list, func_name='transform_data'):
+    """errors that executing code on the json records tables of table_list would certainly run into,
+    an empty list when none was found"""
+    try:
+        tree = ast.parse(code)
+    except SyntaxError as err:
+        return [f"SyntaxError: {err.msg} (line {err.lineno})"]
+
+    errors = check_imports(tree)
+
+    funcs = [node for node in tree.body if isinstance(node, ast.FunctionDef) and node.name == func_name]
+    if len(funcs) == 0:
+        return errors + [f"no top-level function named {func_name} is defined"]
+
+    args = funcs[-1].args
+    params = [a.arg for a in args.posonlyargs + args.args]
+    required = len(params) - len(args.defaults)
+    if args.vararg is None and not (required <= len(table_list) <= len(params)):
+        errors.append(f"{func_name} takes {len(params)} parameter(s) ({', '.join(params)}) "
+                      f"but is called with {len(table_list)} table(s), define it as "
+                      f"{func_name}({', '.join(['df'] if len(table_list) == 1 else [f'df{i + 1}' for i in range(len(table_list))])})")
+        return errors
+
+    tables = [TableColumns(rows) for rows in table_list]
+    helper_names = {node.name for node in ast.walk(tree) if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef))}
+    return errors + check_columns(funcs[-1], params[:len(tables)], tables, helper_names)
+
+
+_stats_lock = threading.Lock()
+_stats = {'checked': 0, 'rejected': 0}
+
+def record_check(errors):
+    with _stats_lock:
+        _stats['checked'] += 1
+        if errors:
+            _stats['rejected'] += 1
+
+def preflight_stats():
+    """codes checked and rejected by the pre-flight checks of this process, each rejection is a sandbox run avoided"""
+    with _stats_lock:
+        return {**_stats, 'sandbox_runs_avoided': _stats['rejected']}
@@ -7,6 +7,8 @@ class Inputs(typing.TypedDict):
     x_axis_name: str | None
     y_axis_name: str | None
     code_repair_attempts: int | None
+    time_limit_seconds: int | None
+    memory_limit_mb: int | None
     llm_model: LLMModelOptions
 class Outputs(typing.TypedDict):
     code_for_derive: str
@@ -17,17 +19,38 @@ class Outputs(typing.TypedDict):
     refined_y_axis_name: str
 #endregion
 
+import asyncio
 import logging
-from typing import Any, Dict, List, Optional, Tuple
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import pandas as pd
 
 from data_formulator.agents.agent_code_explanation import CodeExplanationAgent
 from data_formulator.agents.agent_data_transform_v2 import DataTransformationAgentV2
+from data_formulator.agents.agent_utils import dataframe_to_records
 from data_formulator.agents.client_utils import Client
+from data_formulator.agents.plan_cache import get_plan_cache, plan_key
 from oocana import Context
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
+# Sandbox statuses worth another attempt, and the hint sent back to the model for each of them
+REPAIR_HINTS = {
+    "error": "Focus on data type compatibility, column name accuracy, and proper error handling.",
+    "timeout": (
+        "The code was too slow and was stopped before finishing. "
+        "Avoid row-by-row loops, apply(axis=1), cross joins and other operations that grow quadratically; "
+        "prefer vectorized pandas operations."
+    ),
+    "oom": (
+        "The code used too much memory and was stopped. "
+        "Avoid cross joins, exploding rows or building large intermediate tables; "
+        "select only the needed columns and aggregate as early as possible."
+    ),
+}
+
 def _validate_inputs(params: Inputs) -> None:
     """Validate input parameters with enhanced checks"""
     # Check data presence and format
@@ -59,6 +82,12 @@ def _validate_inputs(params: Inputs) -> None:
     if repair_attempts is not None and (not isinstance(repair_attempts, int) or repair_attempts < 1):
         raise ValueError("code_repair_attempts must be a positive integer")
 
+    # Validate sandbox limits if provided
+    for name in ("time_limit_seconds", "memory_limit_mb"):
+        limit = params.get(name)
+        if limit is not None and (not isinstance(limit, int) or limit < 1):
+            raise ValueError(f"{name} must be a positive integer")
+
     # Validate LLM model configuration
     llm_model = params.get("llm_model", {})
     if not isinstance(llm_model, dict):
@@ -66,6 +95,14 @@ def _validate_inputs(params: Inputs) -> None:
 
     logger.info(f"Input validation successful: {len(data)} tables, instruction length: {len(instruction)}")
 
+def _sandbox_limits(params: Inputs) -> Dict[str, Optional[int]]:
+    """Budgets of the sandbox executions, unlimited unless set in the inputs"""
+    memory_mb = params.get("memory_limit_mb")
+    return {
+        "timeout": params.get("time_limit_seconds"),
+        "memory": memory_mb * 1024 * 1024 if memory_mb is not None else None,
+    }
+
 def _create_llm_client(params: Inputs, context: Context) -> Client:
     """Create LLM client with validation"""
     try:
@@ -92,35 +129,41 @@ def _create_llm_client(params: Inputs, context: Context) -> Client:
     except Exception as e:
         raise RuntimeError(f"Failed to create LLM client: {str(e)}")
 
-def _process_data_with_repair(
+async def _process_data_with_repair(
     agent: DataTransformationAgentV2,
     input_tables: List[Dict[str, Any]],
     instruction: str,
     expected_fields: List[str],
-    max_attempts: int
+    max_attempts: int,
+    on_code: Optional[Callable[[str], None]] = None
 ) -> Dict[str, Any]:
-    """Process data transformation with automatic error repair"""
+    """Process data transformation with automatic error repair, on_code is called with the code of every attempt
+    before it is executed"""
     logger.info(f"Starting data transformation with max {max_attempts} repair attempts")
 
     try:
-        # Initial transformation attempt
-        results = agent.run(input_tables, instruction, expected_fields, [], max_attempts)
+        # Initial transformation attempt, asking for max_attempts candidates in one round trip
+        results = await agent.arun(input_tables, instruction, expected_fields, [], max_attempts, on_code=on_code)
 
         if not results or len(results) == 0:
             raise RuntimeError("No results returned from data transformation agent")
 
-        result = results[0]
+        # candidates come back in choice order, the first one that executed successfully wins
+        result = next((r for r in results if r.get('status') == 'ok'), results[0])
+        logger.info(f"{sum(r.get('status') == 'ok' for r in results)} of {len(results)} candidates executed successfully")
         repair_attempts = 0
+        # codes rejected by the static pre-flight checks never reached a sandbox
+        sandbox_runs_avoided = sum(1 for r in results if r.get('preflight_errors'))
 
-        while result.get('status') == 'error' and repair_attempts < max_attempts:
+        while result.get('status') in REPAIR_HINTS and repair_attempts < max_attempts:
             error_message = result.get('content', 'Unknown error')
-            logger.warning(f"Code generation failed (attempt {repair_attempts + 1}): {error_message}")
+            logger.warning(f"Code generation failed (attempt {repair_attempts + 1}, status {result.get('status')}): {error_message}")
 
             # Create repair instruction
             repair_instruction = (
                 f"The following error occurred during code execution:\n\n{error_message}\n\n"
                 "Please analyze the error and fix the code to prevent similar issues. "
-                "Focus on data type compatibility, column name accuracy, and proper error handling."
+                f"{REPAIR_HINTS[result['status']]}"
             )
 
             prev_dialog = result.get('dialog', [])
@@ -130,7 +173,7 @@ def _process_data_with_repair(
 
             # Attempt repair
             logger.info(f"Attempting code repair (attempt {repair_attempts + 1})")
-            repair_results = agent.followup(input_tables, prev_dialog, expected_fields, repair_instruction)
+            repair_results = await agent.afollowup(input_tables, prev_dialog, expected_fields, repair_instruction, on_code=on_code)
 
             if not repair_results or len(repair_results) == 0:
                 logger.error("No results returned from repair attempt")
@@ -138,8 +181,13 @@ def _process_data_with_repair(
 
             result = repair_results[0]
             repair_attempts += 1
+            sandbox_runs_avoided += 1 if result.get('preflight_errors') else 0
 
-        if result.get('status') == 'error':
+        result['sandbox_runs_avoided'] = sandbox_runs_avoided
+        if sandbox_runs_avoided > 0:
+            logger.info(f"Pre-flight checks avoided {sandbox_runs_avoided} sandbox run(s)")
+
+        if result.get('status') in REPAIR_HINTS:
             final_error = result.get('content', 'Unknown error')
             raise RuntimeError(
                 f"Failed to generate valid code after {max_attempts} repair attempts. "
@@ -153,6 +201,40 @@ def _process_data_with_repair(
         logger.error(f"Data transformation failed: {str(e)}")
         raise RuntimeError(f"Data processing failed: {str(e)}")
 
+# Sandbox timing stages in execution order, with their display labels
+TIMING_STAGES = [
+    ("sample_run", "Sample-first run"),
+    ("spawn", "Process spawn / worker wait"),
+    ("send_input", "Input pickling"),
+    ("build_dataframe", "DataFrame construction"),
+    ("transform", "transform_data"),
+    ("serialize_output", "Output serialization"),
+    ("receive_output", "Result unpickling"),
+    ("total", "Total"),
+]
+
+def _format_timings(timings: Dict[str, Any]) -> str:
+    """Format sandbox execution timings as markdown list items"""
+    if not timings:
+        return "- No timing information available"
+
+    lines = [
+        f"- **{label}**: {timings[stage] * 1000:.1f} ms"
+        for stage, label in TIMING_STAGES if stage in timings
+    ]
+    if "peak_rss_increase" in timings:
+        lines.append(f"- **Sandbox peak RSS increase**: {timings['peak_rss_increase'] / (1024 * 1024):.1f} MB")
+    return "\n".join(lines)
+
+def _format_plan_cache(result: Dict[str, Any]) -> str:
+    """Describe whether the code came from the plan cache, with the cache's hit rate and time saved"""
+    stats = result.get('plan_cache')
+    if not stats:
+        return "- Plan cache disabled"
+    source = "Reused a cached plan for this instruction and schema" if result.get('plan_cache_hit') else "Generated a new plan and cached it"
+    return (f"- {source} (plan cache hit rate {stats['hit_rate']:.0%} over {stats['hits'] + stats['misses']} runs, "
+            f"{stats['seconds_saved']:.1f} s of generation saved)")
+
 def _generate_analysis_logic(
     input_tables: List[Dict[str, Any]],
     instruction: str,
@@ -204,6 +286,8 @@ def _generate_analysis_logic(
 
 ### 3. Quality Assurance
 {f"- Required {repair_attempts} code repair attempts" if repair_attempts > 0 else "- Code generated successfully on first attempt"}
+{_format_plan_cache(result)}
+{f"- Static pre-flight checks caught {result['sandbox_runs_avoided']} broken code(s) before execution, avoiding as many sandbox runs" if result.get('sandbox_runs_avoided') else "- Static pre-flight checks found no errors"}
 - Validated output data structure
 - Verified column mappings and data types
 
@@ -212,6 +296,9 @@ def _generate_analysis_logic(
 - **Output Columns**: {', '.join(result_columns)}
 - **Processing Status**: ✅ Successfully completed
 
+## ⏱️ Sandbox Execution Timings
+{_format_timings(result.get('timings', {}))}
+
 ## 🎨 Visualization Fields
 {f"- Suggested fields: {', '.join(refined_goal.get('visualization_fields', []))}" if refined_goal.get('visualization_fields') else "- No specific visualization fields identified"}
 
@@ -275,9 +362,37 @@ def _determine_axis_names(
     logger.info(f"Determined axis names - X: '{refined_x}', Y: '{refined_y}'")
     return refined_x, refined_y
 
-def main(params: Inputs, context: Context) -> Outputs:
+EXPLANATION_FAILED = "Code explanation generation failed"
+
+async def _explain_code(code_expl_agent: CodeExplanationAgent, input_tables: List[Dict[str, Any]], code: str) -> str:
+    """Generate the code explanation, a failure is reported in the explanation text"""
+    try:
+        return await code_expl_agent.arun(input_tables, code)
+    except Exception as e:
+        logger.warning(f"Failed to generate code explanation: {str(e)}")
+        return f"{EXPLANATION_FAILED}: {str(e)}"
+
+async def _run_cached_plan(
+    agent: DataTransformationAgentV2,
+    input_tables: List[Dict[str, Any]],
+    plan: Dict[str, Any]
+) -> Optional[Dict[str, Any]]:
+    """Execute the code of a cached plan, None when it does not run successfully on the current data"""
+    result = await asyncio.to_thread(agent.execute_code, input_tables, plan['code'])
+    if result.get('status') != 'ok':
+        logger.info(f"Cached plan failed on the current data ({result.get('status')}), generating a new one")
+        return None
+
+    # the axis names come from the visualization fields cached with the code, as on the run that generated it
+    result['refined_goal'] = {'visualization_fields': plan['visualization_fields']}
+    result['dialog'] = []
+    result['plan_cache_hit'] = True
+    return result
+
+async def main(params: Inputs, context: Context) -> Outputs:
     """Main function to process data transformation with comprehensive error handling"""
     logger.info("Starting derive-data task execution")
+    explanations: Dict[str, asyncio.Task] = {}
 
     try:
         # Validate input parameters
@@ -286,7 +401,7 @@ def main(params: Inputs, context: Context) -> Outputs:
         # Extract parameters with defaults
         input_tables = params["data"]
         instruction = params["instruction"]
-        max_repair_attempts = params.get("code_repair_attempts", 3)
+        max_repair_attempts = params.get("code_repair_attempts") or 3
         x_axis_name = params.get("x_axis_name")
         y_axis_name = params.get("y_axis_name")
 
@@ -301,12 +416,37 @@ def main(params: Inputs, context: Context) -> Outputs:
 
         # Create data transformation agent and process
         logger.info("Creating data transformation agent")
-        agent = DataTransformationAgentV2(client=llm_client)
+        # Results stay columnar (arrow) until here, the task boundary, where they become records
+        agent = DataTransformationAgentV2(client=llm_client, output_format="arrow", sample_first=True,
+                                          limits=_sandbox_limits(params))
+        code_expl_agent = CodeExplanationAgent(client=llm_client)
+
+        # Explain every generated code while the sandbox executes it, only the explanation of the final code is kept
+        def explain_code(code: str) -> None:
+            if code not in explanations:
+                explanations[code] = asyncio.ensure_future(_explain_code(code_expl_agent, input_tables, code))
+
+        # Reuse the plan of an earlier run with the same instruction and table schemas, the LLM is only called
+        # when there is none or its code fails on the current data
+        start = time.perf_counter()
+        plan_cache = get_plan_cache()
+        cache_key = plan_key(instruction, expected_fields, [t['rows'] for t in input_tables]) if plan_cache else None
+        plan = plan_cache.get(cache_key) if plan_cache else None
+        if plan and plan['explanation'] is None:
+            explain_code(plan['code'])
+        result = await _run_cached_plan(agent, input_tables, plan) if plan else None
+        if plan and result is None:
+            plan_cache.invalidate(cache_key)
+            plan = None
 
         # Process data with automatic repair
-        result = _process_data_with_repair(
-            agent, input_tables, instruction, expected_fields, max_repair_attempts
-        )
+        if result is None:
+            result = await _process_data_with_repair(
+                agent, input_tables, instruction, expected_fields, max_repair_attempts, explain_code
+            )
+        logger.info(f"Sandbox execution timings: {result.get('timings', {})}")
+        if isinstance(result.get('content'), pd.DataFrame):
+            result['content'] = dataframe_to_records(result['content'])
 
         # Extract results with validation
         code = result.get('code')
@@ -326,12 +466,26 @@ def main(params: Inputs, context: Context) -> Outputs:
 
         # Generate code explanation
         logger.info("Generating code explanation")
-        try:
-            code_expl_agent = CodeExplanationAgent(client=llm_client)
-            code_explain = code_expl_agent.run(input_tables, code)
-        except Exception as e:
-            logger.warning(f"Failed to generate code explanation: {str(e)}")
-            code_explain = f"Code explanation generation failed: {str(e)}"
+        if plan and plan['explanation'] is not None:
+            code_explain = plan['explanation']
+        else:
+            explain_code(code)
+            code_explain = await explanations[code]
+
+        if plan_cache:
+            elapsed = time.perf_counter() - start
+            # a failed explanation is not cached, the next hit generates it again
+            explanation = None if code_explain.startswith(EXPLANATION_FAILED) else code_explain
+            if plan:
+                plan_cache.record(hit=True, seconds_saved=plan['generation_seconds'] - elapsed)
+                if plan['explanation'] is None and explanation is not None:
+                    plan_cache.put(cache_key, code, plan['generation_seconds'], plan['visualization_fields'], explanation)
+            else:
+                visualization_fields = result.get('refined_goal', {}).get('visualization_fields', [])
+                plan_cache.put(cache_key, code, elapsed, visualization_fields, explanation)
+                plan_cache.record(hit=False)
+            result['plan_cache'] = plan_cache.stats()
+            logger.info(f"Plan cache {'hit' if plan else 'miss'}, stats: {result['plan_cache']}")
 
         # Generate analysis logic
         logger.info("Generating analysis logic")
@@ -361,4 +515,8 @@ def main(params: Inputs, context: Context) -> Outputs:
         raise RuntimeError(str(e))
     except Exception as e:
         logger.error(f"Unexpected error in derive-data task: {str(e)}")
-        raise RuntimeError(f"Data derivation failed: {str(e)}") 
\ No newline at end of file
+        raise RuntimeError(f"Data derivation failed: {str(e)}")
+    finally:
+        # explanations of code that was repaired (or of a failed run) are not needed anymore
+        for task in explanations.values():
+            task.cancel() 
\ No newline at end of file
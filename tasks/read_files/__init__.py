@@ -1,25 +1,98 @@
-import json
+import multiprocessing
 import os
-from typing import Any, Dict, List
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import partial
+from typing import Any, Dict, List, Tuple
 
+import numpy as np
 import pandas as pd
 from oocana import Context
 
+from data_formulator.agents.agent_utils import dataframe_to_records
+from data_formulator.csv_reader import cached_dtypes, read_csv, schema_fits
+
 #region generated meta
 import typing
 class Inputs(typing.TypedDict):
     tables: list[str]
     enable_preview: bool
+    max_rows: int | None
+    sample_rows: int | None
+    usecols: list[str] | None
 class Outputs(typing.TypedDict):
     output: list[dict]
+    file_stats: list[dict]
 #endregion
 
 # 支持的文件扩展名
 SUPPORTED_EXTENSIONS = {'.xlsx', '.xls', '.csv'}
+# openpyxl / xlrd 是纯 Python 实现，解析时一直持有 GIL，多个 Excel 文件要在多个进程中才能并行解析
+EXCEL_EXTENSIONS = {'.xlsx', '.xls'}
+
+# 同时读取的文件在内存中的总占用上限（字节）
+READ_MEMORY_BUDGET = 2 * 1024 ** 3
+# 读入的 DataFrame 加上转换出的 JSON 记录，大约是文件大小的多少倍
+MEMORY_PER_FILE_BYTE = 10
+# 小于这个大小的文件读取时间主要花在 I/O 上，可以多开一些线程
+SMALL_FILE_BYTES = 1024 ** 2
+
+# 流式读取 CSV 时每块的行数
+CSV_CHUNK_ROWS = 100000
+
+
+def reservoir_sample_chunks(chunks, sample_rows: int, seed: int = 0) -> pd.DataFrame:
+    """对逐块读入的行做蓄水池抽样（Algorithm R），内存中只保留 sample_rows 行，结果按原始行顺序排列"""
+    rng = np.random.default_rng(seed)
+    reservoir = None
+    seen = 0
+    for chunk in chunks:
+        positions = np.arange(seen, seen + len(chunk))
+        # 第 i 行（从 0 开始）以 sample_rows / (i + 1) 的概率替换蓄水池中随机的一格，前 sample_rows 行直接填入
+        slots = np.where(positions < sample_rows, positions, rng.integers(0, positions + 1))
+        accepted = slots < sample_rows
+        seen += len(chunk)
+        if not accepted.any():
+            continue
+
+        kept = chunk[accepted].assign(__slot=slots[accepted], __position=positions[accepted])
+        reservoir = kept if reservoir is None else pd.concat([reservoir, kept], ignore_index=True)
+        # 同一格被多次替换时保留最后一次
+        reservoir = reservoir.drop_duplicates("__slot", keep="last")
+
+    if reservoir is None:
+        return pd.DataFrame()
+    return reservoir.sort_values("__position").drop(columns=["__slot", "__position"]).reset_index(drop=True)
 
 
-def read_file_to_dataframe(file_path: str) -> pd.DataFrame:
-    """读取文件到DataFrame"""
+def read_csv_streaming(file_path: str, max_rows: int | None, sample_rows: int | None, usecols: List[str] | None) -> pd.DataFrame:
+    """分块读取 CSV：最多读 max_rows 行，指定 sample_rows 时只保留抽样的行，内存占用与文件大小无关"""
+    # 使用上次推断出的列类型，各块的类型保持一致；类型不再适用时重新推断
+    dtypes = cached_dtypes(file_path)
+    if dtypes is not None:
+        try:
+            df = read_csv_chunks(file_path, max_rows, sample_rows, usecols, dtypes)
+            if schema_fits(df):
+                return df
+        except ValueError:
+            pass
+    return read_csv_chunks(file_path, max_rows, sample_rows, usecols, None)
+
+
+def read_csv_chunks(file_path: str, max_rows: int | None, sample_rows: int | None, usecols: List[str] | None,
+                    dtypes: Dict[str, str] | None) -> pd.DataFrame:
+    chunks = pd.read_csv(file_path, usecols=usecols, nrows=max_rows, chunksize=CSV_CHUNK_ROWS, dtype=dtypes)
+    with chunks:
+        if sample_rows:
+            return reservoir_sample_chunks(chunks, sample_rows)
+        return pd.concat(list(chunks), ignore_index=True)
+
+
+def read_file_to_dataframe(file_path: str, max_rows: int | None = None, sample_rows: int | None = None,
+                           usecols: List[str] | None = None, excel_pool: Executor | None = None) -> pd.DataFrame:
+    """读取文件到DataFrame，可选只读前 max_rows 行、随机抽取 sample_rows 行、只读 usecols 中的列，
+    指定 excel_pool 时 Excel 文件在其中的进程里解析"""
     file_ext = os.path.splitext(file_path)[1].lower()
     
     if file_ext not in SUPPORTED_EXTENSIONS:
@@ -30,9 +103,19 @@ def read_file_to_dataframe(file_path: str) -> pd.DataFrame:
     
     try:
         if file_ext in ['.xlsx', '.xls']:
-            return pd.read_excel(file_path)
+            # Excel 无法分块读取，读完后再抽样；在进程池中解析时，DataFrame 经 pickle 传回
+            if excel_pool is None:
+                df = pd.read_excel(file_path, usecols=usecols, nrows=max_rows)
+            else:
+                df = excel_pool.submit(pd.read_excel, file_path, usecols=usecols, nrows=max_rows).result()
+            if sample_rows and len(df) > sample_rows:
+                df = df.sample(n=sample_rows, random_state=0).sort_index().reset_index(drop=True)
+            return df
         elif file_ext == '.csv':
-            return pd.read_csv(file_path)
+            if max_rows or sample_rows:
+                return read_csv_streaming(file_path, max_rows, sample_rows, usecols)
+            # 整表读取：可用时用 pyarrow 多线程解析，并复用上次推断出的列类型
+            return read_csv(file_path, usecols=usecols)
     except Exception as e:
         raise
 
@@ -40,59 +123,115 @@ def read_file_to_dataframe(file_path: str) -> pd.DataFrame:
 def dataframe_to_json_records(df: pd.DataFrame) -> List[Dict[str, Any]]:
     """将DataFrame转换为JSON记录格式"""
     try:
-        json_str = df.to_json(orient="records", force_ascii=False)
-        return json.loads(json_str) if json_str else []
+        # 按列直接转换，不再先序列化成整表的 JSON 字符串再解析回来
+        return dataframe_to_records(df)
     except Exception as e:
         return []
 
 
-def process_single_file(file_path: str, enable_preview: bool, context: Context) -> Dict[str, Any]:
-    """处理单个文件"""
+def file_size(file_path: str) -> int:
+    try:
+        return os.path.getsize(file_path)
+    except OSError:
+        return 0
+
+
+def pool_size(file_paths: List[str]) -> int:
+    """并发读取的线程（进程）数：不超过文件数和 CPU 数（小文件为 CPU 数的两倍），并保证最大的文件同时读取时不超过内存预算"""
+    sizes = [file_size(p) for p in file_paths]
+    cpus = os.cpu_count() or 1
+    workers = cpus * 2 if max(sizes, default=0) < SMALL_FILE_BYTES else cpus
+
+    largest = max(sizes, default=0)
+    if largest > 0:
+        workers = min(workers, READ_MEMORY_BUDGET // (largest * MEMORY_PER_FILE_BYTE))
+    return max(1, min(workers, len(file_paths)))
+
+
+def is_excel(file_path: str) -> bool:
+    return os.path.splitext(file_path)[1].lower() in EXCEL_EXTENSIONS
+
+
+def excel_process_pool(file_paths: List[str]):
+    """两个以上的 Excel 文件能同时解析时返回解析用的进程池，否则返回空的上下文（在线程中解析）"""
+    excel_files = [p for p in file_paths if is_excel(p)]
+    workers = min(pool_size(excel_files), os.cpu_count() or 1) if excel_files else 1
+    if workers < 2:
+        return nullcontext()
+    # spawn 出的进程不继承其他线程持有的锁
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+def process_single_file(file_path: str, max_rows: int | None = None, sample_rows: int | None = None,
+                        usecols: List[str] | None = None,
+                        excel_pool: Executor | None = None) -> Tuple[Dict[str, Any], Dict[str, Any], pd.DataFrame | None]:
+    """处理单个文件，返回结果、读取统计（行数、字节数、解析和转换耗时）和用于预览的 DataFrame"""
     file_name = os.path.basename(file_path)
+    stats = {"name": file_name, "rows": 0, "bytes": file_size(file_path), "parse_seconds": 0.0, "convert_seconds": 0.0}
     
     try:
         # 读取文件
-        df = read_file_to_dataframe(file_path)
+        start = time.perf_counter()
+        df = read_file_to_dataframe(file_path, max_rows, sample_rows, usecols, excel_pool)
+        stats["parse_seconds"] = round(time.perf_counter() - start, 4)
         
         # 转换为JSON
+        start = time.perf_counter()
         records = dataframe_to_json_records(df)
-        
-        # 预览数据
-        if enable_preview and context and not df.empty:
-            try:
-                context.preview(df)
-            except Exception:
-                pass
+        stats["convert_seconds"] = round(time.perf_counter() - start, 4)
+        stats["rows"] = len(records)
             
-        return {"name": file_name, "rows": records}
+        return {"name": file_name, "rows": records}, stats, df
     except Exception as e:
-        return {"name": file_name, "rows": [], "error": str(e)}
+        stats["error"] = str(e)
+        return {"name": file_name, "rows": [], "error": str(e)}, stats, None
+
+
+def preview_dataframe(df: pd.DataFrame | None, context: Context) -> None:
+    """预览数据"""
+    if context and df is not None and not df.empty:
+        try:
+            context.preview(df)
+        except Exception:
+            pass
 
 
 def main(params: Inputs, context: Context) -> Outputs:
-    """主函数：处理多个文件"""
+    """主函数：并发处理多个文件，输出顺序与输入一致"""
     try:
         # 验证输入参数
         if not params:
-            return {"output": []}
+            return {"output": [], "file_stats": []}
         
         input_files: List[str] = params.get("tables", [])
         enable_preview: bool = params.get("enable_preview", False)
         
         if not input_files:
-            return {"output": []}
+            return {"output": [], "file_stats": []}
         
         # 过滤空字符串和无效路径
         valid_files = [f for f in input_files if f and f.strip()]
         if not valid_files:
-            return {"output": []}
-        
+            return {"output": [], "file_stats": []}
+
+        # CSV 在线程中解析（pyarrow 和 C 解析器会释放 GIL），Excel 交给进程池
+        with excel_process_pool(valid_files) as excel_pool:
+            read_file = partial(process_single_file, max_rows=params.get("max_rows"),
+                                sample_rows=params.get("sample_rows"), usecols=params.get("usecols") or None,
+                                excel_pool=excel_pool)
+            with ThreadPoolExecutor(max_workers=pool_size(valid_files)) as executor:
+                processed = list(executor.map(read_file, valid_files))
+
         results = []
-        for file_path in valid_files:
-            result = process_single_file(file_path, enable_preview, context)
+        file_stats = []
+        for result, stats, df in processed:
+            # 预览在主线程中按输入顺序进行
+            if enable_preview:
+                preview_dataframe(df, context)
             results.append(result)
+            file_stats.append(stats)
         
-        return {"output": results}
+        return {"output": results, "file_stats": file_stats}
         
     except Exception:
-        return {"output": []}
+        return {"output": [], "file_stats": []}
@@ -4,6 +4,7 @@ class Inputs(typing.TypedDict):
     file_name: str
     data_rows: list[dict]
     sample_size: int | None
+    use_llm: bool
 class Outputs(typing.TypedDict):
     summary: str
     fields_schema: list[dict]
@@ -129,6 +130,20 @@ def analyze_data_with_ai(data_rows: List[Dict], file_name: str, llm_client: Clie
         raise DataSummarizerError(f"AI analysis failed: {str(e)}")
 
 
+def analyze_data_locally(data_rows: List[Dict], file_name: str, context: Context) -> Dict[str, Any]:
+    """Analyze data with local type inference only, without calling the LLM"""
+    try:
+        agent = DataLoadAgent(client=None, logger=context.logger)
+        candidates = agent.run_local(input_data={
+            "name": file_name,
+            "rows": data_rows
+        })
+        return candidates[0]['content']
+
+    except Exception as e:
+        raise DataSummarizerError(f"Local analysis failed: {str(e)}")
+
+
 def format_summary(ai_result: Dict[str, Any], statistics: Dict[str, Any]) -> str:
     """Format the summary with AI insights and statistics"""
     summary_parts = []
@@ -176,6 +191,7 @@ def main(params: Inputs, context: Context) -> Outputs:
         file_name = params["file_name"]
         data_rows = params["data_rows"]
         sample_size = params.get("sample_size")
+        use_llm = params.get("use_llm", True) is not False
 
         # Sample data if needed for performance
         sampled_data = sample_data(data_rows, sample_size)
@@ -185,11 +201,14 @@ def main(params: Inputs, context: Context) -> Outputs:
         # Calculate basic statistics
         statistics = calculate_basic_statistics(sampled_data)
 
-        # Create LLM client
-        llm_client = create_llm_client(context)
+        if use_llm:
+            # Create LLM client
+            llm_client = create_llm_client(context)
 
-        # Analyze data with AI
-        ai_result = analyze_data_with_ai(sampled_data, file_name, llm_client, context)
+            # Analyze data with AI, only fields that cannot be typed locally are sent to the LLM
+            ai_result = analyze_data_with_ai(sampled_data, file_name, llm_client, context)
+        else:
+            ai_result = analyze_data_locally(sampled_data, file_name, context)
 
         # Extract results
         fields_schema = ai_result.get("fields", [])
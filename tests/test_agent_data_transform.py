@@ -0,0 +1,64 @@
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from data_formulator import py_sandbox
+from data_formulator.agents.agent_data_transform_v2 import SAMPLE_ROWS, DataTransformationAgentV2
+
+FAST_CODE = "import pandas as pd\n\ndef transform_data(df):\n    return df\n"
+SLOW_CODE = "import pandas as pd\nimport time\n\ndef transform_data(df):\n    time.sleep(30)\n    return df\n"
+INPUT_TABLES = [{'name': 'table', 'rows': [{'a': 1}, {'a': 2}]}]
+
+
+def response(*codes):
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(
+        role="assistant", content=f'{{"visualization_fields": []}}\n```python\n{code}```\n')) for code in codes])
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    pool = py_sandbox.SandboxWorkerPool(size=2)
+    monkeypatch.setattr(py_sandbox, "_default_pool", pool)
+    yield pool
+    pool.close()
+
+
+def test_no_choices_gives_no_candidates():
+    agent = DataTransformationAgentV2(client=None)
+    assert agent.process_gpt_response(INPUT_TABLES, [], response()) == []
+
+
+def test_stop_at_first_ok_stops_the_other_candidates(pool):
+    agent = DataTransformationAgentV2(client=None, stop_at_first_ok=True)
+    candidates = agent.process_gpt_response(INPUT_TABLES, [], response(SLOW_CODE, FAST_CODE))
+    assert [c['code'].strip() for c in candidates] == [FAST_CODE.strip()]
+
+    # the worker running the slow candidate is killed and replaced, the pool is back to full strength
+    deadline = time.monotonic() + 10
+    while pool._idle.qsize() < pool.size and time.monotonic() < deadline:
+        time.sleep(0.1)
+    assert pool._idle.qsize() == pool.size
+
+
+def test_sample_first_runs_single_tables_on_a_sample(monkeypatch):
+    monkeypatch.setattr("data_formulator.agents.agent_data_transform_v2.SAMPLE_FIRST_MIN_ROWS", 100)
+    agent = DataTransformationAgentV2(client=None, sample_first=True)
+    rows = [{'id': i} for i in range(5000)]
+    result = agent.execute_on_sample([{'name': 'table', 'rows': rows}], FAST_CODE)
+    assert result['status'] == 'ok' and len(json.loads(result['content'])) <= SAMPLE_ROWS
+
+
+def test_sample_first_skips_several_tables(monkeypatch):
+    monkeypatch.setattr("data_formulator.agents.agent_data_transform_v2.SAMPLE_FIRST_MIN_ROWS", 100)
+    agent = DataTransformationAgentV2(client=None, sample_first=True)
+    code = ("import pandas as pd\n\ndef transform_data(orders, customers):\n"
+            "    joined = orders.merge(customers, on='customer')\n"
+            "    assert len(joined) == len(orders)\n    return joined\n")
+    orders = [{'order': i, 'customer': i % 500} for i in range(1000)]
+    customers = [{'customer': i, 'name': f"c{i}"} for i in range(500)]
+    tables = [{'name': 'orders', 'rows': orders}, {'name': 'customers', 'rows': customers}]
+    assert agent.execute_on_sample(tables, code) is None
+    result = agent.execute_code(tables, code)
+    assert result['status'] == 'ok' and len(result['content']) == len(orders)
@@ -0,0 +1,57 @@
+import asyncio
+from types import SimpleNamespace
+
+import litellm
+import pytest
+
+from data_formulator.agents import client_utils
+from data_formulator.agents.client_utils import Client
+
+
+class FakeClient(Client):
+    """answers single-choice requests, fails requests with n > 1 with the given error"""
+
+    def __init__(self, error):
+        super().__init__("openai", "fake-model", api_key="key")
+        self.error = error
+
+    def request_choices(self, messages, n):
+        if n > 1:
+            raise self.error
+        return SimpleNamespace(choices=[SimpleNamespace(index=0, message=SimpleNamespace(content="ok"))])
+
+    async def arequest_choices(self, messages, n):
+        return self.request_choices(messages, n)
+
+
+@pytest.fixture(autouse=True)
+def n_support(monkeypatch):
+    monkeypatch.setattr(client_utils, "_n_support", {})
+
+
+@pytest.mark.parametrize("error", [
+    litellm.UnsupportedParamsError(message="openai does not support parameters: {'n': 3}", model="x", llm_provider="openai"),
+    litellm.BadRequestError(message="Unsupported value: 'n' must be 1 for this model", model="x", llm_provider="openai"),
+])
+def test_requests_rejecting_n_fall_back_to_single_choices(error):
+    client = FakeClient(error)
+    assert len(client.request_completion([], n=3).choices) == 3
+    assert client_utils._n_support[client.provider_key()] is False
+
+    client_utils._n_support.clear()
+    assert len(asyncio.run(client.arequest_completion([], n=3)).choices) == 3
+    assert client_utils._n_support[client.provider_key()] is False
+
+
+@pytest.mark.parametrize("error", [
+    litellm.RateLimitError(message="rate limit reached", model="x", llm_provider="openai"),
+    litellm.BadRequestError(message="maximum context length exceeded", model="x", llm_provider="openai"),
+    TimeoutError("timed out"),
+])
+def test_other_errors_are_raised_and_do_not_disable_n(error):
+    client = FakeClient(error)
+    with pytest.raises(type(error)):
+        client.request_completion([], n=3)
+    with pytest.raises(type(error)):
+        asyncio.run(client.arequest_completion([], n=3))
+    assert client.provider_key() not in client_utils._n_support
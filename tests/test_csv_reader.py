@@ -0,0 +1,38 @@
+import json
+
+import pandas as pd
+import pytest
+
+from data_formulator import csv_reader
+
+
+@pytest.fixture
+def schema_cache(tmp_path, monkeypatch):
+    cache = csv_reader.CsvSchemaCache(str(tmp_path / "csv_schemas.json"), max_entries=2)
+    monkeypatch.setattr(csv_reader, "csv_schema_cache", cache)
+    return cache
+
+
+@pytest.mark.parametrize("body", [
+    "a,b\n0x10,1\n0x1F,2\n",
+    "a,b\n12345678901234567890,1\n1,2\n",
+    "a,b\n-9223372036854775809,1\n3,2\n",
+    "a,b\n1.5,x\n1e19,y\n",
+])
+def test_values_match_pandas(tmp_path, schema_cache, body):
+    path = tmp_path / "table.csv"
+    path.write_text(body)
+    for _ in range(2):
+        # the second read uses the cached schema
+        pd.testing.assert_frame_equal(csv_reader.read_csv(str(path)), pd.read_csv(path))
+
+
+def test_schema_cache_keeps_the_most_recently_used_files(tmp_path, schema_cache):
+    paths = [str(tmp_path / f"{name}.csv") for name in "abc"]
+    for path in paths:
+        schema_cache.put(path, {'engine': 'c', 'types': {}, 'dtypes': {}})
+        schema_cache.get(paths[0])
+
+    assert schema_cache.get(paths[1]) is None
+    with open(schema_cache.path) as f:
+        assert list(json.load(f)) == [paths[0], paths[2]]
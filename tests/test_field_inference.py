@@ -0,0 +1,58 @@
+import logging
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+
+from data_formulator.agents.agent_data_load import DataLoadAgent
+from data_formulator.agents.field_inference import infer_field
+
+
+@pytest.mark.parametrize("values", [["$1,200", "$35"], ["5k", "10k"], ["1,200", "35.5"]])
+def test_plain_amounts_are_not_ranges(values):
+    assert infer_field("x", pd.Series(values)) is None
+
+
+@pytest.mark.parametrize("values, order", [
+    (["20+", "10-19", "<10"], ["<10", "10-19", "20+"]),
+    (["over 10", "under 5", "5 to 10"], ["under 5", "5 to 10", "over 10"]),
+])
+def test_ranges_are_sorted_by_their_bounds(values, order):
+    assert infer_field("x", pd.Series(values)) == {"type": "string", "semantic_type": "Range", "sort_order": order}
+
+
+@pytest.mark.parametrize("name, values", [
+    ("phone", ["555-1234", "555-9876"]),
+    ("x", ["1-2", "3-4"]),
+    ("zip", ["98052-6399", "10001-1234"]),
+    ("score", ["2-1", "0-3"]),
+    ("age_group", ["30-39", "20-10"]),
+])
+def test_hyphenated_numbers_are_not_ranges(name, values):
+    assert infer_field(name, pd.Series(values)) is None
+
+
+def test_hyphenated_ranges_need_a_range_like_name():
+    assert infer_field("Age Group", pd.Series(["20-29", "10-19", "1k-2k", "500-999"])) == {
+        "type": "string", "semantic_type": "Range", "sort_order": ["10-19", "20-29", "500-999", "1k-2k"]}
+
+
+def test_times_must_be_zero_padded():
+    assert infer_field("x", pd.Series(["1:2", "3:4"])) is None
+    assert infer_field("x", pd.Series(["09:30", "10:15"]))["semantic_type"] == "Time"
+    assert infer_field("x", pd.Series(["09:30:00", "10:15:30"]))["semantic_type"] == "Time"
+
+
+def test_fields_the_model_skips_get_the_local_fallback():
+    input_data = {"name": "table", "rows": [{"city": "Paris", "score": 0.5}, {"city": "Rome", "score": 0.25}]}
+    agent = DataLoadAgent(client=None, logger=logging.getLogger(__name__))
+    known_fields = agent.infer_fields(input_data)
+    assert known_fields == {"city": None, "score": None}
+
+    response = SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(
+        role="assistant", content='{"fields": {"city": {"type": "string", "semantic_type": "Location", "sort_order": null}}}'))])
+    [result] = agent.process_response([], response, known_fields, input_data)
+    assert result["content"]["fields"] == {
+        "city": {"type": "string", "semantic_type": "Location", "sort_order": None},
+        "score": {"type": "number", "semantic_type": "Number", "sort_order": None},
+    }
@@ -0,0 +1,33 @@
+from data_formulator.agents import plan_cache
+from data_formulator.agents.plan_cache import PlanCache, plan_key
+
+
+def test_plan_cache_is_off_unless_configured(monkeypatch):
+    monkeypatch.delenv("DATA_FORMULATOR_PLAN_CACHE", raising=False)
+    monkeypatch.setattr(plan_cache, "_plan_cache", None)
+    monkeypatch.setattr(plan_cache, "_plan_cache_configured", False)
+    assert plan_cache.get_plan_cache() is None
+
+
+def test_only_the_code_fields_and_explanation_are_stored(tmp_path):
+    cache = PlanCache(str(tmp_path / "plans.sqlite"))
+    key = plan_key("average sales", ["Year"], [[{'Year': 2020, 'Sales': 1.0}]])
+    cache.put(key, "def transform_data(df):\n    return df\n", 2.5, ["Year", "Sales"], "Returns the table.")
+    assert cache.get(key) == {'code': "def transform_data(df):\n    return df\n", 'generation_seconds': 2.5,
+                              'visualization_fields': ["Year", "Sales"], 'explanation': "Returns the table."}
+
+    columns = [row[1] for row in cache._conn.execute("PRAGMA table_info(plans)")]
+    assert columns == ['key', 'code', 'visualization_fields', 'explanation', 'generation_seconds', 'created',
+                       'last_used']
+
+
+def test_least_recently_used_plans_are_evicted(tmp_path):
+    cache = PlanCache(str(tmp_path / "plans.sqlite"), max_entries=2)
+    for key in ["a", "b"]:
+        cache.put(key, f"code {key}", 1.0)
+    cache.get("a")
+    cache.put("c", "code c", 1.0)
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+    assert cache.stats()['entries'] == 2
+
@@ -0,0 +1,36 @@
+import json
+
+import pytest
+
+from data_formulator.py_sandbox import is_row_local, run_derive_data_in_sandbox2020
+
+
+@pytest.mark.parametrize("code", [
+    'def derive(a):\n    return a * 2\n',
+    'import math\n\ndef derive(a):\n    return math.sqrt(a)\n',
+    'RATE = 1.5\nNAMES = {"a": 1}\n\ndef scale(x):\n    return x * RATE\n\ndef derive(a):\n    return scale(a) + NAMES.get("a", 0)\n',
+    'def derive(df):\n    return df + 1\n',
+])
+def test_row_local_code(code):
+    assert is_row_local(code, "derive")
+
+
+@pytest.mark.parametrize("code", [
+    'def derive(a):\n    return a / df["a"].sum()\n',
+    'def total():\n    return df["a"].sum()\n\ndef derive(a):\n    return a / total()\n',
+    'def total():\n    return load_table(table_rows)["a"].sum()\n\ndef share(a):\n    return a / total()\n\ndef derive(a):\n    return share(a)\n',
+    'TOTAL = len(table_rows)\n\ndef derive(a):\n    return a / TOTAL\n',
+    'seen = []\n\ndef derive(a):\n    seen.append(a)\n    return len(seen)\n',
+    'count = 0\n\ndef derive(a):\n    global count\n    count += 1\n    return count\n',
+    'class Counter:\n    n = 0\n\ndef derive(a):\n    Counter.n += 1\n    return Counter.n\n',
+])
+def test_code_reading_other_rows_is_not_row_local(code):
+    assert not is_row_local(code, "derive")
+
+
+def test_helpers_reading_df_are_not_partitioned():
+    code = 'def total():\n    return df["a"].sum()\n\ndef derive(a):\n    return a / total()\n'
+    rows = [{'a': 1} for _ in range(50000)]
+    result = run_derive_data_in_sandbox2020(code, ['a'], 'share', rows, partitioned=True)
+    assert result['status'] == 'ok'
+    assert sum(r['share'] for r in json.loads(result['content'])) == pytest.approx(1.0)
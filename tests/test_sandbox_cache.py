@@ -0,0 +1,103 @@
+import json
+import os
+import sys
+
+import pytest
+
+from data_formulator import sandbox_io
+from data_formulator.agents.agent_utils import summarize_table
+from data_formulator.py_sandbox import run_transform_in_sandbox2020
+from data_formulator.sandbox_cache import cached_sandbox_call, configure_result_cache
+from data_formulator.sandbox_io import ARROW_HANDOFF_MIN_ROWS, TableStore, table_fingerprint
+
+
+@pytest.fixture(autouse=True)
+def result_cache():
+    yield configure_result_cache()
+    configure_result_cache()
+
+
+@cached_sandbox_call('table_rows')
+def cell_types(code, table_rows):
+    return {'status': 'ok', 'content': [type(r['x']).__name__ for r in table_rows]}
+
+
+@pytest.mark.parametrize("left, right", [
+    ([{"x": 1}, {"x": "a"}], [{"x": "1"}, {"x": "a"}]),
+    ([{"x": True}, {"x": "a"}], [{"x": "True"}, {"x": "a"}]),
+])
+def test_cells_of_different_types_are_not_confused(left, right):
+    assert table_fingerprint(left) != table_fingerprint(right)
+    assert cell_types("", left)['content'] == [type(r['x']).__name__ for r in left]
+    assert cell_types("", right)['content'] == [type(r['x']).__name__ for r in right]
+
+
+def test_fingerprints_do_not_stage_tables():
+    store = TableStore()
+    rows = [{'a': i} for i in range(ARROW_HANDOFF_MIN_ROWS)]
+    store.fingerprint(rows)
+    assert store.staged_path(rows) is None
+
+    path = store.stage(rows)
+    assert path is not None and store.staged_path(rows) == path
+    store.clear()
+
+
+def test_tables_changed_in_place_are_prepared_again():
+    store = TableStore()
+    rows = [{'a': i} for i in range(100)]
+    before = store.fingerprint(rows)
+    for row in rows:
+        row['a'] += 1
+    assert store.fingerprint(rows) != before
+
+
+def test_store_is_bounded_by_bytes():
+    store = TableStore(max_bytes=1024 * 1024)
+    tables = [[{'a': i, 'b': str(i)} for i in range(ARROW_HANDOFF_MIN_ROWS)] for _ in range(4)]
+    paths = []
+    for rows in tables:
+        paths.append(store.stage(rows))
+        store.release(paths[-1])
+    assert len(store._entries) < len(tables)
+    assert os.path.exists(paths[-1]) and not os.path.exists(paths[0])
+    store.clear()
+
+
+def test_store_counts_the_rows_it_keeps():
+    store = TableStore(max_bytes=1024 * 1024)
+    tables = [[{'a': i} for i in range(2000)] for _ in range(4)]
+    for rows in tables:
+        store.fingerprint(rows)
+    kept = [rows for rows in tables if rows in store]
+    assert sum(sys.getsizeof(row) for rows in kept for row in rows) <= store.max_bytes
+
+
+def test_summaries_build_one_frame_per_table(monkeypatch):
+    def from_records(*args, **kwargs):
+        raise AssertionError("the store built a second frame")
+    monkeypatch.setattr(sandbox_io.pd.DataFrame, "from_records", from_records)
+    rows = [{'a': i, 'b': str(i)} for i in range(100)]
+    assert "a -- type: int64" in summarize_table(rows, False, 7)[0]
+    assert rows in sandbox_io.table_store
+
+
+def test_staged_files_stay_until_released():
+    store = TableStore(max_bytes=1024 * 1024)
+    tables = [[{'a': i, 'b': str(i)} for i in range(ARROW_HANDOFF_MIN_ROWS)] for _ in range(3)]
+    paths = [store.stage(rows) for rows in tables]
+    assert all(os.path.exists(path) for path in paths)
+
+    for path in paths:
+        store.release(path)
+    assert not os.path.exists(paths[0]) and os.path.exists(paths[-1])
+    store.clear()
+
+
+def test_tables_of_one_execution_may_exceed_the_store(monkeypatch):
+    monkeypatch.setattr(sandbox_io.table_store, "max_bytes", 10 ** 6)
+    code = "import pandas as pd\n\ndef transform_data(left, right):\n    return pd.DataFrame({'n': [len(left), len(right)]})\n"
+    tables = [[{'a': i, 'b': str(i)} for i in range(2 * ARROW_HANDOFF_MIN_ROWS)] for _ in range(2)]
+    result = run_transform_in_sandbox2020(code, tables, use_pool=False)
+    assert result['status'] == 'ok', result['content']
+    assert json.loads(result['content']) == [{'n': len(tables[0])}, {'n': len(tables[1])}]
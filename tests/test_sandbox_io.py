@@ -0,0 +1,87 @@
+import gc
+import json
+import sys
+from multiprocessing import shared_memory
+
+import pandas as pd
+import pytest
+
+from data_formulator.py_sandbox import run_transform_in_sandbox2020
+from data_formulator.sandbox_io import ARROW_HANDOFF_MIN_ROWS, DUMP_TABLE_STR, read_result_table, result_block_name, \
+    table_store
+
+CELL_TYPES_CODE = '''
+import pandas as pd
+
+def transform_data(df):
+    return pd.DataFrame({'name': list(df.columns), 'type': [type(df[c].iloc[-1]).__name__ for c in df.columns]})
+'''
+
+
+def test_large_tables_with_nested_cells_keep_their_python_values():
+    rows = [{'id': i, 'tags': ['a', 'b'], 'meta': {'k': i}} for i in range(ARROW_HANDOFF_MIN_ROWS)]
+    rows[-1]['meta'] = {'other': 1}
+    assert table_store.stage(rows) is None
+
+    result = run_transform_in_sandbox2020(CELL_TYPES_CODE, [rows], use_pool=False)
+    assert result['status'] == 'ok'
+    assert {r['name']: r['type'] for r in json.loads(result['content'])} == {'id': 'int64', 'tags': 'list', 'meta': 'dict'}
+
+
+def test_dict_cells_of_arrow_results_keep_their_keys():
+    code = "import pandas as pd\n\ndef transform_data(df):\n    return df\n"
+    for rows in ([{'x': {'x': 1}}, {'x': {'y': 2}}], [{'x': [1, 2]}, {'x': []}]):
+        result = run_transform_in_sandbox2020(code, [rows], use_pool=False, output_format="arrow")
+        assert result['status'] == 'ok'
+        assert result['content'].to_dict("records") == rows
+
+
+def test_reading_a_result_releases_its_shared_memory(monkeypatch):
+    pytest.importorskip("pyarrow")
+    unraisable = []
+    monkeypatch.setattr(sys, "unraisablehook", unraisable.append)
+
+    namespace = {'pd': pd}
+    exec(DUMP_TABLE_STR, namespace)
+    df = pd.DataFrame({'a': pd.Categorical(['x', 'y'] * 1000), 'b': range(2000)})
+    shm_name = result_block_name()
+    content = namespace['dump_table'](df, shm_name)
+    assert 'shm' in content
+
+    result = read_result_table(content, shm_name)
+    assert result.equals(df)
+    del result
+    gc.collect()
+    assert unraisable == []
+
+
+def test_results_cannot_free_other_shared_memory_blocks():
+    victim = shared_memory.SharedMemory(create=True, size=16)
+    try:
+        code = ("import pandas as pd\n\n"
+                "def transform_data(df):\n"
+                "    global dump_table\n"
+                f"    dump_table = lambda df, shm_name: {{'format': 'arrow', 'shm': {victim.name!r}, 'size': 1}}\n"
+                "    return df\n")
+        result = run_transform_in_sandbox2020(code, [[{'a': 1}]], use_pool=False, output_format="arrow")
+        assert result['status'] == 'ok'
+
+        forged = {'format': 'arrow', 'shm': victim.name, 'size': 1}
+        with pytest.raises(ValueError):
+            read_result_table(forged, result_block_name())
+        shared_memory.SharedMemory(name=victim.name).close()
+    finally:
+        victim.close()
+        victim.unlink()
+
+
+def test_unreadable_results_report_the_read_error():
+    pytest.importorskip("pyarrow")
+    shm_name = result_block_name()
+    block = shared_memory.SharedMemory(name=shm_name, create=True, size=64)
+    block.buf[:64] = b"\xff" * 64
+    block.close()
+
+    with pytest.raises(Exception) as error:
+        read_result_table({'format': 'arrow', 'shm': shm_name, 'size': 64}, shm_name)
+    assert not isinstance(error.value, BufferError)
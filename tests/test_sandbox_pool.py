@@ -0,0 +1,62 @@
+import os
+
+import pytest
+
+from data_formulator.py_sandbox import SandboxWorkerPool, run_script_in_sandbox
+
+resource = pytest.importorskip("resource")
+
+
+@pytest.fixture
+def pool():
+    pool = SandboxWorkerPool(size=1)
+    yield pool
+    pool.close()
+
+
+def test_patched_modules_do_not_leak_into_the_next_run(pool):
+    patch = ("import pandas as pd\n"
+             "pd.Series.sum = lambda self, *args, **kwargs: -1\n"
+             "pd.set_option('display.max_rows', 3)\n"
+             "output = pd.Series([1, 2]).sum()\n")
+    assert pool.run(patch, {})['content'] == -1
+
+    probe = ("import pandas as pd\n"
+             "output = (int(pd.Series([1, 2]).sum()), pd.get_option('display.max_rows'))\n")
+    assert pool.run(probe, {})['content'] == (3, 60)
+
+
+def test_limits_do_not_leak_into_the_next_run(pool):
+    limited = pool.run("output = 1", {}, limits={'timeout': 30, 'cpu_time': 5, 'memory': 2 ** 34})
+    assert limited['status'] == 'ok'
+
+    probe = "import resource\noutput = resource.getrlimit(resource.RLIMIT_AS)[0], resource.getrlimit(resource.RLIMIT_CPU)[0]"
+    result = pool.run(probe, {}, limits={'timeout': 30, 'cpu_time': None, 'memory': None})
+    assert result['content'] == (resource.RLIM_INFINITY, resource.RLIM_INFINITY)
+
+
+def test_workers_are_not_forked_from_the_main_process(pool):
+    # a fork of the (multithreaded) main process could inherit locks held by its other threads
+    result = pool.run("import os\noutput = os.getppid()", {})
+    assert result['status'] == 'ok' and result['content'] != os.getpid()
+
+
+def test_memory_budget_is_on_top_of_what_the_sandbox_inherits():
+    np = pytest.importorskip("numpy")
+    # reserved, never touched: grows the address space a forked sandbox starts with, not its memory use
+    reserved = np.empty(2 ** 31, dtype=np.uint8)
+    code = "import numpy as np\noutput = int(np.ones(10 ** 7).sum())"
+    result = run_script_in_sandbox(code, {}, use_pool=False, limits={'memory': 256 * 2 ** 20})
+    assert result['status'] == 'ok' and result['content'] == 10 ** 7
+    del reserved
+
+
+@pytest.mark.parametrize("use_pool", [True, False])
+def test_peak_rss_counts_only_the_execution(use_pool):
+    np = pytest.importorskip("numpy")
+    # touched, so that it is part of the RSS a forked sandbox starts with
+    inherited = np.ones(2 ** 25)
+    result = run_script_in_sandbox("output = 1", {}, use_pool=use_pool)
+    assert result['status'] == 'ok'
+    assert 0 <= result['timings']['peak_rss_increase'] < inherited.nbytes / 2
+    del inherited
@@ -0,0 +1,34 @@
+import pytest
+
+from data_formulator.sandbox_preflight import check_transform_code
+
+ROWS = [{'Year': 2020, 'Sales': 1}, {'Year': 2021, 'Sales': 2}]
+
+
+def transform(body, imports=""):
+    return f"import pandas as pd\n{imports}\ndef transform_data(df):\n{body}\n"
+
+
+@pytest.mark.parametrize("imports", ["import io", "import os", "import pathlib", "import glob", "from io import StringIO"])
+def test_modules_the_sandbox_allows_are_not_rejected(imports):
+    assert check_transform_code(transform("    return df", imports), [ROWS]) == []
+
+
+def test_modules_the_sandbox_blocks_are_rejected():
+    errors = check_transform_code(transform("    return df", "import subprocess"), [ROWS])
+    assert len(errors) == 1 and "subprocess" in errors[0]
+
+
+@pytest.mark.parametrize("body", [
+    '    if "Month" in df.columns:\n        df["Month"] = df["Month"] + 1\n    return df',
+    '    if "Month" not in df.columns:\n        return df\n    else:\n        return df[["Month"]]',
+    '    df["x"] = df["Month"] if "Month" in df.columns else 0\n    return df',
+    '    try:\n        df["x"] = df["Month"]\n    except KeyError:\n        pass\n    return df',
+])
+def test_guarded_column_reads_are_not_rejected(body):
+    assert check_transform_code(transform(body), [ROWS]) == []
+
+
+def test_unguarded_missing_columns_are_rejected():
+    errors = check_transform_code(transform('    if "Year" in df.columns:\n        pass\n    return df[["Yeer"]]'), [ROWS])
+    assert len(errors) == 1 and "did you mean 'Year'" in errors[0]
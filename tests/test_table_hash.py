@@ -0,0 +1,87 @@
+import random
+
+import pandas as pd
+import pytest
+
+from data_formulator.agents.agent_utils import table_hash, value_handling_func
+
+
+def old_table_hash(table):
+    """table_hash before it was vectorized, the reference for how candidates are grouped"""
+    if len(table) == 0:
+        return hash(table)
+    schema = sorted(list(table[0].keys()))
+    frozen_table = tuple(sorted([tuple([hash(value_handling_func(r[key])) for key in schema]) for r in table]))
+    return hash(frozen_table)
+
+
+WORDS = ["a", "b", "north", "south", "x y"]
+
+
+def random_value(rng, kind):
+    if kind == "int":
+        return rng.randint(-5, 5)
+    if kind == "bigint":
+        return 2 ** 60 + rng.randint(0, 3)
+    if kind == "float":
+        return round(rng.uniform(-5, 5), rng.choice([0, 2, 5]))
+    if kind == "text":
+        return rng.choice(WORDS)
+    # mixed numbers and text
+    return rng.choice([rng.randint(0, 3), float(rng.randint(0, 3)), str(rng.randint(0, 3)), rng.choice(WORDS)])
+
+
+def random_table(rng):
+    kinds = [rng.choice(["int", "bigint", "float", "text", "mixed"]) for _ in range(rng.randint(1, 3))]
+    return [{f"c{i}": random_value(rng, kind) for i, kind in enumerate(kinds)} for _ in range(rng.randint(1, 6))]
+
+
+def same_values_changed(rng, value):
+    """a value value_handling_func does not tell apart from value"""
+    if isinstance(value, str):
+        return value
+    if isinstance(value, int) and abs(value) > 2 ** 53:
+        # swapping one of them for a float would turn the column into floats, which cannot hold them exactly
+        return value
+    if float(value) == int(value):
+        return rng.choice([int(value), float(value), str(int(value)), str(float(value))])
+    return value + rng.choice([0, 1e-7, -1e-7])
+
+
+def variant(rng, table):
+    """a copy of table with shuffled rows and columns, equivalent values swapped in, and maybe an edit"""
+    columns = list(table[0].keys())
+    rng.shuffle(columns)
+    rows = [{c: same_values_changed(rng, r[c]) for c in columns} for r in table]
+    rng.shuffle(rows)
+    if rng.random() < 0.3:
+        row, column = rng.randrange(len(rows)), rng.choice(columns)
+        rows[row][column] = rng.choice([rng.choice(WORDS), rng.randint(10, 20), "7", 2 ** 60 + rng.randint(0, 3)])
+    if rng.random() < 0.1:
+        rows.append(dict(rows[0]))
+    return rows
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_candidates_are_grouped_like_the_old_hash(seed):
+    rng = random.Random(seed)
+    for _ in range(50):
+        table = random_table(rng)
+        other = variant(rng, table)
+        assert (table_hash(table) == table_hash(other)) == (old_table_hash(table) == old_table_hash(other)), (table, other)
+
+
+@pytest.mark.parametrize("values", [[3, "a"], [3.0, "a"], ["3", "a"]])
+def test_numbers_in_mixed_columns_match_their_numeric_strings(values):
+    assert table_hash([{"x": v} for v in values]) == table_hash([{"x": 3}, {"x": "a"}])
+
+
+def test_dataframes_and_records_hash_alike():
+    records = [{"a": 1, "b": "x"}, {"a": 2, "b": "y"}]
+    assert table_hash(pd.DataFrame(records)) == table_hash(records)
+
+
+def test_large_integers_stay_distinct():
+    assert table_hash([{"id": 2 ** 60 + 1}]) != table_hash([{"id": 2 ** 60 + 2}])
+    assert table_hash([{"id": 2 ** 60 + 1}, {"id": "a"}]) != table_hash([{"id": 2 ** 60 + 2}, {"id": "a"}])
+    assert table_hash([{"id": 2 ** 60}]) == table_hash([{"id": float(2 ** 60)}])
@@ -0,0 +1,41 @@
+import json
+
+import pytest
+
+from data_formulator.py_sandbox import run_derive_data_in_sandbox2020, run_filter_data_in_sandbox2020
+
+ROWS = [{'name': f"Name{i}" if i % 50 else None, 'price': i % 100, 'quantity': i % 7} for i in range(1000)]
+
+
+def derived_values(code, fields, mode):
+    result = run_derive_data_in_sandbox2020(code, fields, 'out', ROWS, mode=mode, partitioned=False)
+    assert result['status'] == 'ok', result
+    return [r['out'] for r in json.loads(result['content'])], result.get('mode')
+
+
+@pytest.mark.parametrize("code", [
+    'def derive(name):\n    return name if name is not None else "unknown"\n',
+    'def derive(name):\n    return name.lower() if isinstance(name, str) else name\n',
+])
+def test_auto_mode_keeps_row_wise_semantics(code):
+    auto, mode = derived_values(code, ['name'], "auto")
+    assert mode == "rowwise"
+    assert auto == derived_values(code, ['name'], "rowwise")[0]
+
+
+def test_row_wise_is_the_default():
+    code = 'def derive(price, quantity):\n    return price * quantity\n'
+    result = run_derive_data_in_sandbox2020(code, ['price', 'quantity'], 'out', ROWS)
+    assert result['mode'] == "rowwise"
+
+
+def test_auto_mode_vectorizes_code_that_agrees_with_row_wise():
+    code = 'def derive(price, quantity):\n    return price * quantity * 1.2\n'
+    auto, mode = derived_values(code, ['price', 'quantity'], "auto")
+    assert mode == "vectorized"
+    assert auto == pytest.approx(derived_values(code, ['price', 'quantity'], "rowwise")[0])
+
+    code = 'def filter_row(row, df):\n    return (row["price"] > 50) & (row["quantity"] % 2 == 0)\n'
+    result = run_filter_data_in_sandbox2020(code, ROWS, mode="auto")
+    assert result['mode'] == "vectorized"
+    assert result['content'] == run_filter_data_in_sandbox2020(code, ROWS, mode="rowwise")['content']